@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" benchmark of the raw decoding of piRaw, runs without RaspberryPi and camera
+
+Generates synthetic JPEG+BRCM buffers as delivered by picamera for the V1, V2 and HQ camera, with
+a known pixel pattern. These are decoded with PiBayerFlatArray.flush() and demosaiced with all
+of DEMOSAIC_ALGORITHMS. For each step, the time, throughput and peak memory are reported, and the
+result is compared bit by bit with the original implementation from picamera PR 309, which is
+included below unchanged. It only knows the 10 bit sensors. For 12 bit sensors, the demosaic is
+compared to the 10 bit demosaic of the same picture.
+
+picamera is not needed. If pyfits is not installed, astropy.io.fits or a stub is used instead. Usage, e.g.:
+  benchPiRaw.py --sensors RP_imx219 --repeat 3
+"""
+
+__author__    = 'Georg Viehoever'
+__copyright__ = 'Copyright 2016, Georg Viehoever, reference implementation Copyright (c) 2013-2015 Dave Jones <dave@waveform.org.uk>'
+__license__   = "MIT, see piRaw.py. For the reference implementation see the license of PiBayerFlatArray in piRaw.py"
+__version__   = '0.3.0'
+
+import argparse
+import statistics
+import sys
+import time
+import tracemalloc
+import types
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def installStubs():
+    """ install stub module pyfits if it is not available, so that piRaw can be imported. piRaw itself
+    works without picamera
+    returns list of the names of the stubbed modules
+    """
+    stubbed=[]
+    try:
+        import pyfits
+    except ImportError:
+        try:
+            from astropy.io import fits as pyfits
+        except ImportError:
+            # only needed for writing files, which is not benchmarked
+            pyfits=types.ModuleType("pyfits")
+        sys.modules["pyfits"]=pyfits
+        stubbed.append("pyfits")
+    return stubbed
+
+STUBBED=installStubs()
+""" names of modules replaced by stubs"""
+
+import piRaw
+
+#
+# Synthetic buffers
+#
+PATTERNS=("noise","ramp")
+""" pixel patterns: noise has all combinations of bits, ramp is a smooth gradient like a real picture"""
+
+def makeMosaic(sensor,pattern="noise",seed=0):
+    """ returns uint16 mosaic with the shape and bits of sensor, a key of piRaw.BAYER_BUFFER_LAYOUTS
+    """
+    layout=piRaw.BAYER_BUFFER_LAYOUTS[sensor]
+    shape=layout["shape"]
+    maxValue=(1<<layout["bits"])-1
+    if pattern=="noise":
+        return np.random.RandomState(seed).randint(0,maxValue+1,shape).astype(np.uint16)
+    rows,cols=np.ogrid[0:shape[0],0:shape[1]]
+    return ((rows*maxValue)//shape[0]//2+(cols*maxValue)//shape[1]//2).astype(np.uint16)
+
+#
+# Reference implementation, picamera PR 309 as in piRaw 0.2.0
+#
+def referenceFlush(value):
+    """ returns mosaic decoded from value, the bytes of the buffer
+    """
+    ver = 1
+    data = value[-6404096:]
+    if data[:4] != b'BRCM':
+        ver = 2
+        data = value[-10270208:]
+        if data[:4] != b'BRCM':
+            raise ValueError('Unable to locate Bayer data at end of buffer')
+    # Strip header
+    data = data[32768:]
+    # Reshape into 2D pixel values
+    reshape, crop = {
+        1: ((1952, 3264), (1944, 3240)),
+        2: ((2480, 4128), (2464, 4100)),
+    }[ver]
+    data = np.frombuffer(data, dtype=np.uint8). \
+               reshape(reshape)[:crop[0], :crop[1]]
+    # Unpack 10-bit values; every 5 bytes contains the high 8-bits of 4
+    # values followed by the low 2-bits of 4 values packed into the fifth
+    # byte
+    data = data.astype(np.uint16) << 2
+    for byte in range(4):
+        data[:, byte::5] |= ((data[:, 4::5] >> ((4 - byte) * 2)) & 3)
+    # Create a new array from the unpacked data
+    array = np.zeros((data.shape[0], (data.shape[1]*4)//5), dtype=np.uint16)
+    for i in range(4):
+        array[:, i::4] = data[:, i::5]
+    return array
+
+def referenceDemosaic(array):
+    """ returns RGB array demosaiced from mosaic array
+    """
+    # Construct representation of the bayer pattern
+    expandedArray = np.zeros(array.shape + (3,), dtype=array.dtype)
+    expandedArray[1::2, 1::2, 0] = array[1::2, 1::2]  # Red
+    expandedArray[1::2, 0::2, 1] = array[1::2, 0::2]  # Green
+    expandedArray[0::2, 1::2, 1] = array[0::2, 1::2]  # Green
+    expandedArray[0::2, 0::2, 2] = array[0::2, 0::2]  # Blue
+    # Construct representation of the bayer pattern
+    bayer = np.zeros(expandedArray.shape, dtype=np.uint8)
+    bayer[1::2, 1::2, 0] = 1  # Red
+    bayer[0::2, 1::2, 1] = 1  # Green
+    bayer[1::2, 0::2, 1] = 1  # Green
+    bayer[0::2, 0::2, 2] = 1  # Blue
+    # Allocate output array with same shape as data and set up some
+    # constants to represent the weighted average window
+    window = (3, 3)
+    borders = (window[0] - 1, window[1] - 1)
+    border = (borders[0] // 2, borders[1] // 2)
+    # Pad out the data and the bayer pattern (np.pad is faster but
+    # unavailable on the version of numpy shipped with Raspbian at the
+    # time of writing)
+    rgb = np.zeros((
+        expandedArray.shape[0] + borders[0],
+        expandedArray.shape[1] + borders[1],
+        expandedArray.shape[2]), dtype=array.dtype)
+    rgb[
+    border[0]:rgb.shape[0] - border[0],
+    border[1]:rgb.shape[1] - border[1],
+    :] = expandedArray
+    bayer_pad = np.zeros((
+        expandedArray.shape[0] + borders[0],
+        expandedArray.shape[1] + borders[1],
+        expandedArray.shape[2]), dtype=bayer.dtype)
+    bayer_pad[
+    border[0]:bayer_pad.shape[0] - border[0],
+    border[1]:bayer_pad.shape[1] - border[1],
+    :] = bayer
+    bayer = bayer_pad
+    # For each plane in the RGB data, construct a view over the plane
+    # of 3x3 matrices. Then do the same for the bayer array and use
+    # Einstein summation to get the weighted average
+    demo = np.empty(expandedArray.shape, dtype=expandedArray.dtype)
+    for plane in range(3):
+        p = rgb[..., plane]
+        b = bayer[..., plane]
+        pview = as_strided(p, shape=(
+                                        p.shape[0] - borders[0],
+                                        p.shape[1] - borders[1]) + window, strides=p.strides * 2)
+        bview = as_strided(b, shape=(
+                                        b.shape[0] - borders[0],
+                                        b.shape[1] - borders[1]) + window, strides=b.strides * 2)
+        psum = np.einsum('ijkl->ij', pview)
+        bsum = np.einsum('ijkl->ij', bview)
+        demo[..., plane] = psum // bsum
+    return demo
+
+#
+# Benchmark
+#
+def flushOutput(data,allocate=None):
+    """ returns PiBayerFlatArray into which data has been written and flushed, as done by picamera.
+    Timings include writing data into the output, a copy of about 10 MB
+    """
+    output=piRaw.PiBayerFlatArray(None,allocate)
+    output.write(data)
+    output.flush()
+    return output
+
+def measure(function,repeat):
+    """ returns (result,seconds,peakBytes): result of the last call of function, median time of repeat calls,
+    peak memory allocated during one call as reported by tracemalloc
+    """
+    times=[]
+    for _ in range(repeat):
+        start=time.perf_counter()
+        result=function()
+        times.append(time.perf_counter()-start)
+        del result
+    # separate call, tracemalloc slows down allocations
+    tracemalloc.start()
+    try:
+        result=function()
+        peak=tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return (result,statistics.median(times),peak)
+
+def compare(result,expected):
+    """ returns string describing the difference between arrays result and expected
+    """
+    if result.shape!=expected.shape:
+        return "shape {!s} instead of {!s}".format(result.shape,expected.shape)
+    if np.array_equal(result,expected):
+        return "bit exact"
+    diff=np.abs(result.astype(np.int32)-expected)
+    return "max diff {:d}, mean diff {:.2f}".format(int(diff.max()),float(diff.mean()))
+
+def benchSensor(sensor,pattern,repeat,bReference):
+    """ benchmark decoding and demosaic of a synthetic buffer of sensor, print results
+    """
+    mosaic=makeMosaic(sensor,pattern)
+    data=piRaw.makeBayerBuffer(mosaic,sensor)
+    pixels=mosaic.size
+    bits=piRaw.BAYER_BUFFER_LAYOUTS[sensor]["bits"]
+    # the reference decoder only knows the 10 bit V1 and V2 cameras
+    bReferenceFlush=bReference and bits==10
+    print("{:s}, {:d} bit, {:s} pattern, {:d}x{:d} pixels, buffer {:.1f} MB".format(sensor,bits,pattern,mosaic.shape[1],
+                                                                                mosaic.shape[0],len(data)/1e6))
+    print("{:24s} {:>9s} {:>10s} {:>10s}  {:s}".format("step","ms","Mpixel/s","peak MB","result"))
+
+    def report(name,seconds,peak,check):
+        print("{:24s} {:9.1f} {:10.1f} {:10.1f}  {:s}".format(name,1000*seconds,pixels/seconds/1e6,peak/1e6,check))
+
+    reference=None
+    if bReferenceFlush:
+        reference,seconds,peak=measure(lambda: referenceFlush(data),repeat)
+        report("flush PR309",seconds,peak,compare(reference,mosaic))
+
+    def flushNew():
+        output=flushOutput(data)
+        array=output.array
+        output.close()
+        return array
+    array,seconds,peak=measure(flushNew,repeat)
+    report("flush",seconds,peak,compare(array,mosaic))
+
+    pool=piRaw.FramePool(1)
+    def flushPool():
+        output=flushOutput(data,pool.acquire)
+        array=output.array
+        output.close()
+        pool.release(array)
+        return array
+    flushPool()
+    _,seconds,peak=measure(flushPool,repeat)
+    report("flush preallocated",seconds,peak,"")
+
+    # as in RawCamera.capture(True): the algorithms work on the flipped RGGB view
+    if bReference:
+        referenceDemo,seconds,peak=measure(lambda: referenceDemosaic(mosaic),repeat)
+        report("demosaic PR309",seconds,peak,"")
+    output=flushOutput(data)
+    for algorithm in sorted(piRaw.DEMOSAIC_ALGORITHMS):
+        if algorithm=="reference" and not bReference:
+            continue
+        def demosaic():
+            output._demo=None
+            return output.demosaic(algorithm)
+        demo,seconds,peak=measure(demosaic,repeat)
+        check=""
+        if bReference and demo.shape==referenceDemo.shape:
+            check=compare(demo,referenceDemo)+" to PR309"
+        report("demosaic "+algorithm,seconds,peak,check)
+    output.close()
+
+    if bits>10:
+        checkBits(mosaic,bits)
+
+    size=256
+    preview,seconds,peak=measure(lambda: piRaw.previewFromMosaic(mosaic[::-1,::-1],size),repeat)
+    report("preview {:d}".format(size),seconds,peak,"")
+    print()
+
+def checkBits(mosaic,bits):
+    """ print comparison of the demosaic of mosaic with bits to the demosaic of its upper 10 bits. Both
+    must agree up to rounding. Also checks a saturated star, a single red pixel with saturated green
+    neighbours, which must stay saturated
+    """
+    shift=bits-10
+    maxValue=(1<<bits)-1
+    # as in PiBayerFlatArray.demosaic(): the algorithms work on the flipped RGGB view
+    low=mosaic[::-1,::-1]>>shift
+    star=np.zeros((8,8),dtype=np.uint16)
+    star[0::2,1::2]=maxValue
+    star[1::2,0::2]=maxValue
+    star[4,4]=maxValue
+    for algorithm in ("superpixel","bilinear","edge"):
+        function=piRaw.DEMOSAIC_ALGORITHMS[algorithm]
+        expected=function(low).astype(np.int32)<<shift
+        if algorithm=="edge":
+            result=function(low<<shift,bits=bits)
+            starGreen=int(function(star,bits=bits)[4,4,1])
+        else:
+            result=function(low<<shift)
+            starGreen=int(function(star)[4,4,1]) if algorithm=="bilinear" else maxValue
+        diff=int(np.abs(result-expected).max())
+        bOk=diff<=2<<shift and starGreen==maxValue
+        print("{:24s} {:>9s} {:>10s} {:>10s}  max diff {:d} to 10 bit, star green {:d}: {:s}".format(
+            "{:d} bit {:s}".format(bits,algorithm),"","","",diff,starGreen,"ok" if bOk else "FAILED"))
+
+def main():
+    parser=argparse.ArgumentParser(description="%(prog)s benchmarks the raw decoding and demosaic of piRaw "
+                                               "with synthetic buffers")
+    parser.add_argument("--sensors",nargs="+",choices=sorted(piRaw.BAYER_BUFFER_LAYOUTS),
+                        default=sorted(piRaw.BAYER_BUFFER_LAYOUTS),
+                        help="sensors. Default %(default)s")
+    parser.add_argument("--pattern",choices=PATTERNS,default="noise",help="pixel pattern. Default %(default)s")
+    parser.add_argument("--repeat",type=int,default=3,help="number of timed runs per step. Default %(default)s")
+    parser.add_argument("--noReference",action="store_true",
+                        help="skip the reference implementation, its demosaic needs seconds on a PC and minutes on a Pi.")
+    args=parser.parse_args()
+    print("piRaw {!s}, numpy {!s}, python {!s}".format(piRaw.__version__,np.__version__,sys.version.split()[0]))
+    if STUBBED:
+        print("Stubs for", ", ".join(STUBBED))
+    for sensor in args.sensors:
+        benchSensor(sensor,args.pattern,max(1,args.repeat),not args.noReference)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """ tool capturing RAW images on a RaspberryPi
-Profike with options -mcProfile -s"tottime"
+Profile with option --profile DIR, which writes cProfile statistics of each stage and tracemalloc snapshots
 
 In addition to the modules available with Raspian anyway, you will need tto install
 the following packages via apt-get or Settings/Add/Remove Software
 - python3-numpy
-- python3-matplotlib
+- python3-matplotlib (only for the GUI)
 - python3-pyfits
 
+The GUI is in piRawGui.py, which must be in the same directory. Use --headless for
+capture runs without GUI, e.g. for unattended timelapses:
+  piRaw.py --headless --shutter 10 --count 300 --delay 90 --autoShutter
+Without RaspberryPi, e.g. for testing and profiling on a PC, --simulate uses a simulated camera,
+picamera is not needed then:
+  piRaw.py --headless --simulate 0.01 --shutter 10 --count 20 --delay 0 --format raw10
+
 If RPi does not set time correctly on boot:
 NTP workaround per https://github.com/raspberrypi/linux/issues/1519
 
@@ -21,6 +28,31 @@ Version:
 0.1.0: Initial version
 0.2.0: - control for analog gain and awb_gains that previously were floating
        - formatting picture number in file name to for digits, i.e. 0001, 0002, ...
+0.3.0: - decoding of raw Bayer data without copies of the capture buffer
+       - choice of demosaic algorithms: superpixel, bilinear, edge aware and the original reference
+       - camera stays open during a capture run, only changed settings are applied
+       - FITS files are written in the background while the next picture is taken
+       - FITS keywords DATE-OBS and EXPTIME
+       - file formats Rice compressed FITS and packed 10 bit raw10
+       - GUI preview computed from raw data at reduced resolution, without full demosaic
+       - faster GUI updates with persistent matplotlib artists and blitting
+       - auto shutter with metering modes, converges in one or two shots
+       - headless capture runs from the command line, GUI in separate module piRawGui
+       - reused frame buffers instead of new arrays for each picture and gc.collect()
+       - pictures start at fixed intervals on the monotonic clock, no drift. Option --overrun
+       - optional stacking of groups of pictures (sum, mean, sigma clipped mean) while capturing
+       - dark library with hot pixel maps, hot pixels are corrected while capturing
+       - timing of the pipeline stages, percentiles in log and GUI, option --timingCsv
+       - simulated camera for tests and benchmarks without RaspberryPi, option --simulate. picamera is optional
+       - burst mode for short exposures, the sensor keeps streaming between pictures
+       - pictures are processed by a pool of worker threads while the next one is captured, option --workers
+       - file format fits_mmap: frames are unpacked directly into the memory mapped FITS file
+       - raw data geometry read from the BRCM header, 12 bit packing, HQ camera (imx477)
+       - Bayer preserving 2x2 and 4x4 binning and cropping right after unpacking, options --binning and --crop
+       - event detection: only frames in which something happens are written, with index. Option --detect
+       - focus assistant: half flux radius and gradient energy of a small region, for each exposure. Option --focus
+       - option --profile replaces --trace: cProfile statistics per stage and tracemalloc snapshots, written to files
+       - sensor capabilities validated once and cached in a file, settings use them from memory. Option --capabilityCache
 
 """
 
@@ -46,133 +78,1523 @@ NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES
 WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
-__version__   = '0.2.0'
+__version__   = '0.3.0'
 __email__     = 'georg.viehoever@web.de'
 __maintainer__= 'Georg Viehoever'
 __status__    = 'Prototype'
 __date__      = '20160828'
 
 import argparse
-import trace
+import cProfile
 import datetime
 import time
 import functools
+import hashlib
 import math
 import threading
 import fractions
 import os
 import pathlib
-import gc
-
-#GUI
-import tkinter as Tk
-import tkinter.ttk as Ttk
-import tkinter.messagebox as TkMb
-import tkinter.filedialog as TkFd
-
-import matplotlib as mpl
-mpl.use("TkAgg") #FIXME Try other backend?
-import matplotlib.pyplot as plt
+import queue
+import json
+import struct
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import io
+import pstats
+import tracemalloc
+import traceback
+
+import sys
+
+# GUI modules (tkinter, matplotlib) are imported by piRawGui, which is only loaded when the GUI is used
 import numpy as np
 
-#Camera
-import picamera
-import picamera.array
+#Camera. Without picamera, only the simulated camera can be used, see SimulatedPiCamera
+try:
+    import picamera
+    import picamera.array
+    from picamera.exc import PiCameraError, PiCameraValueError
+    _ArrayOutput=picamera.array.PiArrayOutput
+except ImportError:
+    picamera=None
+
+    class PiCameraError(Exception):
+        """ replaces picamera.exc.PiCameraError if picamera is not installed"""
+
+    class PiCameraValueError(PiCameraError,ValueError):
+        """ replaces picamera.exc.PiCameraValueError if picamera is not installed"""
+
+    class _ArrayOutput(io.BytesIO):
+        """ replaces picamera.array.PiArrayOutput if picamera is not installed, enough for PiBayerFlatArray"""
+        def __init__(self,camera,size=None):
+            super().__init__()
+            self.camera=camera
+            self.size=size
+            self.array=None
+
+        def close(self):
+            self.array=None
+            super().close()
 
 # FITS file
 import pyfits
 
 #
-# GUI
+# Timing
 #
-def busyCursor(f):
-    """ decorator that causes execution of f with a busy cursor
+class StageTimer:
+    """ records the durations of the stages of the capture pipeline
+
+    Use as "with timer.stage("write"):". The last window durations of each stage are kept for
+    percentiles, all of them can also be written to a CSV file. Stages may nest, e.g. exposure
+    contains bayer and unpack, because picamera decodes the raw data before capture() returns.
+    Thread safe, the FrameWriter records from its own thread.
+    """
+
+    STAGES=("open","exposure","bayer","unpack","demosaic","hotpixels","preview","meter","stack","detect","focus",
+            "write","redraw")
+    """ stages recorded by piRaw, in pipeline order. Other names may be used as well"""
+
+    def __init__(self,window=100):
+        """ initialize timer
+        :param window: number of durations per stage used for percentiles
+        """
+        self.window=window
+        """ number of durations per stage kept for percentiles"""
+        self._durations=collections.OrderedDict((stage,collections.deque(maxlen=window)) for stage in self.STAGES)
+        """ stage -> last durations in seconds"""
+        self._lock=threading.Lock()
+        self._csvFile=None
+        """ open CSV file, None if no CSV is written"""
+        self._csvWriter=None
+        self.profiler=None
+        """ StageProfiler while profiling, see startProfile()"""
+
+    @contextlib.contextmanager
+    def stage(self,name):
+        """ context manager measuring the duration of stage name. Also recorded if an exception occurs.
+        While profiling, the stage is also profiled
+        """
+        profiler=self.profiler
+        start=time.perf_counter()
+        try:
+            if profiler is None:
+                yield
+            else:
+                with profiler.profile(name):
+                    yield
+        finally:
+            self.record(name,time.perf_counter()-start)
+            if profiler is not None:
+                profiler.stageDone(name)
+
+    def record(self,name,secs):
+        """ record duration secs of stage name
+        """
+        with self._lock:
+            if name not in self._durations:
+                self._durations[name]=collections.deque(maxlen=self.window)
+            self._durations[name].append(secs)
+            if self._csvWriter is not None:
+                self._csvWriter.writerow((datetime.datetime.now().isoformat(),threading.current_thread().name,
+                                          name,"{:.3f}".format(1000*secs)))
+
+    def percentiles(self,name,percents=(50,90,99)):
+        """ returns list of percentiles of the recorded durations of stage name in seconds, None if there are none
+        """
+        with self._lock:
+            durations=list(self._durations.get(name,()))
+        if not durations:
+            return None
+        return list(np.percentile(durations,percents))
+
+    def summary(self,percents=(50,90,99)):
+        """ returns multiline string with count and percentiles in ms of each stage that has durations
+        """
+        lines=["{:10s} {:>5s} ".format("stage","n")+" ".join("{:>8s}".format("p{:d} ms".format(p)) for p in percents)]
+        for name in list(self._durations):
+            values=self.percentiles(name,percents)
+            if values is not None:
+                lines.append("{:10s} {:5d} ".format(name,len(self._durations[name]))+
+                             " ".join("{:8.1f}".format(1000*value) for value in values))
+        return "\n".join(lines)
+
+    def medians(self):
+        """ returns one line string with the median in ms of each stage that has durations, e.g. for the GUI
+        """
+        items=[]
+        for name in list(self._durations):
+            values=self.percentiles(name,(50,))
+            if values is not None:
+                items.append("{!s} {:.0f}".format(name,1000*values[0]))
+        return ", ".join(items)+" ms" if items else ""
+
+    def openCsv(self,filename):
+        """ write all durations recorded from now on to CSV file filename with columns time,thread,stage,ms
+        """
+        self.closeCsv()
+        with self._lock:
+            self._csvFile=open(filename,"w",newline="")
+            self._csvWriter=csv.writer(self._csvFile)
+            self._csvWriter.writerow(("time","thread","stage","ms"))
+
+    def closeCsv(self):
+        """ close CSV file, if one is open
+        """
+        with self._lock:
+            if self._csvFile is not None:
+                self._csvFile.close()
+            self._csvFile=None
+            self._csvWriter=None
+
+    def startProfile(self,directory,snapshotInterval=10):
+        """ profile all stages from now on, and take memory snapshots, see StageProfiler
+        """
+        self.stopProfile()
+        self.profiler=StageProfiler(directory,snapshotInterval)
+
+    def stopProfile(self):
+        """ stop profiling and write the statistics, if profiling
+        """
+        profiler,self.profiler=self.profiler,None
+        if profiler is not None:
+            print("Profile:",profiler.close())
+
+class StageProfiler:
+    """ profiles the stages of the pipeline with cProfile and takes tracemalloc snapshots, for offline analysis
+
+    Much cheaper than tracing each line. Each stage has its own cProfile.Profile per thread, enabled while
+    the stage runs. A profile only sees the thread that enabled it, and stages nest, so only the outermost stage
+    of a thread is profiled, nested stages such as unpack within exposure are part of it. Since python 3.12 only
+    one profile may be active at a time, stages that start while another thread is profiled are skipped then.
+    Every snapshotInterval frames, counted as completed snapshotStage, a tracemalloc snapshot is taken and
+    the largest growth of memory since the start is printed. Files written to directory:
+    - profile_<stage>.pstats: read with pstats.Stats(filename).sort_stats("cumulative").print_stats(20)
+    - memory_<frame>.snapshot: read with tracemalloc.Snapshot.load(filename), compare with Snapshot.compare_to()
     """
-    @functools.wraps(f)
-    def wrapper(self,*args,**kwargs):
-        cursor=self.cget("cursor")
+
+    def __init__(self,directory,snapshotInterval=10,snapshotStage="exposure",traceFrames=10):
+        """ start profiling. Takes the first memory snapshot
+        :param directory: directory for the files, created if necessary
+        :param snapshotInterval: take a memory snapshot every this many frames, 0 for none
+        :param snapshotStage: stage counted as frame
+        :param traceFrames: depth of the tracebacks stored by tracemalloc for each memory block
+        """
+        self.directory=pathlib.Path(directory)
+        """ directory of the files"""
+        self.snapshotInterval=snapshotInterval
+        """ frames between memory snapshots"""
+        self.snapshotStage=snapshotStage
+        """ stage counted as frame"""
+        self.numFrames=0
+        """ number of frames so far"""
+        self._profiles=collections.OrderedDict()
+        """ (stage,thread name) -> cProfile.Profile"""
+        self._skipped=collections.Counter()
+        """ stage -> number of times not profiled because another profile was active"""
+        self._local=threading.local()
+        """ attribute active is True while a stage of this thread is profiled"""
+        self._lock=threading.Lock()
+        self._firstSnapshot=None
+        """ memory snapshot at the start"""
+        self.directory.mkdir(parents=True,exist_ok=True)
+        if self.snapshotInterval>0:
+            tracemalloc.start(traceFrames)
+            self._firstSnapshot=self._snapshot()
+
+    @contextlib.contextmanager
+    def profile(self,name):
+        """ context manager profiling stage name, unless a stage of this thread is already profiled
+        """
+        profile=None
+        if not getattr(self._local,"active",False):
+            with self._lock:
+                profile=self._profiles.setdefault((name,threading.current_thread().name),cProfile.Profile())
+            try:
+                profile.enable()
+                self._local.active=True
+            except ValueError:
+                # another profile is active in another thread, python >= 3.12
+                profile=None
+                with self._lock:
+                    self._skipped[name]+=1
         try:
-            #print("wait cursor")
-            self.configure(cursor="watch")
-            self.update() #necessary so cursor actually changes
-            return f(self,*args,**kwargs)
+            yield
         finally:
-            #print("restore cursor")
-            self.configure(cursor=cursor)
-            self.update()
+            if profile is not None:
+                profile.disable()
+                self._local.active=False
+
+    def stageDone(self,name):
+        """ called by StageTimer after stage name. Takes a memory snapshot every snapshotInterval frames
+        """
+        if name!=self.snapshotStage or self.snapshotInterval<=0:
+            return
+        with self._lock:
+            self.numFrames+=1
+            bSnapshot=self.numFrames%self.snapshotInterval==0
+        if bSnapshot:
+            snapshot=self._snapshot()
+            print("Memory growth after {:d} frames:".format(self.numFrames))
+            for difference in snapshot.compare_to(self._firstSnapshot,"lineno")[:5]:
+                print("  ",difference)
+
+    def _snapshot(self):
+        """ returns memory snapshot without the allocations of tracemalloc, also written to a file
+        """
+        snapshot=tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False,tracemalloc.__file__),))
+        snapshot.dump(str(self.directory/"memory_{:04d}.snapshot".format(self.numFrames)))
+        return snapshot
+
+    def close(self):
+        """ stop profiling and write the statistics of each stage, all threads merged. Returns statistics string
+        """
+        with self._lock:
+            profiles=list(self._profiles.items())
+        stats=collections.OrderedDict()
+        for (name,threadName),profile in profiles:
+            if name in stats:
+                stats[name].add(profile)
+            else:
+                stats[name]=pstats.Stats(profile)
+        for name,stat in stats.items():
+            stat.dump_stats(str(self.directory/"profile_{!s}.pstats".format(name)))
+        if self.snapshotInterval>0:
+            tracemalloc.stop()
+        result="{:d} stages, {:d} frames written to {!s}".format(len(stats),self.numFrames,self.directory)
+        if self._skipped:
+            result+=", skipped "+", ".join("{!s} {:d}".format(name,count) for name,count in self._skipped.items())
+        return result
+
+timer=StageTimer()
+""" timer for the stages of the pipeline, used by all parts of piRaw"""
+
+#
+# Capture
+#
+class FramePool:
+    """ fixed number of preallocated frame buffers
+
+    A full frame is tens of MB. Allocating new arrays for every picture fragments memory on the Pi,
+    so the buffers are reused. acquire() blocks while all buffers are in use, which also bounds
+    the number of frames in flight between capture and writer.
+    """
+    def __init__(self,numBuffers):
+        """ initialize pool. Buffers are allocated on first use
+        :param numBuffers: maximum number of buffers handed out at the same time
+        """
+        self.numBuffers=numBuffers
+        """ maximum number of buffers in use"""
+        self._free=[]
+        """ buffers available for acquire()"""
+        self._key=None
+        """ (shape,dtype) of the buffers in the pool"""
+        self._inUse=0
+        """ number of buffers currently handed out"""
+        self._condition=threading.Condition()
+
+    def acquire(self,shape,dtype=np.uint16):
+        """ returns buffer with shape and dtype, contents undefined. Blocks while all buffers are in use.
+        Must be returned with release()
+
+        If shape or dtype differ from the previous call, the pool is emptied and new buffers are allocated.
+        Can be passed as allocate function to RawCamera.capture()
+        """
+        key=(tuple(shape),np.dtype(dtype))
+        with self._condition:
+            if key!=self._key:
+                self._key=key
+                self._free=[]
+            while not self._free and self._inUse>=self.numBuffers:
+                self._condition.wait()
+            buffer=self._free.pop() if self._free else np.empty(shape,dtype=dtype)
+            self._inUse+=1
+            return buffer
+
+    def release(self,buffer):
+        """ return buffer obtained with acquire(). It must not be used afterwards
+        """
+        with self._condition:
+            self._inUse-=1
+            if (buffer.shape,buffer.dtype)==self._key:
+                self._free.append(buffer)
+            self._condition.notify()
+
+class FrameWriter(threading.Thread):
+    """ writes frames to disk in the background
+
+    Writing a frame to the SD card takes seconds. With the writer, the next exposure can start while
+    the previous frames are still being written. The queue is bounded: write() blocks while it is
+    full, so a slow card throttles the capture instead of filling memory.
+    """
+
+    FILE_FORMATS={"fits":".fits",
+                  "fits_mmap":".fits",
+                  "fits_rice":".fits",
+                  "raw10":".raw10"}
+    """ supported file formats and their file name extension:
+    - fits: uncompressed 16 bit FITS, about 16 MB per V2 frame
+    - fits_mmap: same file as fits, but the frame is unpacked directly into the mapped file, see mapFits().
+      Saves a copy of the frame and the conversion by pyfits
+    - fits_rice: lossless Rice tile compressed FITS, readable by PixInsight and astropy
+    - raw10: 10 bit values packed 4 into 5 bytes, see writeRaw10() and readRaw10(). Exactly 10/16 of fits
+    """
+
+    def __init__(self,maxQueued=2):
+        """ initialize and start writer thread
+        :param maxQueued: maximum number of frames waiting to be written
+        """
+        self._queue=queue.Queue(maxQueued)
+        """ frames waiting to be written, None terminates the thread"""
+        self.error=None
+        """ first exception that occurred while writing, None if all went well"""
+        self.framesWritten=0
+        """ number of files written"""
+        self.bytesWritten=0
+        """ total size of files written"""
+        super().__init__(name="FrameWriter")
+        self.start()
+
+    def write(self,filename,data,header=None,fileFormat="fits",release=None):
+        """ queue data for writing to filename. Blocks while the queue is full
+
+        data must not be modified after this call.
+        :param filename: file to write. Existing file is overwritten
+        :param data: numpy array, for fits_mmap the array returned by mapFits() for filename
+        :param header: dict with additional keywords, optional
+        :param fileFormat: one of FILE_FORMATS
+        :param release: if not None, called with data when it is no longer needed, e.g. FramePool.release
+        """
+        if self.error is not None:
+            raise self.error
+        if fileFormat not in self.FILE_FORMATS:
+            raise ValueError("Unknown file format {!s}, choose one of {!s}".format(fileFormat,sorted(self.FILE_FORMATS)))
+        self._queue.put((filename,data,header,fileFormat,release))
+
+    def close(self):
+        """ write all queued frames and terminate the thread. Raises the first error that occurred while writing
+        """
+        if self.is_alive():
+            self._queue.put(None)
+            self.join()
+        if self.error is not None:
+            raise self.error
+
+    @property
+    def numQueued(self):
+        """ number of frames not yet written
+        """
+        return self._queue.qsize()
+
+    @staticmethod
+    def _writeFits(filename,data,header,bCompress):
+        """ write data with header keywords to FITS file
+        @param bCompress: if True, write Rice tile compressed image extension
+        """
+        if bCompress:
+            hdu=pyfits.CompImageHDU(data,compression_type="RICE_1")
+            hduList=pyfits.HDUList([pyfits.PrimaryHDU(),hdu])
+        else:
+            hdu=pyfits.PrimaryHDU(data)
+            hduList=pyfits.HDUList([hdu])
+        if header is not None:
+            for key,value in header.items():
+                hdu.header[key]=value
+        hduList.writeto(filename,clobber=True)
+
+    @classmethod
+    def _writeFile(cls,filename,data,header,fileFormat):
+        """ write file in fileFormat, returns number of bytes written
+        """
+        if fileFormat=="raw10":
+            writeRaw10(filename,data,header)
+        elif fileFormat=="fits_mmap":
+            finishMappedFits(filename,data,header)
+        else:
+            cls._writeFits(filename,data,header,fileFormat=="fits_rice")
+        return os.path.getsize(filename)
+
+    def run(self):
+        """ write frames until None is received
+        """
+        while True:
+            item=self._queue.get()
+            if item is None:
+                return
+            filename,data,header,fileFormat,release=item
+            try:
+                with timer.stage("write"):
+                    size=self._writeFile(filename,data,header,fileFormat)
+                self.framesWritten+=1
+                self.bytesWritten+=size
+                print("Written",filename,size,"bytes")
+            except Exception as e:
+                print("Error writing",filename,e)
+                if self.error is None:
+                    self.error=e
+            finally:
+                if release is not None:
+                    release(data)
+
+class ExposureMeter:
+    """ measures the exposure of raw mosaics and computes the shutter speed for the next picture
+
+    Statistics are computed on a strided sample of 2x2 Bayer cells (about sampleCells of them),
+    which takes milliseconds instead of a pass over the full frame. The shutter speed is controlled
+    in log space: the complete correction is applied at once, so a usable exposure is reached after
+    one or two pictures. Saturated pictures dont tell how much light there is, they are corrected
+    by at least saturatedStep.
+    """
+
+    METER_MODES={"mean":"mean of all pixels",
+                 "center":"center weighted mean",
+                 "percentile":"percentile of the pixels, see ExposureMeter.percentile. Ignores stars and hot pixels",
+                 "highlight":"mean, but limited such that the brightest pixels are not saturated"}
+    """ available modes and their description"""
+
+    def __init__(self,mode="mean",targetLevel=500,tolerance=1.05):
+        """ initialize meter
+        :param mode: one of METER_MODES
+        :param targetLevel: targeted raw value of the metered statistic, including black level
+        :param tolerance: factor. Shutter speed is not changed if the metered value is within this factor of target
+        """
+        if mode not in self.METER_MODES:
+            raise ValueError("Unknown meter mode {!s}, choose one of {!s}".format(mode,sorted(self.METER_MODES)))
+        self.mode=mode
+        """ metering mode, see METER_MODES"""
+        self.targetLevel=targetLevel
+        """ targeted raw value"""
+        self.tolerance=tolerance
+        """ no change of shutter speed if within this factor of targetLevel"""
+        self.roi=None
+        """ if not None, (x,y,width,height) of the metered region in the mosaic"""
+        self.sampleCells=40000
+        """ approximate number of 2x2 Bayer cells used for statistics"""
+        self.percentile=50
+        """ percentile metered in mode percentile"""
+        self.highlightPercentile=99.5
+        """ percentile that must not be saturated in mode highlight"""
+        self.highlightLevel=900
+        """ maximum raw value of highlightPercentile in mode highlight"""
+        self.saturatedLevel=1000
+        """ cells with a mean above this value are considered saturated"""
+        self.clipLevel=1023
+        """ raw value of clipped pixels. A clipped highlightPercentile only tells that there is too much light"""
+        self.saturatedStep=4.0
+        """ minimum factor by which shutter speed is reduced if more than maxSaturated of the cells are
+        saturated, or if highlightPercentile is clipped in mode highlight"""
+        self.maxSaturated=0.25
+        """ fraction of saturated cells that triggers saturatedStep. The metered value is unreliable then"""
+        self.maxStep=100.0
+        """ maximum factor by which shutter speed is changed for one picture"""
+        self._weights=None
+        """ cached weights for mode center"""
+
+    def _sample(self,mosaic):
+        """ returns (level,maxima) of a strided sample of 2x2 cells: the mean and maximum of the 4 pixels of each cell
+        """
+        if self.roi is not None:
+            x,y,width,height=self.roi
+            mosaic=mosaic[y&~1:y+height,x&~1:x+width]
+        cells=(mosaic.shape[0]//2)*(mosaic.shape[1]//2)
+        step=2*max(1,int(math.sqrt(cells/self.sampleCells)))
+        rows,cols=mosaic.shape[0]//step,mosaic.shape[1]//step
+        pixels=[mosaic[row::step,col::step][:rows,:cols] for row in range(2) for col in range(2)]
+        level=pixels[0].astype(np.float32)
+        maxima=pixels[0].copy()
+        for p in pixels[1:]:
+            level+=p
+            np.maximum(maxima,p,out=maxima)
+        level*=0.25
+        return (level,maxima)
+
+    def _centerWeights(self,shape):
+        """ returns gaussian weights falling to 1/e at 1/3 of the diagonal from the center
+        """
+        if self._weights is None or self._weights.shape!=shape:
+            y,x=np.ogrid[0:shape[0],0:shape[1]]
+            r2=((y-(shape[0]-1)/2)**2+(x-(shape[1]-1)/2)**2)/((shape[0]**2+shape[1]**2)/9)
+            self._weights=np.exp(-r2).astype(np.float32)
+        return self._weights
+
+    def measure(self,mosaic,bits=10):
+        """ returns (value,highlight,saturated): metered value according to mode, highlightPercentile of
+        the cell maxima (mode highlight, else None), fraction of saturated cells
+        :param bits: bits per pixel of mosaic. Values are returned as 10 bit values, like the levels of the meter
+        """
+        level,maxima=self._sample(mosaic)
+        if bits!=10:
+            level*=2.0**(10-bits)
+        saturated=np.count_nonzero(level>self.saturatedLevel)/level.size
+        highlight=None
+        if self.mode=="center":
+            weights=self._centerWeights(level.shape)
+            value=float(np.sum(level*weights)/np.sum(weights))
+        elif self.mode=="percentile":
+            value=float(np.percentile(level,self.percentile))
+        else:
+            value=float(np.mean(level))
+            if self.mode=="highlight":
+                highlight=float(np.percentile(maxima,self.highlightPercentile))*2.0**(10-bits)
+        return (value,highlight,saturated)
+
+    def nextShutter(self,shutterSpeed,mosaic,minShutter,maxShutter,blackLevel=0,bits=10):
+        """ returns shutter speed for the next picture
+        :param shutterSpeed: shutter speed used for mosaic in microseconds
+        :param mosaic: raw RGGB mosaic
+        :param minShutter, maxShutter: limits of the sensor in microseconds
+        :param blackLevel: raw value of black pixels. Exposure is proportional to the signal above it
+        :param bits: bits per pixel of mosaic, see measure()
+        """
+        value,highlight,saturated=self.measure(mosaic,bits)
+        blackLevel*=2.0**(10-bits)
+        signal=max(1.0,value-blackLevel)
+        target=max(1.0,self.targetLevel-blackLevel)
+        logStep=math.log(target/signal)
+        bClipped=saturated>self.maxSaturated
+        if highlight is not None:
+            # highlight protection: the highlights must stay below highlightLevel. Unless they are
+            # clipped, they are proportional to the exposure like the mean
+            logStep=min(logStep,math.log(max(1.0,self.highlightLevel-blackLevel)/max(1.0,highlight-blackLevel)))
+            bClipped=bClipped or highlight>=self.clipLevel
+        if bClipped:
+            logStep=min(logStep,-math.log(self.saturatedStep))
+        if abs(logStep)<math.log(self.tolerance):
+            return shutterSpeed
+        maxLogStep=math.log(self.maxStep)
+        logStep=min(maxLogStep,max(-maxLogStep,logStep))
+        return int(min(maxShutter,max(minShutter,shutterSpeed*math.exp(logStep))))
+
+class StackAccumulator:
+    """ stacks groups of numFrames consecutive raw mosaics into one frame
+
+    Only the stack is written, which saves numFrames-1 files on the SD card and the stacking step in
+    PixInsight. Frames are accumulated while they are captured, the raw frame buffers are released
+    immediately. Only mode sigma has to keep all frames of a group, numFrames*16 MB for a V2 camera.
+    """
+
+    STACK_MODES={"sum":"sum of the frames, uint32",
+                 "mean":"mean of the frames, float32",
+                 "sigma":"mean of the frames without outliers beyond kappa sigma (satellites, planes), float32"}
+    """ available modes and their description"""
+
+    def __init__(self,mode,numFrames,numBuffers=3,kappa=3.0):
+        """ initialize accumulator
+        :param mode: one of STACK_MODES
+        :param numFrames: number of frames per stack
+        :param numBuffers: number of stacks that may be in use at the same time, e.g. waiting to be written
+        :param kappa: frames further than kappa standard deviations from the mean are ignored in mode sigma
+        """
+        if mode not in self.STACK_MODES:
+            raise ValueError("Unknown stack mode {!s}, choose one of {!s}".format(mode,sorted(self.STACK_MODES)))
+        self.mode=mode
+        """ stack mode, see STACK_MODES"""
+        self.numFrames=max(1,numFrames)
+        """ number of frames per stack"""
+        self.kappa=kappa
+        """ clipping threshold of mode sigma in standard deviations"""
+        self.chunkRows=64
+        """ mode sigma processes this many rows at once, bounds temporary memory"""
+        self.count=0
+        """ number of frames in current stack"""
+        self._pool=FramePool(numBuffers)
+        """ buffers for stacks"""
+        self._stack=None
+        """ stack being accumulated, sum (modes sum, mean) or frames (mode sigma)"""
+        self._filename=None
+        """ file name of the current stack: name of its first frame"""
+        self._header=None
+        """ header of the first frame of the current stack"""
+        self._exposure=0.0
+        """ sum of EXPTIME of the frames in the current stack"""
+
+    def add(self,mosaic,filename,header):
+        """ add mosaic to the current stack. mosaic may be reused by the caller afterwards
+        :param mosaic: raw mosaic. All mosaics must have the same shape
+        :param filename, header: as for FrameWriter.write(). The stack gets those of its first frame
+        returns (filename,stack,header) if the stack is complete, otherwise None. stack must be returned with release()
+        """
+        if self.count==0:
+            self._filename=filename
+            self._header=dict(header)
+            self._exposure=0.0
+            if self.mode=="sigma":
+                if self._stack is None or self._stack.shape[1:]!=mosaic.shape:
+                    self._stack=np.empty((self.numFrames,)+mosaic.shape,dtype=mosaic.dtype)
+            else:
+                self._stack=self._pool.acquire(mosaic.shape,np.uint32 if self.mode=="sum" else np.float32)
+                self._stack[...]=0
+        if self.mode=="sigma":
+            self._stack[self.count]=mosaic
+        else:
+            np.add(self._stack,mosaic,out=self._stack)
+        self.count+=1
+        self._exposure+=header.get("EXPTIME",0.0)
+        if self.count>=self.numFrames:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """ finish the current stack even if it has less than numFrames frames
+        returns (filename,stack,header), None if there are no frames
+        """
+        if self.count==0:
+            return None
+        n=self.count
+        if self.mode=="sigma":
+            stack=self._sigmaClippedMean(self._stack[:n])
+        else:
+            stack=self._stack
+            self._stack=None
+            if self.mode=="mean":
+                stack*=1.0/n
+        header=self._header
+        header["NCOMBINE"]=n
+        header["STACKMOD"]=self.mode
+        header["EXPTIME"]=self._exposure if self.mode=="sum" else self._exposure/n
+        self.count=0
+        return (self._filename,stack,header)
+
+    def release(self,stack):
+        """ return stack obtained from add() or flush(). Can be passed as release function to FrameWriter.write()
+        """
+        self._pool.release(stack)
+
+    def _sigmaClippedMean(self,frames):
+        """ returns float32 mean over axis 0 of frames, ignoring values beyond kappa sigma. Processed in
+        chunks of rows, so the temporaries stay small
+
+        Each value is compared to mean and standard deviation of the other frames. With few frames, an
+        outlier inflates the standard deviation of all frames so much that it would never be clipped.
+        """
+        out=self._pool.acquire(frames.shape[1:],np.float32)
+        n=frames.shape[0]
+        if n<3:
+            np.mean(frames,axis=0,out=out)
+            return out
+        for row in range(0,frames.shape[1],self.chunkRows):
+            block=frames[:,row:row+self.chunkRows].astype(np.float64)
+            total=block.sum(axis=0)
+            squares=np.square(block).sum(axis=0)
+            others=(total-block)/(n-1)
+            # variance of value minus mean of the others: sample variance of the others times n/(n-1)
+            variance=((squares-np.square(block))/(n-1)-np.square(others))*(n/(n-2))
+            # at least one raw unit, the values are integers
+            limit=self.kappa*np.sqrt(np.maximum(variance,1.0))
+            keep=np.abs(block-others)<=limit
+            count=keep.sum(axis=0)
+            kept=(block*keep).sum(axis=0)
+            np.divide(np.where(count>0,kept,total),np.where(count>0,count,n),out=out[row:row+self.chunkRows],
+                      casting="unsafe")
+        return out
+
+class EventDetector:
+    """ keeps only the frames in which something happens, e.g. meteors, satellites or lightning
+
+    Each frame is compared to the previous one on its green plane, binned into blocks of blockSize x blockSize
+    green pixels. If at least minBlocks blocks got brighter by more than threshold, the frame triggers an event.
+    Triggering frames are written together with the framesBefore frames before the first trigger and the
+    framesAfter frames after the last one. All other frames are dropped. The frames before are kept in a small
+    ring buffer. Each written frame gets a line in the index file. Costs a few milliseconds per frame, the
+    binned planes are 1/256 of the frame with the default blockSize.
+    """
+
+    INDEX_COLUMNS=("event","role","file","date_obs","score","blocks","x","y")
+    """ columns of the index file. role is before, trigger or after. score is the largest brightening in raw values,
+    blocks the number of blocks above threshold, x and y the position of the largest brightening in the mosaic"""
+
+    def __init__(self,indexFile,release,threshold=20.0,framesBefore=2,framesAfter=2,minBlocks=2,blockSize=8):
+        """ initialize detector
+        :param indexFile: path of the CSV index of the written frames, created at the first event
+        :param release: function(mosaic), called for frames that are dropped, e.g. FramePool.release
+        :param threshold: brightening of a block in raw values that counts as event
+        :param framesBefore: number of frames written before the first trigger of an event
+        :param framesAfter: number of frames written after the last trigger of an event
+        :param minBlocks: number of blocks above threshold needed for a trigger. 1 also triggers on cosmic rays
+        :param blockSize: green pixels per block in each direction
+        """
+        self.indexFile=indexFile
+        """ path of the index file"""
+        self.release=release
+        """ called with dropped frames"""
+        self.threshold=threshold
+        """ brightening of a block in raw values that triggers"""
+        self.framesBefore=max(0,framesBefore)
+        """ frames written before an event"""
+        self.framesAfter=max(0,framesAfter)
+        """ frames written after an event"""
+        self.minBlocks=max(1,minBlocks)
+        """ blocks above threshold needed for a trigger"""
+        self.blockSize=blockSize
+        """ size of the blocks in green pixels"""
+        self.numEvents=0
+        """ number of events so far"""
+        self.numFrames=0
+        """ number of frames added"""
+        self._ring=collections.deque()
+        """ (filename,mosaic,header) of the latest frames without event, at most framesBefore"""
+        self._previous=None
+        """ binned green plane of the previous frame"""
+        self._remaining=0
+        """ number of frames still to be written after the last trigger"""
+        self._index=None
+        """ open index file"""
+        self._indexWriter=None
+
+    def _binnedGreen(self,mosaic):
+        """ returns float32 mean of each block of the green pixels at [0::2,1::2] of the RGGB mosaic
+        """
+        size=self.blockSize
+        green=mosaic[0::2,1::2]
+        rows,cols=green.shape[0]//size,green.shape[1]//size
+        blockRows=green[:rows*size,:cols*size].reshape(rows,size,cols*size)
+        sums=blockRows[:,0].astype(np.float32)
+        for i in range(1,size):
+            sums+=blockRows[:,i]
+        blocks=sums.reshape(rows,cols,size)
+        binned=blocks[:,:,0].copy()
+        for i in range(1,size):
+            binned+=blocks[:,:,i]
+        binned*=1.0/(size*size)
+        return binned
+
+    def _trigger(self,mosaic):
+        """ returns (score,blocks,x,y) if mosaic triggers an event compared to the previous frame, otherwise None
+        """
+        binned=self._binnedGreen(mosaic)
+        previous,self._previous=self._previous,binned
+        if previous is None or previous.shape!=binned.shape:
+            return None
+        difference=binned-previous
+        blocks=int(np.count_nonzero(difference>self.threshold))
+        if blocks<self.minBlocks:
+            return None
+        row,col=np.unravel_index(int(np.argmax(difference)),difference.shape)
+        # center of the block in mosaic coordinates
+        return (float(difference[row,col]),blocks,int(2*self.blockSize*col+self.blockSize),int(2*self.blockSize*row+self.blockSize))
+
+    def add(self,mosaic,filename,header):
+        """ add the next frame. It is either returned for writing, kept in the ring buffer or released
+        :param mosaic: raw RGGB mosaic
+        :param filename, header: as for FrameWriter.write()
+        returns list of (filename,mosaic,header) to be written, in order. header has keyword EVENT
+        """
+        self.numFrames+=1
+        trigger=self._trigger(mosaic)
+        frames=[]
+        if trigger is not None:
+            if self._remaining==0:
+                self.numEvents+=1
+                print("Event",self.numEvents,"score {:.1f}, {:d} blocks at x {:d} y {:d}".format(*trigger))
+                while self._ring:
+                    frames.append(self._record(self._ring.popleft(),"before",None))
+            frames.append(self._record((filename,mosaic,header),"trigger",trigger))
+            self._remaining=self.framesAfter
+        elif self._remaining>0:
+            self._remaining-=1
+            frames.append(self._record((filename,mosaic,header),"after",None))
+        else:
+            self._ring.append((filename,mosaic,header))
+            while len(self._ring)>self.framesBefore:
+                self.release(self._ring.popleft()[1])
+        return frames
+
+    def _record(self,frame,role,trigger):
+        """ add frame (filename,mosaic,header) of the current event to the index, returns frame
+        """
+        filename,mosaic,header=frame
+        header["EVENT"]=self.numEvents
+        if self._index is None:
+            self._index=open(str(self.indexFile),"a",newline="")
+            self._indexWriter=csv.writer(self._index)
+            if self._index.tell()==0:
+                self._indexWriter.writerow(self.INDEX_COLUMNS)
+        score,blocks,x,y=trigger if trigger is not None else ("","","","")
+        self._indexWriter.writerow((self.numEvents,role,os.path.basename(filename),header.get("DATE-OBS",""),
+                                    score if score=="" else "{:.1f}".format(score),blocks,x,y))
+        self._index.flush()
+        return frame
+
+    def flush(self):
+        """ release the frames in the ring buffer and close the index file. Returns statistics string
+        """
+        while self._ring:
+            self.release(self._ring.popleft()[1])
+        self._previous=None
+        self._remaining=0
+        if self._index is not None:
+            self._index.close()
+            self._index=None
+        return "{:d} events in {:d} frames".format(self.numEvents,self.numFrames)
+
+class FocusMeter:
+    """ focus metrics of a small region of interest, computed from the green pixels of the raw mosaic
+
+    Two metrics are computed on the background subtracted green plane, both independent of the brightness:
+    - hfr: half flux radius of the brightest star in mosaic pixels, the mean distance of its flux from its
+      centroid. Smaller is better. Needs a star that is not saturated
+    - gradient: gradient energy (Tenengrad), the sum of the squared differences of neighbouring pixels divided
+      by the sum of the squared pixels. Larger is better. Also works without distinct stars, e.g. on the moon
+    Pixels below kappa times the noise of the background count as black, and this threshold is subtracted from
+    the others. Nothing is measured unless the brightest 3x3 box stands out of the noise, otherwise the metrics
+    of a pure noise frame would jump around at random. For a region of 256x256 pixels this costs about a
+    millisecond, so it can be done for each exposure.
+    """
+
+    def __init__(self,kappa=3.0,starRadius=12,minSnr=5.0,minPixels=5):
+        """ initialize meter
+        :param kappa: threshold above the background in units of its noise
+        :param starRadius: radius in green pixels of the window around the brightest star used for the hfr
+        :param minSnr: the brightest 3x3 box must exceed the threshold by this many times the noise per pixel
+        :param minPixels: number of green pixels above the threshold needed for a measurement
+        """
+        self.kappa=kappa
+        """ threshold above background in units of the noise"""
+        self.starRadius=starRadius
+        """ half size in green pixels of the window used for the hfr"""
+        self.minSnr=minSnr
+        """ signal to noise ratio per pixel of the brightest 3x3 box needed for a detection"""
+        self.minPixels=minPixels
+        """ green pixels above threshold needed for a detection"""
+
+    def measure(self,mosaic):
+        """ returns (hfr,gradient,peak,x,y) of mosaic, None if nothing stands out of the background
+        :param mosaic: raw RGGB mosaic of the region of interest, e.g. from RawCamera.capture(False,crop=...)
+        peak is the brightest raw value of the star, x and y its centroid in mosaic pixels
+        """
+        green=mosaic[0::2,1::2].astype(np.float32)
+        background=np.median(green)
+        signal=green-background
+        noise=max(1.0,1.4826*np.median(np.abs(signal)))
+        # soft threshold, a hard one would add edges to the gradient
+        signal-=self.kappa*noise
+        np.maximum(signal,0,out=signal)
+        if np.count_nonzero(signal)<self.minPixels:
+            return None
+        # brightest 3x3 sum, so that single hot pixels are not taken for the star
+        boxes=signal[:-2,:-2]+signal[:-2,1:-1]+signal[:-2,2:]
+        boxes=boxes+signal[1:-1,:-2]+signal[1:-1,1:-1]+signal[1:-1,2:]+signal[2:,:-2]+signal[2:,1:-1]+signal[2:,2:]
+        row,col=np.unravel_index(int(np.argmax(boxes)),boxes.shape)
+        if boxes[row,col]<=self.minSnr*noise*9:
+            return None
+        gradient=(float(np.square(signal[:,1:]-signal[:,:-1]).sum())+
+                  float(np.square(signal[1:,:]-signal[:-1,:]).sum()))/float(np.square(signal).sum())
+
+        radius=self.starRadius
+        top,left=max(0,row+1-radius),max(0,col+1-radius)
+        star=signal[top:row+2+radius,left:col+2+radius]
+        flux=star.sum()
+        rows,cols=np.indices(star.shape,dtype=np.float32)
+        centerRow,centerCol=(rows*star).sum()/flux,(cols*star).sum()/flux
+        distance=np.hypot(rows-centerRow,cols-centerCol)
+        # a green pixel covers 2x2 mosaic pixels
+        hfr=2*float((distance*star).sum()/flux)
+        peak=int(mosaic[0::2,1::2][top:row+2+radius,left:col+2+radius].max())
+        return (hfr,gradient,peak,int(round(2*(left+centerCol)+1)),int(round(2*(top+centerRow))))
+
+class DarkLibrary:
+    """ hot pixel maps derived from master darks, stored in a directory and used to correct pictures while capturing
+
+    Each entry belongs to a (shutter speed, iso) pair and is stored as dark_iso<iso>_<shutter>us.npz. It holds
+    the flat indices of the hot pixels, a few KB instead of a full frame. Pictures are corrected with the entry
+    of the same iso that has the nearest shutter speed, because the number of hot pixels grows with exposure time.
+    A hot pixel is replaced with the median of its 4 nearest neighbours of the same color, computed for all hot
+    pixels at once with fancy indexing. This takes milliseconds per frame.
+    """
+
+    def __init__(self,directory):
+        """ initialize library. Existing entries in directory are loaded when needed
+        :param directory: directory of the library, created when the first entry is added
+        """
+        self.directory=pathlib.Path(directory)
+        """ directory with .npz files"""
+        self.hotLevel=50
+        """ pixels of a master dark that exceed its median by more than this raw value are hot"""
+        self._entries={}
+        """ (shutterSpeed,iso) -> (shape,indices,neighbours) of the nearest entry, None if there is none"""
+        self._lock=threading.Lock()
+        """ protects _entries, correct() may be called from several threads"""
+
+    def _fileName(self,shutterSpeed,iso):
+        """ returns path of entry for shutterSpeed in microseconds and iso
+        """
+        return self.directory/"dark_iso{:d}_{:d}us.npz".format(iso,shutterSpeed)
+
+    def keys(self):
+        """ returns list of (shutterSpeed,iso) of the entries in the directory
+        """
+        keys=[]
+        for path in self.directory.glob("dark_iso*_*us.npz"):
+            iso,shutter=path.stem[len("dark_iso"):-len("us")].split("_")
+            keys.append((int(shutter),int(iso)))
+        return sorted(keys)
+
+    def add(self,masterDark,shutterSpeed,iso):
+        """ derive hot pixel map from masterDark and store it as entry for shutterSpeed and iso
+        :param masterDark: raw mosaic, e.g. mean of several dark pictures. Same orientation as the corrected pictures
+        returns number of hot pixels
+        """
+        flat=masterDark.reshape(-1)
+        level=np.median(flat[::97])
+        indices=np.flatnonzero(flat>level+self.hotLevel).astype(np.uint32)
+        if indices.size>0.01*flat.size:
+            print("Warning: {:.1f}% of the pixels of the dark are hot. Was the lens covered?".format(100*indices.size/flat.size))
+        self.directory.mkdir(parents=True,exist_ok=True)
+        np.savez_compressed(str(self._fileName(shutterSpeed,iso)),indices=indices,shape=np.array(masterDark.shape))
+        # nearest entries may have changed
+        with self._lock:
+            self._entries={}
+        return indices.size
+
+    def _entry(self,shutterSpeed,iso):
+        """ returns (shape,indices,neighbours) of the entry nearest to shutterSpeed with the same iso, None if none exists
+        """
+        key=(shutterSpeed,iso)
+        # held while loading, so that concurrent misses load an entry only once
+        with self._lock:
+            if key not in self._entries:
+                candidates=[candidate for candidate in self.keys() if candidate[1]==iso]
+                if not candidates:
+                    print("No dark for iso",iso,"in",self.directory,", hot pixels are not corrected")
+                    self._entries[key]=None
+                    return None
+                nearest=min(candidates,key=lambda candidate:abs(math.log(candidate[0]/max(1,shutterSpeed))))
+                if self._entries.get(nearest) is None:
+                    with np.load(str(self._fileName(*nearest))) as data:
+                        shape=tuple(int(size) for size in data["shape"])
+                        indices=data["indices"]
+                    self._entries[nearest]=(shape,indices,self._neighbours(shape,indices))
+                self._entries[key]=self._entries[nearest]
+            return self._entries[key]
+
+    @staticmethod
+    def _neighbours(shape,indices):
+        """ returns flat indices of shape (len(indices),4): the same color pixels 2 rows/columns away.
+        At the border, the pixel on the other side is used twice
+        """
+        rows,cols=np.divmod(indices.astype(np.int64),shape[1])
+        up=np.where(rows>=2,rows-2,rows+2)
+        down=np.where(rows<shape[0]-2,rows+2,rows-2)
+        left=np.where(cols>=2,cols-2,cols+2)
+        right=np.where(cols<shape[1]-2,cols+2,cols-2)
+        return np.stack([up*shape[1]+cols,down*shape[1]+cols,rows*shape[1]+left,rows*shape[1]+right],axis=1)
+
+    def correct(self,mosaic,shutterSpeed,iso):
+        """ replace hot pixels of mosaic in place. Returns number of corrected pixels
+        """
+        entry=self._entry(shutterSpeed,iso)
+        if entry is None:
+            return 0
+        shape,indices,neighbours=entry
+        if shape!=mosaic.shape:
+            raise ValueError("Dark has shape {!s}, but picture has shape {!s}".format(shape,mosaic.shape))
+        # a copy if mosaic is not contiguous, e.g. a view of part of a larger buffer
+        flat=np.ravel(mosaic)
+        # median of 4 values: mean of the middle two
+        values=np.sort(flat[neighbours],axis=1)
+        flat[indices]=(values[:,1].astype(np.uint32)+values[:,2]+1)//2
+        if not mosaic.flags.c_contiguous:
+            mosaic[...]=flat.reshape(mosaic.shape)
+        return indices.size
+
+class DeadlineScheduler:
+    """ paces pictures to absolute start times start+n*interval on the monotonic clock
+
+    Deadlines do not depend on how long a picture took, so the interval does not drift, and sleeping
+    is not affected by changes of the wall clock (e.g. by NTP after boot). Timelapse videos need
+    evenly spaced frames.
+    """
+
+    OVERRUN_POLICIES={"skip":"if a picture took longer than the interval, skip the deadlines that have been missed",
+                      "catchup":"take pictures for missed deadlines immediately, until the schedule is met again"}
+    """ available policies for pictures taking longer than the interval, and their description"""
+
+    def __init__(self,interval,policy="skip",stopEvent=None):
+        """ initialize scheduler. The first deadline is the time of the first call to waitNext()
+        :param interval: time between the starts of two pictures in seconds
+        :param policy: one of OVERRUN_POLICIES
+        :param stopEvent: threading.Event, optional. If set, waitNext() returns False immediately
+        """
+        if policy not in self.OVERRUN_POLICIES:
+            raise ValueError("Unknown overrun policy {!s}, choose one of {!s}".format(policy,sorted(self.OVERRUN_POLICIES)))
+        self.interval=max(0.0,interval)
+        """ time between deadlines in seconds"""
+        self.policy=policy
+        """ overrun policy, see OVERRUN_POLICIES"""
+        self.maxLateness=0.5*self.interval
+        """ with policy skip, a deadline missed by less than this is still used. Avoids skipping
+        a whole interval if a picture took just a bit longer than the interval"""
+        self.stopEvent=stopEvent if stopEvent is not None else threading.Event()
+        """ set to stop waiting"""
+        self.numSkipped=0
+        """ number of deadlines skipped because of overruns"""
+        self.startErrors=[]
+        """ for each picture: start time minus deadline in seconds"""
+        self._start=None
+        """ monotonic time of first deadline"""
+        self._slot=-1
+        """ number of current deadline, deadline is _start+_slot*interval"""
+
+    def waitNext(self):
+        """ wait for the next deadline. Returns True when it is reached, False if stopEvent was set
+        """
+        now=time.monotonic()
+        if self._start is None:
+            self._start=now
+        self._slot+=1
+        if self.policy=="skip":
+            # earliest deadline that is not late by more than maxLateness
+            slot=int(math.ceil((now-self.maxLateness-self._start)/self.interval)) if self.interval>0 else self._slot
+            if slot>self._slot:
+                self.numSkipped+=slot-self._slot
+                self._slot=slot
+        # without interval, pictures are taken as fast as possible
+        deadline=self._start+self._slot*self.interval if self.interval>0 else now
+        if self.stopEvent.wait(max(0.0,deadline-time.monotonic())):
+            return False
+        self.startErrors.append(time.monotonic()-deadline)
+        return True
 
-    return wrapper
+    def stop(self):
+        """ stop waitNext(), may be called from any thread
+        """
+        self.stopEvent.set()
+
+    def statistics(self):
+        """ returns string with statistics of the start errors
+        """
+        if not self.startErrors:
+            return "no pictures scheduled"
+        errors=np.array(self.startErrors)*1000
+        return "start error mean {:.1f} ms, std {:.1f} ms, max {:.1f} ms, {:d} deadlines skipped".format(
+            errors.mean(),errors.std(),errors.max(),self.numSkipped)
+
+DEFAULT_WORKERS=max(1,min(3,(os.cpu_count() or 1)-1))
+""" number of FrameProcessor threads used by CaptureThread. Leaves one core for capture, writer and GUI,
+3 on a RaspberryPi 2 or 3"""
+
+class FrameProcessor:
+    """ processes frames in a pool of worker threads and delivers the results in the order of submission
+
+    Unpacking, hot pixel correction, preview and metering are numpy operations on full frames that release
+    the GIL, so several frames are processed on different cores at the same time while the capture thread
+    already takes the next picture. Results are passed to deliver in the order in which the frames
+    were submitted, by a separate thread. submit() blocks while maxPending frames are not yet delivered,
+    so memory stays bounded.
+    """
+
+    def __init__(self,process,deliver,numWorkers=3,maxPending=None):
+        """ initialize and start the threads
+        :param process: function(*args) returning result, called in a worker thread for each submitted frame.
+               If it raises, it must release the buffers it got itself
+        :param deliver: function(result), called in order for the result of each frame
+        :param numWorkers: number of worker threads
+        :param maxPending: maximum number of frames submitted but not yet delivered, numWorkers+1 if None
+        """
+        self.process=process
+        """ function processing a frame"""
+        self.deliver=deliver
+        """ function receiving the results in order"""
+        self.error=None
+        """ first exception that occurred while processing or delivering, None if all went well"""
+        self._slots=threading.BoundedSemaphore(maxPending if maxPending is not None else numWorkers+1)
+        """ one for each frame that may be pending"""
+        self._pending=queue.Queue()
+        """ futures of the submitted frames in order, None terminates the delivery thread"""
+        self._executor=concurrent.futures.ThreadPoolExecutor(max(1,numWorkers))
+        self._deliverer=threading.Thread(target=self._deliverAll,name="FrameDeliverer")
+        self._deliverer.start()
+
+    def submit(self,*args):
+        """ queue frame for processing with process(*args). Blocks while maxPending frames are pending.
+        Raises the first error that occurred while processing
+        """
+        if self.error is not None:
+            raise self.error
+        self._slots.acquire()
+        try:
+            self._pending.put(self._executor.submit(self.process,*args))
+        except:
+            self._slots.release()
+            raise
+
+    def close(self):
+        """ process and deliver all pending frames and terminate the threads. Raises the first error that occurred
+        """
+        if self._deliverer.is_alive():
+            self._pending.put(None)
+            self._deliverer.join()
+        self._executor.shutdown()
+        if self.error is not None:
+            raise self.error
+
+    @property
+    def numPending(self):
+        """ number of frames not yet delivered
+        """
+        return self._pending.qsize()
+
+    def _deliverAll(self):
+        """ deliver results in order until None is received
+        """
+        while True:
+            future=self._pending.get()
+            if future is None:
+                return
+            try:
+                self.deliver(future.result())
+            except Exception as e:
+                print("Error processing frame",e)
+                if self.error is None:
+                    self.error=e
+            finally:
+                self._slots.release()
 
 class CaptureThread(threading.Thread):
     """" runs the capture thread
     """
-    def __init__(self,shutterSpeed, numPictures,delay, directory, prefix, autoShutter, updateImageGui,app=None):
+    def __init__(self,shutterSpeed, numPictures,delay, directory, prefix, autoShutter, updateImageGui,app=None,
+                 fileFormat="fits",meterMode="mean",overrunPolicy="skip",stackFrames=1,stackMode="mean",
+                 darkLibrary=None,bBuildDarks=False,burst=False,numWorkers=None,crop=None,binning=1,
+                 detectThreshold=None,eventFrames=(2,2)):
         """ initialize thread class.
         :param shutterSpeed: Initial shutterspeed to use in microseconds
         :param numPictures: Number of pictures to take
-        :param delay: delay between pictures in seconds, except for first picture. If capturing picture
-               takes longer than this, the next picture is taken immediately
+        :param delay: interval between the starts of pictures in seconds. The first picture is taken immediately
         :param directory: directory where pictures are stored
         :param prefix: prefix of file name, appended by "_num_datetime.fits"
-        :param autoShutter: if true, adjust shutterSpeed such that self.targetMean is reach. self.targetFactor
-               is the accepted tolerance
-        :param updateImageGui: if True provide debayered image to GUI. Needs additional time
+        :param autoShutter: if true, adjust shutterSpeed with self.meter, such that its targetLevel is reached
+        :param updateImageGui: if True provide low resolution preview image to GUI
         :param app: owning app, optional. If given, GUI updates are made
+        :param fileFormat: one of FrameWriter.FILE_FORMATS
+        :param meterMode: one of ExposureMeter.METER_MODES, used by autoShutter
+        :param overrunPolicy: one of DeadlineScheduler.OVERRUN_POLICIES, used if a picture takes longer than delay
+        :param stackFrames: if >1, groups of this many pictures are stacked, and only the stacks are written
+        :param stackMode: one of StackAccumulator.STACK_MODES, used if stackFrames>1
+        :param darkLibrary: DarkLibrary, optional. If given, hot pixels are corrected before pictures are written
+        :param bBuildDarks: if True, the pictures are darks. Their mean is written as master dark and added
+               to darkLibrary. autoShutter and stacking are ignored
+        :param burst: if True, all pictures are taken in one burst with the sensor streaming, as fast as the
+               sensor permits. delay and autoShutter are ignored. For sub-second exposures
+        :param numWorkers: number of threads of the FrameProcessor that processes the captured frames. If 0, frames
+               are processed in this thread between the pictures. DEFAULT_WORKERS if None
+        :param crop: (x,y,width,height) in pixels of the stored mosaic, only this part is kept. All if None
+        :param binning: one of BINNING_FACTORS. Groups of binning x binning pixels of the same color are averaged
+        :param detectThreshold: if not None, only frames with events are written, see EventDetector. Not with stacking
+        :param eventFrames: (before,after) number of frames written before and after an event
         """
         self.shutterSpeed=shutterSpeed
         """ shutter speed to use. May be changed with autoShutter"""
         self.numPictures=numPictures
         """ number of pictures still to be taken"""
         self.delay=delay
-        """ delay between shots in secs. First shot is done immediately. If shot takes longer than delay,
-            the next shot is done immediately
+        """ interval between the starts of shots in secs. First shot is done immediately. If shot takes longer
+            than delay, overrunPolicy applies
         """
+        self.overrunPolicy=overrunPolicy
+        """ see DeadlineScheduler.OVERRUN_POLICIES"""
         self.autoShutter = autoShutter
-        """ if true adapt shutterSpeed by 10% until mean value of 256 is reached"""
+        """ if true adapt shutterSpeed until self.meter reaches its target"""
+        self.burst=burst
+        """ if True, take the pictures with RawCamera.captureBurst(). The shutter speed can not change during a burst"""
+        if binning not in BINNING_FACTORS:
+            raise ValueError("Unknown binning {!s}, choose one of {!s}".format(binning,BINNING_FACTORS))
+        self.crop=tuple(crop) if crop is not None else None
+        """ if not None, (x,y,width,height) of the part of the mosaic that is kept, see alignCrop()"""
+        self.binning=binning
+        """ binning factor, see binMosaic(). Crop and binning are applied right after unpacking, everything
+        after works on the smaller mosaic. Darks must be taken with the same crop and binning"""
 
         self.updateImageGui =updateImageGui and (app is not None)
-        """ if True, send captured image also to GUI. Need additional time for debayer and display"""
+        """ if True, send preview of captured image also to GUI. Needs some time for display"""
         self.directory=directory
         """ path where images are stored"""
         self.prefix=prefix
         """ prefix for filename. Files are stored as "prefix_Num_DateTime.ms.fits"""
+        self.fileFormat=fileFormat
+        """ format of the files, see FrameWriter.FILE_FORMATS"""
 
         self.app=app
         """ calling app. If not None, issue callbacks for updating the GUI"""
 
-        self.targetMean=500
-        """ target mean for exposure"""
-        self.targetFactor=1.05
-        """ tolerance factor for autoShutter"""
+        self.meter=ExposureMeter(meterMode)
+        """ exposure meter for autoShutter, has target and tolerance"""
 
         self.bStopRequest=False
         """ set by stopReques(). Stops run()"""
+        self._stopEvent=threading.Event()
+        """ set by stopRequest(). Interrupts waiting for the next picture"""
+
+        self.bits=10
+        """ bits per pixel of the sensor, known once the camera is open"""
+        self.maxCameraErrors=3
+        """ number of consecutive camera errors after which run() gives up. The camera is reopened after each error"""
+        self.maxQueuedFrames=2
+        """ number of captured frames that may wait for being written to disk"""
+        self.timingInterval=10
+        """ print timing percentiles after this many pictures"""
+        self.numWorkers=numWorkers if numWorkers is not None else DEFAULT_WORKERS
+        """ number of processing threads. With 0, this thread also processes the frames.
+        Otherwise it only captures, and autoShutter uses the metering of the latest processed frame. This is
+        usually the previous frame, but with delay 0 or in bursts it may be one or two frames older"""
+        self._maxPending=self.numWorkers+1
+        """ frames captured but not yet handed to the writer by the FrameProcessor"""
+        self._pool=FramePool(self.maxQueuedFrames+2+(self._maxPending-1 if self.numWorkers>0 else 0))
+        """ raw frame buffers: queued frames, plus one being written, plus one being captured or
+        the frames pending in the FrameProcessor"""
+        self._packedPool=FramePool(self.numWorkers+1)
+        """ buffers for packed frames waiting to be unpacked by the FrameProcessor, plus one being captured"""
+        self._previews=[None,None]
+        """ preview buffers, used alternately. The GUI may still display the previous one"""
+        self._latestPreview=None
+        """ preview of the latest frame delivered by the FrameProcessor, not yet sent to the GUI"""
+        self._shownPreview=None
+        """ preview last sent to the GUI by _takePreview(), released when the next one is sent"""
+        self._previewPool=FramePool(self._maxPending+2)
+        """ preview buffers of the frames processed by _processPacked(): one per pending frame, plus
+        the latest delivered one and the one shown in the GUI"""
+        self._previewLock=threading.Lock()
+        """ protects _latestPreview and _shownPreview, the FrameProcessor delivers from its own thread"""
+        self.darkLibrary=darkLibrary
+        """ if not None, library of hot pixel maps"""
+        self.bBuildDarks=bBuildDarks and darkLibrary is not None
+        """ if True, capture darks for darkLibrary instead of pictures"""
+        if self.bBuildDarks:
+            self.autoShutter=False
+            stackFrames,stackMode=numPictures,"mean"
+        self.stacker=None
+        if stackFrames>1 or self.bBuildDarks:
+            self.stacker=StackAccumulator(stackMode,stackFrames,self.maxQueuedFrames+1)
+        """ if not None, stacks pictures before they are written. Stacks are always written as fits,
+        because fits_rice and raw10 are for 16 bit integers"""
+        self.detector=None
+        if detectThreshold is not None and not self.bBuildDarks:
+            if self.stacker is not None:
+                raise ValueError("Event detection can not be combined with stacking")
+            self.detector=EventDetector(pathlib.Path(directory)/(prefix+"_events.csv"),self._releaseRaw,
+                                        detectThreshold,eventFrames[0],eventFrames[1])
+            self._pool.numBuffers+=self.detector.framesBefore
+        """ if not None, only frames with events are written"""
+        self.bMapped=fileFormat=="fits_mmap" and self.stacker is None and self.detector is None
+        """ if True, raw frames are unpacked directly into their mapped files, see mapFits(). Otherwise
+        they are buffers of self._pool"""
 
         super().__init__()
 
 
-    @staticmethod
-    def _captureFits(shutterSpeed,filename,debayer):
-        """ capture image to fits file
+    def _captureFits(self,camera,writer,shutterSpeed,filename,preview):
+        """ capture image to file in self.fileFormat
+        @param camera: open RawCamera. Only settings that differ from the previous capture are applied
+        @param writer: FrameWriter that writes the file in the background
         @param shutterSpeed in microseconds
         @param filename where to store file. Existing file is overwritten
-        @param debayer: If truem also return debayered image
-        returns (raw,debayered) with debayer==None if debayer is False, else None
-        """
-        with RawCamera() as camera:
-            camera.shutter_speed=shutterSpeed
-            raw,debayer=camera.capture(debayer)
-            #print("camera: ISO=",camera.iso, ", analogGain=",camera.analog_gain, "awb_gains=",camera.awb_gains)
-        hdu=pyfits.PrimaryHDU(raw)
-        # FIXME add some fits keywords, such as date
-        hduList=pyfits.HDUList([hdu])
-        hdu.writeto(filename,clobber=True)
-        return (raw,debayer)
+        @param preview: If True, also return low resolution preview image for the GUI
+        returns preview, None if preview is False
 
-    def _updateApp(self,running,debayer=None):
+        The raw frame is captured into a buffer from _allocateRaw(), which is returned by the writer once the
+        file has been written. Everything that reads the raw frame, such as autoShutter, happens before.
+        """
+        camera.shutter_speed=shutterSpeed
+        captureTime=datetime.datetime.utcnow()
+        raw=camera.capture(False,allocate=functools.partial(self._allocateRaw,filename),crop=self.crop,
+                           binning=self.binning)[0]
+        return self._processFrame(camera,writer,raw,captureTime,shutterSpeed,filename,preview)
+
+    def _captureToProcessor(self,camera,processor,shutterSpeed,filename,preview):
+        """ capture image and submit it to processor, parameters as for _captureFits(). Returns the
+        preview of the latest frame delivered by processor, None if there is none
+
+        Only the packed data is copied here, everything else is done by the workers of processor.
+        """
+        camera.shutter_speed=shutterSpeed
+        captureTime=datetime.datetime.utcnow()
+        packed=camera.capture(False,allocate=self._packedPool.acquire,bPacked=True,crop=self.crop,
+                              binning=self.binning)[0]
+        self._submitFrame(camera,processor,packed,captureTime,shutterSpeed,filename,preview)
+        return self._takePreview()
+
+    def _frameHeader(self,camera,captureTime,shutterSpeed):
+        """ returns dict with FITS keywords of a picture taken with camera
+        """
+        header={"DATE-OBS":captureTime.isoformat(),"EXPTIME":shutterSpeed/1000000,"ISO":camera.iso}
+        if self.binning!=1:
+            header["XBINNING"]=header["YBINNING"]=self.binning
+        if self.crop is not None:
+            width,height=camera.capabilities["max_resolution"]
+            header["XORGSUBF"],header["YORGSUBF"]=alignCrop(self.crop,(height,width),self.binning)[:2]
+        return header
+
+    def _analyzeFrame(self,raw,header,shutterSpeed,iso,capabilities,preview,out=None):
+        """ correct hot pixels of raw and compute the values derived from it, thread safe
+        @param header: FITS keywords of raw, HOTPIX is added
+        @param capabilities: RawCamera.capabilities of the camera
+        @param preview: if True, compute the preview
+        @param out: preview buffer, optional
+        returns (preview,nextShutter): preview is None if not requested, nextShutter None without autoShutter
+        """
+        if self.darkLibrary is not None and not self.bBuildDarks:
+            with timer.stage("hotpixels"):
+                header["HOTPIX"]=self.darkLibrary.correct(raw,shutterSpeed,iso)
+        if preview:
+            with timer.stage("preview"):
+                preview=previewFromMosaic(raw,self.app.subsample,out)
+        else:
+            preview=None
+        nextShutter=None
+        if self.autoShutter and not self.burst:
+            with timer.stage("meter"):
+                nextShutter=self.meter.nextShutter(shutterSpeed,raw,capabilities["min_shutter"],capabilities["max_shutter"],
+                                                   capabilities["black_level"],capabilities["bits"])
+        return (preview,nextShutter)
+
+    def _processFrame(self,camera,writer,raw,captureTime,shutterSpeed,filename,preview):
+        """ process raw frame captured with camera in this thread and hand it to writer,
+        see _captureFits() for the parameters
+        @param raw: raw frame from _allocateRaw()
+        @param captureTime: UTC datetime of the start of the exposure
+        returns preview, None if preview is False
+        """
+        header=self._frameHeader(camera,captureTime,shutterSpeed)
+        try:
+            if preview:
+                self._previews.reverse()
+            preview,nextShutter=self._analyzeFrame(raw,header,shutterSpeed,camera.iso,camera.capabilities,
+                                                   preview,self._previews[0])
+            if preview is not None:
+                self._previews[0]=preview
+        except:
+            self._releaseRaw(raw)
+            raise
+        if nextShutter is not None:
+            self.shutterSpeed=nextShutter
+        self._emitFrame(writer,raw,header,filename)
+        return preview
+
+    def _submitFrame(self,camera,processor,packed,captureTime,shutterSpeed,filename,preview):
+        """ submit packed frame captured with camera to processor, see _processPacked()
+        @param packed: packed raw frame, buffer from self._packedPool
+        """
+        header=self._frameHeader(camera,captureTime,shutterSpeed)
+        try:
+            processor.submit(packed,header,shutterSpeed,camera.iso,camera.capabilities,filename,preview)
+        except:
+            self._packedPool.release(packed)
+            raise
+
+    def _processPacked(self,packed,header,shutterSpeed,iso,capabilities,filename,preview):
+        """ process packed frame, runs in a worker of the FrameProcessor
+        returns (raw,header,filename,preview,nextShutter) for _deliverFrame(), see _analyzeFrame()
+        """
+        try:
+            with timer.stage("unpack"):
+                raw=unpackMosaic(packed,capabilities["bits"],self.binning,functools.partial(self._allocateRaw,filename))
+        finally:
+            self._packedPool.release(packed)
+        previewBuffer=None
+        try:
+            if preview:
+                previewBuffer=self._previewPool.acquire(previewShape(raw.shape,self.app.subsample))
+            preview,nextShutter=self._analyzeFrame(raw,header,shutterSpeed,iso,capabilities,preview,previewBuffer)
+        except:
+            self._releaseRaw(raw)
+            if previewBuffer is not None:
+                self._previewPool.release(previewBuffer)
+            raise
+        return (raw,header,filename,preview,nextShutter)
+
+    def _deliverFrame(self,writer,result):
+        """ hand a frame processed by _processPacked() to writer, called in order of capture
+        """
+        raw,header,filename,preview,nextShutter=result
+        if nextShutter is not None:
+            self.shutterSpeed=nextShutter
+        if preview is not None:
+            with self._previewLock:
+                replaced,self._latestPreview=self._latestPreview,preview
+            # not sent to the GUI
+            if replaced is not None:
+                self._previewPool.release(replaced)
+        self._emitFrame(writer,raw,header,filename)
+
+    def _takePreview(self):
+        """ returns the preview of the latest frame delivered by the FrameProcessor, None if there is no new one
+        """
+        with self._previewLock:
+            preview,self._latestPreview=self._latestPreview,None
+            shown=None
+            if preview is not None:
+                shown,self._shownPreview=self._shownPreview,preview
+        # the GUI now displays preview instead
+        if shown is not None:
+            self._previewPool.release(shown)
+        return preview
+
+    def _emitFrame(self,writer,raw,header,filename):
+        """ hand processed raw frame to writer, or to the stacker if stacking, or to the detector.
+        raw is returned with _releaseRaw()
+        """
+        if self.detector is not None:
+            with timer.stage("detect"):
+                frames=self.detector.add(raw,filename,header)
+            for frame in frames:
+                writer.write(*frame,fileFormat=self.fileFormat,release=self._releaseRaw)
+        elif self.stacker is None:
+            writer.write(filename,raw,header,self.fileFormat,self._releaseRaw)
+        else:
+            try:
+                with timer.stage("stack"):
+                    stack=self.stacker.add(raw,filename,header)
+                self._writeStack(writer,stack)
+            finally:
+                self._releaseRaw(raw)
+
+    def _allocateRaw(self,filename,shape,dtype=np.uint16):
+        """ returns array for the raw frame to be written to filename, see self.bMapped. Must be returned
+        with _releaseRaw()
+        """
+        if self.bMapped:
+            return mapFits(filename,shape)
+        return self._pool.acquire(shape,dtype)
+
+    def _releaseRaw(self,raw):
+        """ return array obtained from _allocateRaw(). Mapped files are unmapped when raw is garbage
+        """
+        if not self.bMapped:
+            self._pool.release(raw)
+
+    def _writeStack(self,writer,stack):
+        """ write stack returned by self.stacker, does nothing if stack is None
+        """
+        if stack is not None:
+            filename,data,header=stack
+            if self.bBuildDarks:
+                numHot=self.darkLibrary.add(data,round(header["EXPTIME"]*1000000),header["ISO"])
+                print("Master dark of",header["NCOMBINE"],"pictures has",numHot,"hot pixels")
+            writer.write(str(pathlib.Path(filename).with_suffix(".fits")),data,header,"fits",self.stacker.release)
+
+    def _nextFileName(self):
+        """ returns file name for the next picture
+        """
+        filename=self._fileTemplate.format(self._index,datetime.datetime.now().strftime("%Y%m%d%H%M%S.%f"))
+        print("Capture", self._index,filename,self.numPictures)
+        return filename
+
+    def _frameDone(self,preview):
+        """ bookkeeping after a picture has been taken
+        """
+        self._index += 1
+        self.numPictures -= 1
+        if self._index%self.timingInterval==0:
+            print("Timing:\n"+timer.summary())
+        self._updateApp(True,preview)
+
+    def _updateApp(self,running,preview=None):
         """ update app with current values
         @param running: True if still running, otherwise terminating
-        @param image: debayered image, may be None
+        @param image: preview image, may be None. Its values have self.bits
         """
         if self.app is None:
             return
@@ -180,520 +1602,221 @@ class CaptureThread(threading.Thread):
             thread=self
         else:
             thread=None
-        self.app.threadUpdateItems(thread, self.shutterSpeed, self.numPictures, debayer)
+        self.app.threadUpdateItems(thread, self.shutterSpeed, self.numPictures, preview, self.bits)
 
 
     def stopRequest(self):
         """ call to stop running thread. Returns immediazely without waiting for stop
         """
         self.bStopRequest=True
-
-    def adjustShutter(self,image):
-        if image is None:
-            return
-        mean=max(1.0,np.mean(image))
-        #if mean<self.targetMean/self.targetFactor:
-        #    self.shutterSpeed=min(1000000*10,int(self.targetFactor*self.shutterSpeed))
-        #elif mean>self.targetMean*self.targetFactor:
-        #    self.shutterSpeed=max(1000000//1000,int(self.shutterSpeed/self.targetFactor))
-        if mean < self.targetMean / self.targetFactor or mean > self.targetMean * self.targetFactor:
-            self.shutterSpeed = min(1000000 * 10, max(1000000 // 100000, int(self.shutterSpeed*self.targetMean/mean)))
+        self._stopEvent.set()
 
     def run(self):
         """ actual work. Also ,manages state with app.
 
-        thread stops when work is done or if someone called stopRequest()
+        thread stops when work is done or if someone called stopRequest(). The camera stays open
+        for the whole run, it is only reopened after an error.
         """
 
         self.bStopRequest=False
-        bFirst=True
-        lastCaptureTime = datetime.datetime.now()
-        i = 0
-        fileTemplate=str(pathlib.Path(self.directory)/pathlib.Path(self.prefix+"_{:04d}_{!s}.fits"))
+        self._stopEvent.clear()
+        # a burst is not paced, it runs as fast as the sensor
+        scheduler=DeadlineScheduler(self.delay if not self.burst else 0,self.overrunPolicy,self._stopEvent)
+        self._fileTemplate=str(pathlib.Path(self.directory)/pathlib.Path(self.prefix+"_{:04d}_{!s}"+
+                                                                        FrameWriter.FILE_FORMATS[self.fileFormat]))
+        self._index=0
+        camera=None
+        cameraErrors=0
+        bRetry=False
+        writer=FrameWriter(self.maxQueuedFrames)
+        processor=None
+        if self.numWorkers>0:
+            processor=FrameProcessor(self._processPacked,functools.partial(self._deliverFrame,writer),
+                                     self.numWorkers,self._maxPending)
         try:
             while not self.bStopRequest and self.numPictures > 0:
-                debayer=None
-                timeSinceCapture = (datetime.datetime.now() - lastCaptureTime).total_seconds()
-                if bFirst or timeSinceCapture >= self.delay:
-                    # take picture
-                    lastCaptureTime = datetime.datetime.now()
-                    filename=fileTemplate.format(i,lastCaptureTime.strftime("%Y%m%d%H%M%S.%f"))
-                    print("Capture", i,filename,self.numPictures)
-                    (raw,debayer)=self._captureFits(self.shutterSpeed,filename,self.updateImageGui)
-                    #raw=None
-                    if self.autoShutter:
-                        self.adjustShutter(raw)
-                    bFirst = False
-                    i += 1
-                    self.numPictures -= 1
-                    # attempt to fight the memory leak
-                    gc.collect()
-                else:
-                    # make sure we poll at least every seconds
-                    timeToGo=self.app.captureDelay-timeSinceCapture
-                    timeToSleep = min(1, timeToGo )
-                    print("sleeping",timeToGo)
-                    time.sleep(timeToSleep)
-                self._updateApp(True,debayer)
+                # a failed picture is repeated immediately, not at the next deadline
+                if not bRetry and not scheduler.waitNext():
+                    break
+                try:
+                    if camera is None:
+                        with timer.stage("open"):
+                            camera=RawCamera()
+                        self.bits=camera.capabilities["bits"]
+                        if self.fileFormat=="raw10" and camera.capabilities["bits"]!=10:
+                            raise ValueError("Format raw10 needs a 10 bit sensor, {!s} has {:d} bits".format(
+                                camera.sensor_type,camera.capabilities["bits"]))
+                    if self.burst:
+                        camera.shutter_speed=self.shutterSpeed
+                        # the file name of a mapped frame is not known yet when it is unpacked in the burst
+                        bPacked=processor is not None or self.bMapped
+                        if bPacked:
+                            frames=camera.captureBurst(self.numPictures,self._packedPool.acquire,True,self.crop,
+                                                       self.binning)
+                        else:
+                            frames=camera.captureBurst(self.numPictures,self._pool.acquire,False,self.crop,
+                                                       self.binning)
+                        for raw,captureTime in frames:
+                            if not bPacked:
+                                preview=self._processFrame(camera,writer,raw,captureTime,self.shutterSpeed,
+                                                           self._nextFileName(),self.updateImageGui)
+                            elif processor is None:
+                                header=self._frameHeader(camera,captureTime,self.shutterSpeed)
+                                self._deliverFrame(writer,self._processPacked(raw,header,self.shutterSpeed,camera.iso,
+                                                                              camera.capabilities,self._nextFileName(),
+                                                                              self.updateImageGui))
+                                preview=self._takePreview()
+                            else:
+                                self._submitFrame(camera,processor,raw,captureTime,self.shutterSpeed,
+                                                  self._nextFileName(),self.updateImageGui)
+                                preview=self._takePreview()
+                            self._frameDone(preview)
+                            if self.bStopRequest:
+                                break
+                    elif processor is None:
+                        preview=self._captureFits(camera,writer,self.shutterSpeed,self._nextFileName(),
+                                                  self.updateImageGui)
+                        self._frameDone(preview)
+                    else:
+                        preview=self._captureToProcessor(camera,processor,self.shutterSpeed,self._nextFileName(),
+                                                         self.updateImageGui)
+                        self._frameDone(preview)
+                    cameraErrors=0
+                    bRetry=False
+                except PiCameraError as e:
+                    cameraErrors+=1
+                    print("Camera error, reopening camera:",e)
+                    if camera is not None:
+                        camera.close()
+                        camera=None
+                    if cameraErrors>=self.maxCameraErrors:
+                        raise
+                    bRetry=True
         finally:
-            self._updateApp(False)
+            if camera is not None:
+                camera.close()
+            print("Schedule:",scheduler.statistics())
+            try:
+                # also on abort: dont lose frames that have already been captured
+                if processor is not None:
+                    print("Waiting for", processor.numPending, "frames to be processed")
+                    processor.close()
+            finally:
+                try:
+                    if self.stacker is not None:
+                        # incomplete last stack
+                        self._writeStack(writer,self.stacker.flush())
+                    if self.detector is not None:
+                        print("Events:",self.detector.flush())
+                    print("Waiting for", writer.numQueued, "frames to be written")
+                    writer.close()
+                    if writer.framesWritten>0:
+                        print("Written {:d} files, {:.1f} MB per file".format(writer.framesWritten,
+                                                                          writer.bytesWritten/writer.framesWritten/1e6))
+                    print("Timing:\n"+timer.summary())
+                finally:
+                    # preview of the last frames delivered by the processor
+                    self._updateApp(False,self._takePreview())
             #print("thread terminated")
 
-class HelpWindow:
-    def __init__(self, master, helpText):
-        self.master = master
-        self.master.wm_title("Help") #window title
-        self.master.protocol("WM_DELETE_WINDOW",self._quitCallback) #close action
-        self.frame = Tk.Frame(self.master)
-        self.text=Tk.Text(self.frame,width=110)
-        self.text.pack(side=Tk.TOP)
-        self.text.insert(Tk.END, str(helpText))
-        self.quitButton = Tk.Button(self.frame, text = 'Quit', width = 25, command = self._quitCallback)
-        self.quitButton.pack(side=Tk.TOP)
-        self.frame.pack()
-    def _quitCallback(self):
-        self.master.destroy()
-
-class RawCameraApp(Tk.Frame):
-    """GUI for RawCamera
-    """
-
-    def __init__(self,master):
-
-        # slots
-        self.shutter_speed=int(1000000 / 10)
-        """ shutter speed used in microseconds"""
-
-        # GUI
-        self.subsample=100
-        """x size of sample used for display. Avoids memory problems"""
-        self.rotation=0
-        """rotation of image in view, 0,90,180,270"""
-
-        # managing the capture thread
-        self.captureThread=None
-        """thread object doing the capture, not None only while running"""
-
-        # capture thread settings
-        self.captureNum = 100
-        """ number of images on run """
-        self.captureDelay = 120
-        """ delay between images during run"""
-        self.captureDirectory=os.getcwd()
-        """ directory for storing images"""
-        self.capturePrefix="light"
-        """ prefix for generated file names"""
-        self.captureAutoShutter=True
-        """" if True, drift current exposure time until mean value 256 is reached"""
-        self.captureDisplayImage=True
-        """ if True, display captured images in GUI. Needs additional time"""
-
-        #some image with non-trivial histogram
-        image1=np.random.randint(0,512,(self.subsample,self.subsample,3))
-        image2=np.random.randint(0,513,(self.subsample,self.subsample,3))
-        self.image=(image1+image2).astype(np.uint16)
-        """image being displayed in GUI, expected to be (low quality) debayered"""
-        #GUI
-        super().__init__(master)
-        self._createWidgets()
+class FocusThread(threading.Thread):
+    """ focus assistant: loops short captures of a small region of interest and measures each with a FocusMeter
 
-    @property
-    def logShutter_speed(self):
-        """ log10 value of shutter_speed in [s]
-        """
-        res=math.log10(self.shutter_speed / 1000000)
-        return res
-
-    @logShutter_speed.setter
-    def logShutter_speed(self,value):
-        """ set log1 value of shutter speed in [s]
-        """
-        self.shutter_speed=int((10.0 ** value) * 1000000)
-
-    def _createWidgets(self):
-        """Create the GUI elements
-        """
-        self.master.wm_title("PiRaw Camera") #window title
-        self.master.protocol("WM_DELETE_WINDOW",self._quitCallback) #close action
-
-        # matplotlib related elements
-        self.figure=self._genFigure()
-        self.canvas=mpl.backends.backend_tkagg.FigureCanvasTkAgg(self.figure,master=self)
-        self.canvas.get_tk_widget().pack(side=Tk.TOP,fill=Tk.BOTH,expand=1)
-
-        self.toolbar=mpl.backends.backend_tkagg.NavigationToolbar2TkAgg(self.canvas,self)
-        self.toolbar.pack(side=Tk.TOP,fill=Tk.BOTH)
-
-        # GUI elements for test capture shown in GUI
-        self.uiFrameCapture=Tk.Frame(self)
-        self.uiCaptureTestButton=Tk.Button(self.uiFrameCapture,text="Capture Test",command=self._captureTestCallback)
-        self.uiCaptureTestButton.pack(side=Tk.LEFT)
-
-        self.uiLogShutterSlider=Tk.Scale(self.uiFrameCapture,label="log10(shutter)[s]",
-                                         from_=-5,to=1,
-                                         orient=Tk.HORIZONTAL,length=200,resolution=0.02,
-                                         command=self._logShutterCallback)
-        self.uiLogShutterSlider.pack(side=Tk.LEFT)
-        self.uiShutterLabel = Tk.Label(self.uiFrameCapture, text="x.xx s")
-        self.uiShutterLabel.pack(side=Tk.LEFT)
-
-        self.uiRotationLabel = Tk.Label(self.uiFrameCapture, text="Rotate View [deg]:")
-        self.uiRotationLabel.pack(side=Tk.LEFT)
-        self._rotationVar=Tk.IntVar(self.uiFrameCapture,self.rotation)
-        self.uiRot0RadioButton=Tk.Radiobutton(self.uiFrameCapture, text="0",
-                                              variable=self._rotationVar,value=0,
-                                              command=self._rotationCallback)
-        self.uiRot0RadioButton.pack(side=Tk.LEFT)
-        self.uiRot90RadioButton=Tk.Radiobutton(self.uiFrameCapture, text="90",
-                                              variable=self._rotationVar,value=90,
-                                              command=self._rotationCallback)
-        self.uiRot90RadioButton.pack(side=Tk.LEFT)
-        self.uiRot180RadioButton=Tk.Radiobutton(self.uiFrameCapture, text="180",
-                                              variable=self._rotationVar,value=180,
-                                              command=self._rotationCallback)
-        self.uiRot180RadioButton.pack(side=Tk.LEFT)
-        self.uiRot270RadioButton=Tk.Radiobutton(self.uiFrameCapture, text="270",
-                                              variable=self._rotationVar,value=270,
-                                              command=self._rotationCallback)
-        self.uiRot270RadioButton.pack(side=Tk.LEFT)
-
-        self.uiFrameCapture.pack(side=Tk.TOP,fill=Tk.BOTH)
-
-        # GUI elements for capture to file
-
-        #self.uiCaptureFitsButton=Tk.Button(self.uiFrameFile,text="Single FITS",command=self._captureFitsCallback)
-        #self.uiCaptureFitsButton.pack(side=Tk.LEFT)
-
-
-        self.uiFrameSequence = Tk.Frame(self)
-
-        # GUI elements for sequence
-        self.uiCaptureNumLabel=Tk.Label(self.uiFrameSequence,text="No of Images:")
-        self.uiCaptureNumLabel.pack(side=Tk.LEFT)
-        self._captureNumVar=Tk.IntVar(self.uiFrameSequence,self.captureNum)
-        captureNumCallback=self.uiFrameSequence.register(self._captureNumCallback)
-        self.uiCaptureNumEntry=Ttk.Entry(self.uiFrameSequence,width=4,textvariable=self._captureNumVar,
-                                         validate="all",validatecommand=(captureNumCallback,"%P"))
-        self.uiCaptureNumEntry.pack(side=Tk.LEFT)
-
-        self.uiCaptureDelayLabel = Tk.Label(self.uiFrameSequence, text="Delay [s]:")
-        self.uiCaptureDelayLabel.pack(side=Tk.LEFT)
-
-        self._captureDelayVar=Tk.IntVar(self.uiFrameSequence,self.captureDelay)
-        captureDelayCallback = self.uiFrameSequence.register(self._captureDelayCallback)
-        self.uiCaptureDelayEntry = Ttk.Entry(self.uiFrameSequence, width=4, textvariable=self._captureDelayVar,
-                                           validate="all", validatecommand=(captureDelayCallback, "%P"))
-        self.uiCaptureDelayEntry.pack(side=Tk.LEFT)
-
-        self._captureAutoShutterVar=Tk.BooleanVar(self.uiFrameSequence,self.captureAutoShutter)
-        self.uiCaptureAutoShutterCheckbox=Tk.Checkbutton(self.uiFrameSequence,text="AutoShutter",command=self._captureAutoShutterCallback,
-                                                  variable=self._captureAutoShutterVar)
-        self.uiCaptureAutoShutterCheckbox.pack(side=Tk.LEFT)
-
-        self.uiFrameSequence.pack(side=Tk.TOP, fill=Tk.BOTH)
-
-        # GUI elements for file management
-        self.uiFrameFile=Tk.Frame(self)
-        self.uiCaptureDirectoryButton = Tk.Button(self.uiFrameFile, text="Directory...", command=self._captureDirectoryCallback)
-        self.uiCaptureDirectoryButton.pack(side=Tk.LEFT)
-        self.uiCaptureDirectoryLabel=Tk.Label(self.uiFrameFile,text="")
-        self.uiCaptureDirectoryLabel.pack(side=Tk.LEFT)
-
-        self.uiCapturePrefixLabel = Tk.Label(self.uiFrameFile, text="Prefix:")
-        self.uiCapturePrefixLabel.pack(side=Tk.LEFT)
-        self._capturePrefixVar=Tk.IntVar(self.uiFrameFile,self.capturePrefix)
-        capturePrefixCallback = self.uiFrameFile.register(self._capturePrefixCallback)
-        self.uiCapturePrefixEntry = Ttk.Entry(self.uiFrameFile, width=8, textvariable=self._capturePrefixVar,
-                                           validate="all", validatecommand=(capturePrefixCallback, "%P"))
-        self.uiCapturePrefixEntry.pack(side=Tk.LEFT)
-
-        self.uiCaptureRunButton = Tk.Button(self.uiFrameFile, text="Run", command=self._captureRunCallback)
-        self.uiCaptureRunButton.pack(side=Tk.LEFT)
-
-        self.uiFrameFile.pack(side=Tk.TOP,fill=Tk.BOTH)
-
-        #Quit +Help Button
-        self.quitButton=Tk.Button(self,text="Quit",command=self._quitCallback)
-        self.quitButton.pack(side=Tk.LEFT)
-        self.helpButton=Tk.Button(self,text="Help...",command=self._helpCallback)
-        self.helpButton.pack(side=Tk.LEFT)
-
-        self.pack(fill=Tk.BOTH, expand=1)
-
-        self._updateItems()
-
-
-    def threadUpdateItems(self,thread,shutterSpeed,captureNum,image=None):
-        """ called by capture thread to update GUI
-        """
-        self.captureThread=thread
-        self.shutter_speed=shutterSpeed
-        #print("threadUpdateItems():shutterSpeed=",shutterSpeed)
-        self.captureNum=captureNum
-        if image is not None:
-            self.image=image
-            self._redraw()
-        self._updateItems()
-        self.update()
-
-    def _updateItems(self):
-        """ update GUI elements to current state
-        """
-        #update displayed values
-        #print("_updateItems,log_shutter_speed",self.logShutter_speed)
-        self.uiLogShutterSlider.set(self.logShutter_speed)
-        self.uiShutterLabel.config(text="{:6.6f} sec".format(self.shutter_speed / 1000000))
-        self._rotationVar.set(self.rotation)
-        self._captureNumVar.set(self.captureNum)
-        self._captureDelayVar.set(self.captureDelay)
-        self._capturePrefixVar.set(self.capturePrefix)
-        self._captureAutoShutterVar.set(self.captureAutoShutter)
-        self.uiCaptureDirectoryLabel.config(text=self.captureDirectory[-20:])
-
-        # disable/enable
-        if self.captureThread is not None:
-            self.uiCaptureRunButton.config(text="Abort")
-            # FIXME wont update if disabled
-            #self.uiCaptureFitsButton.config(state=Tk.DISABLED)
-            self.uiCaptureNumEntry.config(state=Tk.DISABLED)
-            self.uiCaptureDelayEntry.config(state=Tk.DISABLED)
-            self.uiCaptureDirectoryButton.config(state=Tk.DISABLED)
-            self.uiCapturePrefixEntry.config(state=Tk.DISABLED)
-            self.uiCaptureTestButton.config(state=Tk.DISABLED)
-            self.uiCaptureAutoShutterCheckbox.config(state=Tk.DISABLED)
-            #self.uiLogShutterSlider.config(state=Tk.DISABLED)
-            self.helpButton.config(state=Tk.DISABLED)
-            self.quitButton.config(state=Tk.DISABLED)
-        else:
-            self.uiCaptureRunButton.config(text="Run")
-            #self.uiCaptureFitsButton.config(state=Tk.NORMAL)
-            self.uiCaptureNumEntry.config(state=Tk.NORMAL)
-            self.uiCaptureDelayEntry.config(state=Tk.NORMAL)
-            self.uiCaptureDirectoryButton.config(state=Tk.NORMAL)
-            self.uiCapturePrefixEntry.config(state=Tk.NORMAL)
-            self.uiCaptureTestButton.config(state=Tk.NORMAL)
-            self.uiCaptureAutoShutterCheckbox.config(state=Tk.NORMAL)
-            self.uiLogShutterSlider.config(state=Tk.NORMAL)
-            self.helpButton.config(state=Tk.NORMAL)
-            self.quitButton.config(state=Tk.NORMAL)
-
-
-    def _quitCallback(self):
-        """ callback for Quit button
-        """
-        if self.captureThread:
-            TkMb.showerror("Error","Abort capture run before quitting!")
-        else:
-            self.quit()
-            self.destroy()
-
-    def _helpCallback(self):
-        helpText="""PiRaw - A tool for capturing RAWs with the Raspberry Pi
-
-This tool allows to capture RAWs with the Raspberry Pi Camera Module, controlled with a GUI.
-So far tested with Raspberry Pi 3 and PiNoir V2.1, but should work with other
-RaspberryPi systems as well.
-
-The pictures are stored as bayered FITS files as understood by many astrophotography tools.
-Pixel values are 0..1023 (10 bits). When read with PixInsight, the images can be debayered with
-the RGGB pattern.
-
-UI elements:
-- Picture preview on the top left: Reduced resolution view of the captured picture. Can be rotated with the
-  "Rotation" buttons. Reduced resolution is used to limit memory and CPU consumption
-- Histogram on the top right: RGB histogram, generated from the reduced resolution picture.
-- Capture Test button: Capture image, but dont store a FITS file. Good for determining shutter speed
-  and camera orientation
-- Shutter slider: Log scale slider to determine shutter speed. Actual shutter speed in displayed to the right.
-  Note that there is no choice of aperture or ISO: The Pi Camera does not really have something like this.
-- Rotate View buttons: Rotate the picture preview. Has no influence on the orientation of the FITS file
-- No of Images text field: determine the number of images to be taken. One image is approx. 16 MB, so a
-  16GB SD card is goold for several hundred images
-- Delay: Time between images. If time is shorter than the time needed to take an image (20..80 seconds), the
-  next shot is made immediately. Note that the time for capture depends on the shutter time. For 10 second
-  captures it is around 80 seconds, for short exposure times around 20 seconds.
-- Autoshutter check box: If enabled, adapts shutter time such that the mean value of an image is ~500.
-  Adaption happens after each shot. Has no effect on Capture Test.
-- Directory button: Choose directory where images are stored.
-- Prefix text field: Enter file prefix. Files get names such as prefix_201_20160828163035.727016.fits,
-  with _201 being the image number, then datetime.milliseconds, then postfix .fits.
-- Run/Abort button: Run the capture sequence. While running, it is possible to abort.
-- Help button: Display this text
-- Quit button: Quit the tool"""
-        newWindow = Tk.Toplevel(self.master)
-        self.app = HelpWindow(newWindow,helpText)
-
-
-    #@busyCursor
-    def _captureRunCallback(self):
-        """ callback for Run button, capture series
-        """
-        #print("_captureRunCallback")
-        if self.captureThread is not None:
-            self.captureThread.stopRequest()
-        else:
-            self.captureThread=CaptureThread(self.shutter_speed, self.captureNum,
-                                             self.captureDelay, self.captureDirectory,
-                                             self.capturePrefix, self.captureAutoShutter,
-                                             self.captureDisplayImage,
-                                             self)
-            self.captureThread.start()
+    The sensor streams in bursts of framesPerBurst frames, see RawCamera.captureBurst(), and only the region is
+    unpacked, see cropPacked(). There is no demosaic and no preview, so each exposure gives a new measurement.
+    Changes of shutterSpeed and center are applied with the next burst, which starts right away.
+    """
+    def __init__(self,shutterSpeed,numFrames=None,center=(0.5,0.5),size=256,app=None,framesPerBurst=10):
+        """ initialize thread
+        :param shutterSpeed: shutter speed in microseconds. May be changed while running
+        :param numFrames: number of frames to measure, None to run until stopRequest()
+        :param center: (x,y) center of the region of interest as fraction of the width and height of the
+               mosaic as returned by RawCamera.capture(False). May be changed while running
+        :param size: width and height of the region of interest in mosaic pixels
+        :param app: owning app, optional. If given, the measurements are sent with app.threadFocusItems(),
+               otherwise they are printed
+        :param framesPerBurst: number of frames per burst
+        """
+        self.shutterSpeed=shutterSpeed
+        """ shutter speed in microseconds"""
+        self.numFrames=numFrames
+        """ number of frames still to be measured, None if unlimited"""
+        self.center=tuple(center)
+        """ (x,y) center of the region of interest, fractions of the mosaic"""
+        self.size=size
+        """ size of the region of interest in pixels"""
+        self.app=app
+        """ calling app. If not None, issue callbacks for updating the GUI"""
+        self.framesPerBurst=framesPerBurst
+        """ frames per burst. Settings can only change between bursts"""
+        self.meter=FocusMeter()
+        """ computes the focus metrics"""
+        self.numMeasured=0
+        """ number of frames measured so far"""
+        self.bStopRequest=False
+        """ set by stopRequest(). Stops run()"""
+        super().__init__()
 
-        self._updateItems()
+    def roi(self,shape):
+        """ returns crop (x,y,width,height) of the region of interest in a mosaic of shape, see alignCrop()
+        """
+        size=min(self.size,shape[0],shape[1])
+        x=min(max(0,int(self.center[0]*shape[1])-size//2),shape[1]-size)
+        y=min(max(0,int(self.center[1]*shape[0])-size//2),shape[0]-size)
+        return alignCrop((x,y,size,size),shape)
 
-    @busyCursor
-    def _rotationCallback(self):
-        """ Callback for rotation radio butttons
+    def stopRequest(self):
+        """ call to stop running thread. Returns immediately without waiting for stop
         """
-        val=self._rotationVar.get()
-        if val!=self.rotation:
-            self.rotation=val
-            self._redraw()
+        self.bStopRequest=True
 
-    def _captureNumCallback(self,val):
-        """ callback for capture num entry
+    def _report(self,running,measurement):
+        """ send measurement, see FocusMeter.measure(), to the app or print it
+        @param running: True if still running, otherwise terminating
         """
-        try:
-            val=int(val)
-        except ValueError:
-            return False
-        if val<0:
-            return False
-        self.captureNum=val
-        return True
+        if self.app is not None:
+            self.app.threadFocusItems(self if running else None,measurement)
+        elif measurement is not None:
+            print("Focus {:d}: hfr {:.2f} px, gradient {:.4f}, peak {:d} at x {:d} y {:d}".format(self.numMeasured,
+                                                                                                  *measurement))
+        elif running:
+            print("Focus {:d}: no star".format(self.numMeasured))
 
-    def _captureDelayCallback(self, val):
-        """ callback for capture delay entry
+    def run(self):
+        """ actual work. Measures until numFrames are done or someone called stopRequest()
         """
+        self.bStopRequest=False
+        camera=None
+        pool=FramePool(2)
         try:
-            val = int(val)
-        except ValueError:
-            return False
-        if val < 0:
-            return False
-        self.captureDelay = val
-        return True
-
-    @busyCursor
-    def _captureTestCallback(self):
-        """ capture test image
-        """
-        now=datetime.datetime.now()
-        with RawCamera() as camera:
-            #print("RawCameraApp._captureTestCallback() init=%s secs" % (datetime.datetime.now() - now))
-            camera.shutter_speed=self.shutter_speed
-            #print("RawCameraApp._captureTestCallback() shutter=%s secs" % (datetime.datetime.now() - now))
-            self.image=camera.capture(True)[1]
-        #print("RawCameraApp._captureTestCallback() capture=%s secs" % (datetime.datetime.now() - now))
-        self._redraw()
-        #print("RawCameraApp._captureTestCallback() redraw=%s secs" % (datetime.datetime.now() - now))
-
-    #@busyCursor
-    #def _captureFitsCallback(self):
-    #    """ capture image to fits file
-    #    """
-    #    now=datetime.datetime.now()
-    #    with RawCamera() as camera:
-    #        camera.shutter_speed=self.shutter_speed
-    #        image=camera.capture(False)
-    #    print("RawCameraApp._captureFitsCallback() capture=%s secs" % (datetime.datetime.now() - now))
-    #    print("FitsImage=",image.shape,image.dtype)
-    #    hdu=pyfits.PrimaryHDU(image)
-    #    hduList=pyfits.HDUList([hdu])
-    #    print("RawCameraApp._captureFitsCallback() prepFits=%s secs" % (datetime.datetime.now() - now))
-    #    hdu.writeto("test.fits",clobber=True)
-    #    print("RawCameraApp._captureFitsCallback() writeFits=%s secs" % (datetime.datetime.now() - now))
-
-    def _logShutterCallback(self,value):
-        """ callback for shutter slider
-        """
-        self.logShutter_speed=float(value)
-        self._updateItems()
-
-    def _captureAutoShutterCallback(self):
-        """ callback for autoshutter checkbox
-        """
-        self.captureAutoShutter=not self.captureAutoShutter
-        self._updateItems()
-
-    def _captureDirectoryCallback(self):
-        """ callback for directory button
-        """
-        self.captureDirectory=TkFd.askdirectory(parent=self,initialdir=self.captureDirectory, mustexist=True,
-                                                title=("Choose directory for images"))
-        self._updateItems()
-
-    def _capturePrefixCallback(self, val):
-        """ callback for capture prefix entry
-        """
-        self.capturePrefix=val
-        return True
-
-    def _redraw(self):
-        """ redraw with current data
-        """
-        now = datetime.datetime.now()
-        size=self.figure.get_size_inches()
-
-        self.figure=self._genFigure(self.figure)
-        #print("RawCameraApp._redraw() genFigure=%s secs" % (datetime.datetime.now() - now))
-        self.figure.set_size_inches(size)
-        #print("RawCameraApp._redraw() set_size=%s secs" % (datetime.datetime.now() - now))
-        self.canvas.figure=self.figure
-        #print("RawCameraApp._redraw() set_figure=%s secs" % (datetime.datetime.now() - now))
-        self.canvas.draw()
-        #print("RawCameraApp._redraw() draw=%s secs" % (datetime.datetime.now() - now))
-
-    def _genFigure(self,fig=None):
-        """returns figure to be displayed
-        """
-        #print("genFigureCalled")
-        #now=datetime.datetime.now()
-        # subsample. Full image is too much for RPi
-        #print("image.shape=",self.image.shape)
-        subStep=max(1,self.image.shape[0]/self.subsample)
-        smallImage=self.image[::subStep,::subStep,:]
-        #print("RawCameraApp._genFigure() smallImage=%s secs" % (datetime.datetime.now() - now))
-
-        #order seems incorrect, fix it
-        #r = smallImage[:, :, 1].copy()
-        #g = smallImage[:, :, 0].copy()
-        #smallImage[:,:,0]=r
-        #smallImage[:,:,1]=g
-
-        uint8Image=(smallImage//4).astype(np.uint8)
-        if self.rotation==90:
-            uint8Image=np.rot90(uint8Image)
-        elif self.rotation==180:
-            uint8Image = np.rot90(uint8Image,2)
-        elif self.rotation==270:
-            uint8Image = np.rot90(uint8Image,3)
-
-        #print("RawCameraApp._genFigure() uint8Image=%s secs" % (datetime.datetime.now() - now))
-        #smallImage=self.image[0:self.subsample,0:self.subsample,:]
-        #print("smallImage=",smallImage.shape, smallImage.dtype)
-        #print("uin8Image=",uint8Image.shape, uint8Image.dtype)
-        if fig is None:
-            fig,axes=plt.subplots(1,2,squeeze=True)
-        else:
-            axes=fig.axes
-            for ax in axes:
-                ax.clear()
-        #print("RawCameraApp._genFigure() subPlots=%s secs" % (datetime.datetime.now() - now))
-        ax=axes[0]
-        ax.imshow(uint8Image,interpolation='none')
-        #print("RawCameraApp._genFigure() imshow=%s secs" % (datetime.datetime.now() - now))
-
-        ax=axes[1]
-        ax.hist([smallImage[:,:,i] for i in range(smallImage.shape[2])],bins=10,range=(0,1023),
-                color=('r','g','b'))
-        #print("RawCameraApp._genFigure() hist=%s secs" % (datetime.datetime.now() - now))
-
-        ax.set_title("Mean={:4.3f}".format(smallImage.mean()))
-        #ax.plot([1,2],[2,1])
-        #print("RawCameraApp._genFigure() return=%s secs" % (datetime.datetime.now() - now))
-
-        return fig
+            with timer.stage("open"):
+                camera=RawCamera()
+            width,height=camera.capabilities["max_resolution"]
+            shape=(height,width)
+            while not self.bStopRequest and (self.numFrames is None or self.numFrames>0):
+                shutterSpeed,center=self.shutterSpeed,self.center
+                camera.shutter_speed=shutterSpeed
+                numFrames=self.framesPerBurst if self.numFrames is None else min(self.framesPerBurst,self.numFrames)
+                frames=camera.captureBurst(numFrames,pool.acquire,False,self.roi(shape))
+                try:
+                    for raw,captureTime in frames:
+                        with timer.stage("focus"):
+                            measurement=self.meter.measure(raw)
+                        pool.release(raw)
+                        self.numMeasured+=1
+                        if self.numFrames is not None:
+                            self.numFrames-=1
+                        self._report(True,measurement)
+                        if self.bStopRequest or shutterSpeed!=self.shutterSpeed or center!=self.center:
+                            break
+                finally:
+                    frames.close()
+        finally:
+            if camera is not None:
+                camera.close()
+            if self.app is None:
+                print("Timing:\n"+timer.summary())
+            self._report(False,None)
 
 # Adapted from https://github.com/waveform80/picamera/pull/309:
 # -faster decode
@@ -728,7 +1851,7 @@ UI elements:
 # POSSIBILITY OF SUCH DAMAGE.
 from numpy.lib.stride_tricks import as_strided
 # Adapted PiBayerArray
-class PiBayerFlatArray(picamera.array.PiArrayOutput):
+class PiBayerFlatArray(_ArrayOutput):
     """
     Produces a 3-dimensional RGB array from raw Bayer data.
     This custom output class is intended to be used with the
@@ -747,8 +1870,9 @@ class PiBayerFlatArray(picamera.array.PiArrayOutput):
     array always has the shape (1944, 2592, 3) with the V1 module, or
     (2464, 3280, 3) with the V2 module; this also implies that the
     optional *size* parameter (for specifying a resizer resolution) is not
-    available with this array class. As the sensor records 10-bit values,
-    the array uses the unsigned 16-bit integer data type.
+    available with this array class. As the sensor records 10-bit values
+    (12-bit with the HQ camera), the array uses the unsigned 16-bit integer
+    data type. The geometry is read from the BRCM header, see locateBayerData().
     By default, `de-mosaicing`_ is **not** performed; if the resulting array is
     viewed it will therefore appear dark and too green (due to the green bias
     in the `Bayer pattern`_). A trivial weighted-average demosaicing algorithm
@@ -767,101 +1891,900 @@ class PiBayerFlatArray(picamera.array.PiArrayOutput):
     .. _Bayer pattern: http://en.wikipedia.org/wiki/Bayer_filter
     """
 
-    def __init__(self, camera):
+    def __init__(self, camera, allocate=None, bPacked=False, crop=None, binning=1):
+        """ initialize output
+        :param camera: camera to capture from
+        :param allocate: function(shape, dtype) returning the arrays the raw and demosaiced data are
+               written to, e.g. FramePool.acquire. Allocates new arrays if None
+        :param bPacked: if True, array is a copy of the packed rows, to be unpacked later with the function
+               of BAYER_PACKINGS for bits. Copying is much faster than unpacking, see FrameProcessor
+        :param crop: (x,y,width,height) in pixels, only this part of the mosaic is kept, see alignCrop(). All if None
+        :param binning: one of BINNING_FACTORS, see binMosaic(). Not applied if bPacked
+        """
         super(PiBayerFlatArray, self).__init__(camera, size=None)
         self._demo = None
+        self._allocate = allocate
+        self._bPacked = bPacked
+        self._crop = crop
+        self._binning = binning
+        self.bits = None
+        """ bits per pixel of the sensor, key of BAYER_PACKINGS. Known after flush()"""
 
     def flush(self):
         super(PiBayerFlatArray, self).flush()
         self._demo = None
-        ver = 1
-        data = self.getvalue()[-6404096:]
-        if data[:4] != b'BRCM':
-            ver = 2
-            data = self.getvalue()[-10270208:]
-            if data[:4] != b'BRCM':
-                raise picamera.exc.PiCameraValueError('Unable to locate Bayer data at end of buffer')
-        # Strip header
-        data = data[32768:]
-        # Reshape into 2D pixel values
-        reshape, crop = {
-            1: ((1952, 3264), (1944, 3240)),
-            2: ((2480, 4128), (2464, 4100)),
-        }[ver]
-        data = np.frombuffer(data, dtype=np.uint8). \
-                   reshape(reshape)[:crop[0], :crop[1]]
-        # Unpack 10-bit values; every 5 bytes contains the high 8-bits of 4
-        # values followed by the low 2-bits of 4 values packed into the fifth
-        # byte
-        data = data.astype(np.uint16) << 2
-        for byte in range(4):
-            data[:, byte::5] |= ((data[:, 4::5] >> ((4 - byte) * 2)) & 3)
-        # Create a new array from the unpacked data
-        self.array = np.zeros((data.shape[0], (data.shape[1]*4)//5), dtype=np.uint16)
-        for i in range(4):
-            self.array[:, i::4] = data[:, i::5]
-
-    def demosaic(self):
-        if self._demo is None:
-            # XXX Again, should take into account camera's vflip and hflip here
-            # Construct representation of the bayer pattern
-            expandedArray = np.zeros(self.array.shape + (3,), dtype=self.array.dtype)
-            expandedArray[1::2, 1::2, 0] = self.array[1::2, 1::2]  # Red
-            expandedArray[1::2, 0::2, 1] = self.array[1::2, 0::2]  # Green
-            expandedArray[0::2, 1::2, 1] = self.array[0::2, 1::2]  # Green
-            expandedArray[0::2, 0::2, 2] = self.array[0::2, 0::2]  # Blue
-            # Construct representation of the bayer pattern
-            bayer = np.zeros(expandedArray.shape, dtype=np.uint8)
-            bayer[1::2, 1::2, 0] = 1  # Red
-            bayer[0::2, 1::2, 1] = 1  # Green
-            bayer[1::2, 0::2, 1] = 1  # Green
-            bayer[0::2, 0::2, 2] = 1  # Blue
-            # Allocate output array with same shape as data and set up some
-            # constants to represent the weighted average window
-            window = (3, 3)
-            borders = (window[0] - 1, window[1] - 1)
-            border = (borders[0] // 2, borders[1] // 2)
-            # Pad out the data and the bayer pattern (np.pad is faster but
-            # unavailable on the version of numpy shipped with Raspbian at the
-            # time of writing)
-            rgb = np.zeros((
-                expandedArray.shape[0] + borders[0],
-                expandedArray.shape[1] + borders[1],
-                expandedArray.shape[2]), dtype=self.array.dtype)
-            rgb[
-            border[0]:rgb.shape[0] - border[0],
-            border[1]:rgb.shape[1] - border[1],
-            :] = expandedArray
-            bayer_pad = np.zeros((
-                expandedArray.shape[0] + borders[0],
-                expandedArray.shape[1] + borders[1],
-                expandedArray.shape[2]), dtype=bayer.dtype)
-            bayer_pad[
-            border[0]:bayer_pad.shape[0] - border[0],
-            border[1]:bayer_pad.shape[1] - border[1],
-            :] = bayer
-            bayer = bayer_pad
-            # For each plane in the RGB data, construct a view over the plane
-            # of 3x3 matrices. Then do the same for the bayer array and use
-            # Einstein summation to get the weighted average
-            self._demo = np.empty(expandedArray.shape, dtype=expandedArray.dtype)
-            for plane in range(3):
-                p = rgb[..., plane]
-                b = bayer[..., plane]
-                pview = as_strided(p, shape=(
-                                                p.shape[0] - borders[0],
-                                                p.shape[1] - borders[1]) + window, strides=p.strides * 2)
-                bview = as_strided(b, shape=(
-                                                b.shape[0] - borders[0],
-                                                b.shape[1] - borders[1]) + window, strides=b.strides * 2)
-                psum = np.einsum('ijkl->ij', pview)
-                bsum = np.einsum('ijkl->ij', bview)
-                self._demo[..., plane] = psum // bsum
-        return self._demo
+        # Work on a view of the BytesIO buffer: getvalue() would copy the complete JPEG+RAW data
+        # just to slice off its tail. The view must be released before the stream can be
+        # written or truncated again, so no array may keep referring to it after this method.
+        buffer = self.getbuffer()
+        packed = None
+        try:
+            with timer.stage("bayer"):
+                offset, geometry = locateBayerData(buffer)
+                self.bits = geometry["bits"]
+                packing = BAYER_PACKINGS[self.bits]
+                # Strip header and reshape into 2D rows of packed pixel values, without the padding
+                rows, cols = geometry["shape"]
+                packed = np.frombuffer(buffer, dtype=np.uint8, count=geometry["rows"] * geometry["stride"],
+                                       offset=offset + BRCM_HEADER_SIZE).reshape(geometry["rows"], geometry["stride"])
+                packed = packed[:rows, :(cols * packing["bytes"]) // packing["pixels"]]
+                if self._crop is not None or self._binning != 1:
+                    packed = cropPacked(packed, self.bits, self._crop, self._binning)
+                if self._bPacked:
+                    if self._allocate is not None:
+                        self.array = self._allocate(packed.shape, np.uint8)
+                        self.array[...] = packed
+                    else:
+                        self.array = packed.copy()
+            if not self._bPacked:
+                with timer.stage("unpack"):
+                    self.array = unpackMosaic(packed, self.bits, self._binning, self._allocate)
+        except BaseException as error:
+            # The frames of the traceback may still refer to views of buffer. They would keep the
+            # stream from being written or truncated as long as error is alive, e.g. while handled.
+            traceback.clear_frames(error.__traceback__)
+            raise
+        finally:
+            packed = None
+            buffer.release()
+
+    def demosaic(self, algorithm=None):
+        """ returns demosaiced RGB array, computed with one of DEMOSAIC_ALGORITHMS
+        :param algorithm: name of the algorithm, DEFAULT_DEMOSAIC if None
+        """
+        if algorithm is None:
+            algorithm = DEFAULT_DEMOSAIC
+        if self._demo is None or self._demo[0] != algorithm:
+            # The algorithms expect red at [0,0]. Without h/vflip the sensor delivers blue there, the
+            # flipped view of the mosaic is RGGB. Flipping the result back restores the orientation.
+            out = None
+            if self._allocate is not None:
+                shape = self.array.shape if algorithm != "superpixel" else (self.array.shape[0] // 2,
+                                                                            self.array.shape[1] // 2)
+                out = self._allocate(shape + (3,), np.uint16)[::-1, ::-1]
+            function = DEMOSAIC_ALGORITHMS[algorithm]
+            if algorithm == "edge":
+                function = functools.partial(function, bits=self.bits)
+            with timer.stage("demosaic"):
+                demo = function(self.array[::-1, ::-1], out)[::-1, ::-1]
+            self._demo = (algorithm, demo)
+        return self._demo[1]
+
+    @staticmethod
+    def demosaicReference(mosaic, out=None):
+        """ weighted average over all pixels of the same color in a 3x3 window. This is the
+        original picamera algorithm, kept as reference for the faster ones.
+
+        Cost: about 6 times the frame size in temporaries, several seconds on a Pi 3
+        :param mosaic: RGGB mosaic
+        :param out: uint16 array (rows, cols, 3) for the result, allocated if None
+        :returns uint16 RGB array of the same resolution
+        """
+        # Construct representation of the bayer pattern
+        expandedArray = np.zeros(mosaic.shape + (3,), dtype=mosaic.dtype)
+        expandedArray[0::2, 0::2, 0] = mosaic[0::2, 0::2]  # Red
+        expandedArray[0::2, 1::2, 1] = mosaic[0::2, 1::2]  # Green
+        expandedArray[1::2, 0::2, 1] = mosaic[1::2, 0::2]  # Green
+        expandedArray[1::2, 1::2, 2] = mosaic[1::2, 1::2]  # Blue
+        # Construct representation of the bayer pattern
+        bayer = np.zeros(expandedArray.shape, dtype=np.uint8)
+        bayer[0::2, 0::2, 0] = 1  # Red
+        bayer[0::2, 1::2, 1] = 1  # Green
+        bayer[1::2, 0::2, 1] = 1  # Green
+        bayer[1::2, 1::2, 2] = 1  # Blue
+        # Allocate output array with same shape as data and set up some
+        # constants to represent the weighted average window
+        window = (3, 3)
+        borders = (window[0] - 1, window[1] - 1)
+        border = (borders[0] // 2, borders[1] // 2)
+        # Pad out the data and the bayer pattern (np.pad is faster but
+        # unavailable on the version of numpy shipped with Raspbian at the
+        # time of writing)
+        rgb = np.zeros((
+            expandedArray.shape[0] + borders[0],
+            expandedArray.shape[1] + borders[1],
+            expandedArray.shape[2]), dtype=mosaic.dtype)
+        rgb[
+        border[0]:rgb.shape[0] - border[0],
+        border[1]:rgb.shape[1] - border[1],
+        :] = expandedArray
+        bayer_pad = np.zeros((
+            expandedArray.shape[0] + borders[0],
+            expandedArray.shape[1] + borders[1],
+            expandedArray.shape[2]), dtype=bayer.dtype)
+        bayer_pad[
+        border[0]:bayer_pad.shape[0] - border[0],
+        border[1]:bayer_pad.shape[1] - border[1],
+        :] = bayer
+        bayer = bayer_pad
+        # For each plane in the RGB data, construct a view over the plane
+        # of 3x3 matrices. Then do the same for the bayer array and use
+        # Einstein summation to get the weighted average
+        demo = out if out is not None else np.empty(expandedArray.shape, dtype=expandedArray.dtype)
+        for plane in range(3):
+            p = rgb[..., plane]
+            b = bayer[..., plane]
+            pview = as_strided(p, shape=(
+                                            p.shape[0] - borders[0],
+                                            p.shape[1] - borders[1]) + window, strides=p.strides * 2)
+            bview = as_strided(b, shape=(
+                                            b.shape[0] - borders[0],
+                                            b.shape[1] - borders[1]) + window, strides=b.strides * 2)
+            psum = np.einsum('ijkl->ij', pview)
+            bsum = np.einsum('ijkl->ij', bview)
+            demo[..., plane] = psum // bsum
+        return demo
+
+def unpack10(packed, out=None):
+    """ unpack rows of 10 bit pixel values, packed 4 pixels into 5 bytes
+
+    The first 4 bytes of each group hold the high 8 bits of 4 pixels, the 5th byte holds
+    the low 2 bits of these pixels. The values are written directly into out, there are
+    no full frame temporaries.
+    :param packed: uint8 array (rows, 5*n), may be a view into a larger buffer
+    :param out: uint16 array (rows, 4*n) receiving the pixels. Allocated if None
+    :returns out
+    """
+    rows, cols = packed.shape
+    if out is None:
+        out = np.empty((rows, (cols * 4) // 5), dtype=np.uint16)
+    low = packed[:, 4::5]
+    lowBits = np.empty(low.shape, dtype=np.uint8)
+    for i in range(4):
+        pixels = out[:, i::4]
+        np.left_shift(packed[:, i::5], 2, out=pixels, dtype=np.uint16)
+        # bit order of the low bits as in the original picamera PR 309 decoder
+        np.right_shift(low, 6 - 2 * i, out=lowBits)
+        lowBits &= 3
+        pixels |= lowBits
+    return out
+
+
+
+def pack10(array):
+    """ pack 10 bit pixel values 4 into 5 bytes, the inverse of unpack10()
+    :param array: uint16 array (rows, cols) with values 0..1023. If cols is not a multiple of 4,
+           the rows are padded with 0
+    :returns uint8 array (rows, 5*ceil(cols/4))
+    """
+    rows, cols = array.shape
+    groups = (cols + 3) // 4
+    if cols != 4 * groups:
+        padded = np.zeros((rows, 4 * groups), dtype=array.dtype)
+        padded[:, :cols] = array
+        array = padded
+    packed = np.empty((rows, 5 * groups), dtype=np.uint8)
+    low = packed[:, 4::5]
+    low[...] = 0
+    for i in range(4):
+        pixels = array[:, i::4]
+        np.right_shift(pixels, 2, out=packed[:, i::5], casting="unsafe")
+        low |= ((pixels & 3) << (6 - 2 * i)).astype(np.uint8)
+    return packed
+
+
+def unpack12(packed, out=None):
+    """ unpack rows of 12 bit pixel values, packed 2 pixels into 3 bytes as MIPI RAW12
+
+    The first 2 bytes of each group hold the high 8 bits of 2 pixels, the low nibble of the 3rd byte the
+    low 4 bits of the first pixel, its high nibble those of the second. Vectorized like unpack10().
+    :param packed: uint8 array (rows, 3*n), may be a view into a larger buffer
+    :param out: uint16 array (rows, 2*n) receiving the pixels. Allocated if None
+    :returns out
+    """
+    rows, cols = packed.shape
+    if out is None:
+        out = np.empty((rows, (cols * 2) // 3), dtype=np.uint16)
+    low = packed[:, 2::3]
+    lowBits = np.empty(low.shape, dtype=np.uint8)
+    for i in range(2):
+        pixels = out[:, i::2]
+        np.left_shift(packed[:, i::3], 4, out=pixels, dtype=np.uint16)
+        np.right_shift(low, 4 * i, out=lowBits)
+        lowBits &= 15
+        pixels |= lowBits
+    return out
+
+
+def pack12(array):
+    """ pack 12 bit pixel values 2 into 3 bytes, the inverse of unpack12()
+    :param array: uint16 array (rows, cols) with values 0..4095. If cols is odd, the rows are padded with 0
+    :returns uint8 array (rows, 3*ceil(cols/2))
+    """
+    rows, cols = array.shape
+    groups = (cols + 1) // 2
+    if cols != 2 * groups:
+        padded = np.zeros((rows, 2 * groups), dtype=array.dtype)
+        padded[:, :cols] = array
+        array = padded
+    packed = np.empty((rows, 3 * groups), dtype=np.uint8)
+    low = packed[:, 2::3]
+    low[...] = 0
+    for i in range(2):
+        pixels = array[:, i::2]
+        np.right_shift(pixels, 4, out=packed[:, i::3], casting="unsafe")
+        low |= ((pixels & 15) << (4 * i)).astype(np.uint8)
+    return packed
+
+
+BAYER_PACKINGS={10:{"pixels":4,"bytes":5,"unpack":unpack10,"pack":pack10},
+                12:{"pixels":2,"bytes":3,"unpack":unpack12,"pack":pack12}}
+""" packings of raw data by bits per pixel: number of pixels in a group of bytes, and the functions
+to unpack and pack them"""
+
+BRCM_HEADER_SIZE=32768
+""" size of the header of the BRCM block, the rows of the raw data follow"""
+
+BRCM_GEOMETRY=struct.Struct("<32s4H")
+""" part of the BRCM header at offset 176: sensor name, width, height, padding right and padding down in pixels"""
+
+BAYER_BUFFER_LAYOUTS={"RP_OV5647":{"tail":6404096,"rows":1952,"stride":3264,"shape":(1944,2592),"bits":10},
+                      "RP_imx219":{"tail":10270208,"rows":2480,"stride":4128,"shape":(2464,3280),"bits":10},
+                      "RP_imx477":{"tail":18711040,"rows":3056,"stride":6112,"shape":(3040,4056),"bits":12}}
+""" raw data appended by picamera for the V1, V2 and HQ camera: size of the BRCM block at the end of the
+buffer (header, then the rows), number of rows and bytes per row including padding, shape of the mosaic,
+bits per pixel. Blocks of these sizes are found without scanning the buffer"""
+
+def _bayerGeometry(buffer, offset):
+    """ returns geometry of the BRCM block at offset of buffer as in BAYER_BUFFER_LAYOUTS, read from its
+    header. None if there is no consistent block at offset, which must extend to the end of buffer
+    """
+    if buffer[offset:offset + 4] != b'BRCM' or offset + BRCM_HEADER_SIZE > len(buffer):
+        return None
+    name, width, height, paddingRight, paddingDown = BRCM_GEOMETRY.unpack_from(buffer, offset + 176)
+    rows = height + paddingDown
+    size = len(buffer) - offset - BRCM_HEADER_SIZE
+    if width == 0 or height == 0 or size % rows != 0:
+        return None
+    stride = size // rows
+    # the packing with the most bits per pixel whose rows fit into the stride
+    bits = [bits for bits, packing in BAYER_PACKINGS.items()
+            if width % packing["pixels"] == 0 and (width * packing["bytes"]) // packing["pixels"] <= stride]
+    if not bits:
+        return None
+    return {"tail": len(buffer) - offset, "rows": rows, "stride": stride, "shape": (height, width), "bits": max(bits),
+            "name": name.split(b'\0', 1)[0].decode("ascii", "replace")}
+
+
+def locateBayerData(buffer, chunkSize=1 << 20):
+    """ returns (offset,geometry) of the BRCM block at the end of buffer, see _bayerGeometry()
+
+    Blocks with the sizes of BAYER_BUFFER_LAYOUTS are found directly. If the header of such a block is not
+    consistent, the geometry of the table is used. Otherwise buffer is scanned for the header in chunks,
+    which also finds sensors not in the table.
+    :param buffer: JPEG+BRCM data, bytes or memoryview
+    :param chunkSize: bytes copied at a time while scanning
+    """
+    for layout in BAYER_BUFFER_LAYOUTS.values():
+        offset = len(buffer) - layout["tail"]
+        if offset >= 0 and buffer[offset:offset + 4] == b'BRCM':
+            geometry = _bayerGeometry(buffer, offset)
+            return (offset, geometry if geometry is not None else layout)
+    start = 0
+    while start < len(buffer):
+        chunk = bytes(buffer[start:start + chunkSize + 3])
+        position = chunk.find(b'BRCM')
+        while position >= 0:
+            geometry = _bayerGeometry(buffer, start + position)
+            if geometry is not None:
+                return (start + position, geometry)
+            position = chunk.find(b'BRCM', position + 1)
+        start += chunkSize
+    raise PiCameraValueError('Unable to locate Bayer data at end of buffer')
+
+
+def makeBayerBuffer(mosaic, sensor, jpegSize=500000):
+    """ returns bytearray as captured by picamera with bayer=True: JPEG data followed by the BRCM block
+    with mosaic packed as the sensor does. Used by the simulated camera and benchmarks
+    :param mosaic: uint16 array with the bits and shape of sensor
+    :param sensor: key of BAYER_BUFFER_LAYOUTS
+    :param jpegSize: number of bytes of the fake JPEG data
+    """
+    layout = BAYER_BUFFER_LAYOUTS[sensor]
+    if mosaic.shape != layout["shape"]:
+        raise ValueError("Mosaic of {!s} has shape {!s}, not {!s}".format(sensor, layout["shape"], mosaic.shape))
+    packing = BAYER_PACKINGS[layout["bits"]]
+    data = bytearray(jpegSize + layout["tail"])
+    data[:2] = b'\xff\xd8'
+    block = memoryview(data)[jpegSize:]
+    block[:4] = b'BRCM'
+    height, width = layout["shape"]
+    BRCM_GEOMETRY.pack_into(block, 176, sensor[3:].lower().encode("ascii"), width, height,
+                            (layout["stride"] * packing["pixels"]) // packing["bytes"] - width, layout["rows"] - height)
+    raw = np.frombuffer(block, dtype=np.uint8, offset=BRCM_HEADER_SIZE).reshape(layout["rows"], layout["stride"])
+    packed = packing["pack"](mosaic)
+    raw[:packed.shape[0], :packed.shape[1]] = packed
+    # release the views, data could not be resized otherwise
+    del raw, block
+    return data
+
+
+BINNING_FACTORS=(1,2,4)
+""" supported factors of binMosaic(), 1 for no binning"""
+
+def binMosaic(mosaic, factor, out=None):
+    """ Bayer preserving binning: each pixel of the result is the mean of factor x factor pixels of the same color,
+    rounded. The result is a mosaic with the same color pattern and bits, factor times smaller in both directions.
+    Cost: one pass over the mosaic, adding strided views of the rows and then of the columns of the cells
+    :param mosaic: uint16 mosaic, rows and columns multiples of 2*factor
+    :param factor: one of BINNING_FACTORS
+    :param out: contiguous uint16 array (rows/factor, cols/factor) for the result, allocated if None
+    :returns out
+    """
+    if factor not in BINNING_FACTORS:
+        raise ValueError("Unknown binning {!s}, choose one of {!s}".format(factor, BINNING_FACTORS))
+    rows, cols = mosaic.shape
+    if out is None:
+        out = np.empty((rows // factor, cols // factor), dtype=np.uint16)
+    if factor == 1:
+        out[...] = mosaic
+        return out
+    # axes: cell row, row within cell, color row, columns. ndarray.sum() over several axes of this view
+    # is about 10 times slower than adding the views explicitly
+    cellRows = mosaic.reshape(rows // (2 * factor), factor, 2, cols)
+    rowSums = cellRows[:, 0].astype(np.uint32)
+    for i in range(1, factor):
+        rowSums += cellRows[:, i]
+    # axes: cell row, color row, cell column, column within cell, color column
+    cells = rowSums.reshape(rows // (2 * factor), 2, cols // (2 * factor), factor, 2)
+    sums = cells[:, :, :, 0].copy()
+    for i in range(1, factor):
+        sums += cells[:, :, :, i]
+    shift = 2 * (factor.bit_length() - 1)
+    sums += 1 << (shift - 1)
+    np.right_shift(sums, shift, out=out.reshape(sums.shape), casting="unsafe")
+    return out
+
+
+def alignCrop(crop, shape, binning=1):
+    """ returns crop rectangle (x,y,width,height) of a mosaic of shape, aligned such that it keeps the color
+    pattern, starts at a group of packed pixels and can be binned: x is a multiple of 4, y even, width a
+    multiple of 4 and 2*binning, height a multiple of 2*binning. Clipped to shape. crop None is the full mosaic
+    """
+    if crop is None:
+        crop = (0, 0, shape[1], shape[0])
+    x, y, width, height = crop
+    x = min(max(0, x), shape[1]) & ~3
+    y = min(max(0, y), shape[0]) & ~1
+    columnStep = 4 if binning <= 2 else 2 * binning
+    width = (min(width, shape[1] - x) // columnStep) * columnStep
+    height = (min(height, shape[0] - y) // (2 * binning)) * (2 * binning)
+    if width <= 0 or height <= 0:
+        raise ValueError("Crop {!s} is empty for mosaic of shape {!s}".format(crop, shape))
+    return (x, y, width, height)
+
+
+def cropPacked(packed, bits, crop, binning=1):
+    """ returns view of packed rows with bits per pixel restricted to crop, see alignCrop()
+    """
+    packing = BAYER_PACKINGS[bits]
+    shape = (packed.shape[0], (packed.shape[1] * packing["pixels"]) // packing["bytes"])
+    x, y, width, height = alignCrop(crop, shape, binning)
+    return packed[y:y + height, (x * packing["bytes"]) // packing["pixels"]:
+                                ((x + width) * packing["bytes"]) // packing["pixels"]]
+
+
+def unpackMosaic(packed, bits, binning=1, allocate=None, chunkRows=64):
+    """ unpack packed rows with bits per pixel and bin them. Without binning, the pixels are unpacked directly
+    into the result. Otherwise chunks of chunkRows rows are unpacked into a small buffer and binned from there,
+    so there is no full frame temporary
+    :param packed: uint8 array with packed rows, e.g. from cropPacked(). Its size must fit binning
+    :param binning: one of BINNING_FACTORS
+    :param allocate: function(shape,dtype) returning the result array, e.g. FramePool.acquire. New array if None
+    :returns uint16 mosaic
+    """
+    packing = BAYER_PACKINGS[bits]
+    rows, cols = packed.shape[0], (packed.shape[1] * packing["pixels"]) // packing["bytes"]
+    shape = (rows // binning, cols // binning)
+    out = allocate(shape, np.uint16) if allocate is not None else np.empty(shape, dtype=np.uint16)
+    if binning == 1:
+        return packing["unpack"](packed, out)
+    chunkRows = max(1, chunkRows // (2 * binning)) * 2 * binning
+    buffer = np.empty((min(chunkRows, rows), cols), dtype=np.uint16)
+    for start in range(0, rows, chunkRows):
+        stop = min(rows, start + chunkRows)
+        chunk = packing["unpack"](packed[start:stop], buffer[:stop - start])
+        binMosaic(chunk, binning, out[start // binning:stop // binning])
+    return out
+
+
+RAW10_MAGIC=b"PIRAW10\0"
+""" start of raw10 files, followed by rows, cols and header length as little endian uint32"""
+
+def writeRaw10(filename, array, header=None):
+    """ write 10 bit frame to filename in the packed raw10 format:
+    magic, rows, cols, length of the JSON header, JSON header, packed pixels as in pack10()
+    :param header: dict with keywords, stored as JSON
+    """
+    headerBytes = json.dumps(header or {}).encode("utf-8")
+    with open(filename, "wb") as f:
+        f.write(RAW10_MAGIC)
+        f.write(struct.pack("<3I", array.shape[0], array.shape[1], len(headerBytes)))
+        f.write(headerBytes)
+        pack10(array).tofile(f)
+
+
+def readRaw10(filename):
+    """ read file written by writeRaw10()
+    :returns (array,header) with the uint16 pixels and the header dict
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(RAW10_MAGIC)) != RAW10_MAGIC:
+            raise ValueError("{!s} is not a raw10 file".format(filename))
+        rows, cols, headerLength = struct.unpack("<3I", f.read(12))
+        header = json.loads(f.read(headerLength).decode("utf-8"))
+        groups = (cols + 3) // 4
+        packed = np.fromfile(f, dtype=np.uint8, count=rows * 5 * groups).reshape(rows, 5 * groups)
+    return unpack10(packed)[:, :cols], header
+
+
+FITS_BLOCK = 2880
+""" FITS files consist of blocks of this many bytes, a header card has 80 characters"""
+
+def _fitsCard(key, value):
+    """ returns 80 character FITS header card for key and value, which may be bool, int, float or str
+    """
+    if isinstance(value, bool):
+        text = "{:>20s}".format("T" if value else "F")
+    elif isinstance(value, int):
+        text = "{:>20d}".format(value)
+    elif isinstance(value, float):
+        text = "{:.15G}".format(value)
+        # FITS reals need a decimal point
+        if "." not in text:
+            text = text.replace("E", ".E") if "E" in text else text + "."
+        text = "{:>20s}".format(text)
+    else:
+        text = "'{:8s}'".format(str(value).replace("'", "''"))
+    card = "{:8s}= {:s}".format(key, text)
+    if len(card) > 80:
+        raise ValueError("FITS keyword {!s} value too long: {!s}".format(key, value))
+    return card.ljust(80)
+
+
+def mapFits(filename, shape):
+    """ create FITS file for an uint16 image of shape and map it into memory, see finishMappedFits()
+
+    The frame can be written directly into the returned array, e.g. with unpack10(). It only exists in the
+    page cache, the kernel writes it back to the file.
+    :returns native endian uint16 array of shape, mapped to the data of the file
+    """
+    dataBytes = shape[0] * shape[1] * 2
+    size = FITS_BLOCK + -(-dataBytes // FITS_BLOCK) * FITS_BLOCK
+    mapped = np.memmap(filename, dtype=np.uint8, mode="w+", shape=(size,))
+    return mapped[FITS_BLOCK:FITS_BLOCK + dataBytes].view(np.uint16).reshape(shape)
+
 
+def finishMappedFits(filename, data, header=None):
+    """ complete FITS file created with mapFits(): convert data in place to FITS uint16 and write the header.
+    data must not be used afterwards
+
+    FITS stores big endian signed integers, uint16 is stored with BZERO 32768 as pyfits does. Flipping the sign
+    bit subtracts 32768. This is done in place, there is no copy of the frame.
+    :param header: dict with additional keywords, at most one header block
+    """
+    cards = [_fitsCard("SIMPLE", True), _fitsCard("BITPIX", 16), _fitsCard("NAXIS", 2),
+             _fitsCard("NAXIS1", data.shape[1]), _fitsCard("NAXIS2", data.shape[0]),
+             _fitsCard("BZERO", 32768), _fitsCard("BSCALE", 1)]
+    for key, value in (header or {}).items():
+        cards.append(_fitsCard(key, value))
+    cards.append("END".ljust(80))
+    if len(cards) * 80 > FITS_BLOCK:
+        raise ValueError("Too many FITS keywords for mapped file {!s}".format(filename))
+    data ^= 0x8000
+    if sys.byteorder == "little":
+        data.byteswap(True)
+    with open(filename, "r+b") as f:
+        f.write("".join(cards).ljust(FITS_BLOCK).encode("ascii"))
+
+
+#
+# Demosaic
+#
+# All algorithms take a RGGB mosaic (red at [0,0]) with even width and height and return
+# an uint16 RGB array. Mosaics with a different phase can be passed as flipped views.
+#
+def _output(out, shape):
+    """ returns out, or a new uint16 array of shape if out is None
+    """
+    if out is None:
+        return np.empty(shape, dtype=np.uint16)
+    if out.shape != shape:
+        raise ValueError("Output array has shape {!s}, expected {!s}".format(out.shape, shape))
+    return out
+
+
+def _interpolateCorner(plane, out):
+    """ bilinear interpolation of a color sampled at the [0::2,0::2] sites of a mosaic.
+    Averages are computed with separable shifts of the plane, edges are replicated.
+    :param plane: samples of the color, shape (rows/2, cols/2)
+    :param out: 2D view (rows, cols) receiving the full plane, same dtype as plane
+    """
+    out[0::2, 0::2] = plane
+    horizontal = out[0::2, 1::2]
+    np.add(plane[:, :-1], plane[:, 1:], out=horizontal[:, :-1])
+    horizontal[:, :-1] >>= 1
+    horizontal[:, -1] = plane[:, -1]
+    vertical = out[1::2, 0::2]
+    np.add(plane[:-1], plane[1:], out=vertical[:-1])
+    vertical[:-1] >>= 1
+    vertical[-1] = plane[-1]
+    diagonal = out[1::2, 1::2]
+    inner = diagonal[:-1, :-1]
+    np.add(plane[:-1, :-1], plane[:-1, 1:], out=inner)
+    inner += plane[1:, :-1]
+    inner += plane[1:, 1:]
+    inner >>= 2
+    diagonal[-1, :] = horizontal[-1, :]
+    diagonal[:, -1] = vertical[:, -1]
+
+
+def _greenCorner(mosaic, out):
+    """ bilinear green at the [0::2,0::2] sites of a mosaic, average of the 4 direct neighbours
+    :param mosaic: mosaic with green at [0::2,1::2] and [1::2,0::2]
+    :param out: 2D view of the green plane, same orientation as mosaic
+    """
+    green = out[0::2, 0::2]
+    right = mosaic[0::2, 1::2]
+    below = mosaic[1::2, 0::2]
+    np.add(right[:, :-1], right[:, 1:], out=green[:, 1:])
+    np.left_shift(right[:, 0], 1, out=green[:, 0])
+    green[1:] += below[:-1]
+    green[0] += below[0]
+    green += below
+    green >>= 2
+
+
+def _shifted(plane, axis, step):
+    """ returns int16 copy of plane shifted by step (+1/-1) along axis, edges replicated
+    """
+    result = np.empty(plane.shape, dtype=np.int16)
+    if axis == 0:
+        if step > 0:
+            result[1:], result[0] = plane[:-1], plane[0]
+        else:
+            result[:-1], result[-1] = plane[1:], plane[-1]
+    else:
+        if step > 0:
+            result[:, 1:], result[:, 0] = plane[:, :-1], plane[:, 0]
+        else:
+            result[:, :-1], result[:, -1] = plane[:, 1:], plane[:, -1]
+    return result
+
+
+def _greenCornerEdgeAware(mosaic, out, maxValue):
+    """ Hamilton-Adams green at the [0::2,0::2] sites: interpolate along the direction with
+    the smaller gradient, corrected by the laplacian of the site color.
+    :param mosaic: mosaic with green at [0::2,1::2] and [1::2,0::2]
+    :param out: 2D view of the green plane, same orientation as mosaic
+    :param maxValue: maximum pixel value
+    """
+    site = mosaic[0::2, 0::2].astype(np.int16)
+    estimates = []
+    gradients = []
+    for axis, neighbours in ((1, mosaic[0::2, 1::2]), (0, mosaic[1::2, 0::2])):
+        before = _shifted(neighbours, axis, 1)
+        after = neighbours.astype(np.int16)
+        laplace = 2 * site - _shifted(site, axis, 1) - _shifted(site, axis, -1)
+        gradient = np.abs(before - after)
+        gradient += np.abs(laplace)
+        estimate = before + after
+        estimate <<= 1
+        estimate += laplace
+        del before, after, laplace
+        estimates.append(estimate)
+        gradients.append(gradient)
+    (estimateH, estimateV), (gradientH, gradientV) = estimates, gradients
+    # floor of the mean without the sum, which overflows int16 for 12 bit data
+    mean = estimateH >> 1
+    mean += estimateV >> 1
+    mean += estimateH & estimateV & 1
+    green = np.where(gradientH < gradientV, estimateH, np.where(gradientV < gradientH, estimateV, mean))
+    green >>= 2
+    np.clip(green, 0, maxValue, out=green)
+    out[0::2, 0::2] = green
+
+
+def demosaicSuperpixel(mosaic, out=None):
+    """ one RGB pixel per 2x2 Bayer cell, green is the mean of both greens.
+
+    Cost: a single pass over the mosaic, output has half the resolution. Good for previews.
+    :param mosaic: RGGB mosaic
+    :param out: uint16 array (rows/2, cols/2, 3) for the result, allocated if None
+    :returns uint16 RGB array (rows/2, cols/2, 3)
+    """
+    rows, cols = mosaic.shape
+    rgb = _output(out, (rows // 2, cols // 2, 3))
+    rgb[:, :, 0] = mosaic[0::2, 0::2]
+    green = rgb[:, :, 1]
+    np.add(mosaic[0::2, 1::2], mosaic[1::2, 0::2], out=green)
+    green >>= 1
+    rgb[:, :, 2] = mosaic[1::2, 1::2]
+    return rgb
+
+
+def demosaicBilinear(mosaic, out=None):
+    """ bilinear interpolation of each color, computed with separable shifts of the four
+    Bayer planes and written directly into the result.
+
+    Cost: a few passes over the mosaic without temporaries, roughly 10 times faster
+    than the reference algorithm
+    :param mosaic: RGGB mosaic
+    :param out: uint16 array (rows, cols, 3) for the result, allocated if None
+    :returns uint16 RGB array of the same resolution
+    """
+    rows, cols = mosaic.shape
+    rgb = _output(out, (rows, cols, 3))
+    flipped = mosaic[::-1, ::-1]  # blue at [0,0]
+    _interpolateCorner(mosaic[0::2, 0::2], rgb[:, :, 0])
+    _interpolateCorner(flipped[0::2, 0::2], rgb[::-1, ::-1, 2])
+    green = rgb[:, :, 1]
+    green[0::2, 1::2] = mosaic[0::2, 1::2]
+    green[1::2, 0::2] = mosaic[1::2, 0::2]
+    _greenCorner(mosaic, green)
+    _greenCorner(flipped, green[::-1, ::-1])
+    return rgb
+
+
+def demosaicEdgeAware(mosaic, out=None, bits=10):
+    """ edge aware interpolation: Hamilton-Adams green, red and blue by bilinear interpolation
+    of the color difference to green. Avoids most of the zipper and color fringe artifacts of
+    the bilinear algorithm.
+
+    Cost: about twice the bilinear algorithm, and int16 temporaries of about twice the frame size.
+    :param mosaic: RGGB mosaic
+    :param out: uint16 array (rows, cols, 3) for the result, allocated if None
+    :param bits: bits per pixel of the mosaic
+    :returns uint16 RGB array of the same resolution
+    """
+    maxValue = (1 << bits) - 1
+    rows, cols = mosaic.shape
+    rgb = _output(out, (rows, cols, 3))
+    flipped = mosaic[::-1, ::-1]  # blue at [0,0]
+    green = rgb[:, :, 1]
+    green[0::2, 1::2] = mosaic[0::2, 1::2]
+    green[1::2, 0::2] = mosaic[1::2, 0::2]
+    _greenCornerEdgeAware(mosaic, green, maxValue)
+    _greenCornerEdgeAware(flipped, green[::-1, ::-1], maxValue)
+    difference = np.empty((rows, cols), dtype=np.int16)
+    samples = np.empty((rows // 2, cols // 2), dtype=np.int16)
+    for channel, view in ((0, mosaic), (2, flipped)):
+        outView = rgb if channel == 0 else rgb[::-1, ::-1]
+        greenView = outView[:, :, 1]
+        np.subtract(view[0::2, 0::2], greenView[0::2, 0::2], out=samples, dtype=np.int16)
+        differenceView = difference if channel == 0 else difference[::-1, ::-1]
+        _interpolateCorner(samples, differenceView)
+        difference += green
+        np.clip(difference, 0, maxValue, out=difference)
+        rgb[:, :, channel] = difference
+    return rgb
+
+
+def previewShape(shape, size):
+    """ returns shape (rows, cols, 3) of the preview of a mosaic of shape, see previewFromMosaic()
+    """
+    step = 2 * max(1, shape[0] // (2 * size))
+    return (shape[0] // step, shape[1] // step, 3)
+
+
+def previewFromMosaic(mosaic, size, out=None):
+    """ low resolution RGB preview computed directly from the mosaic
+
+    Each preview pixel is made from one 2x2 Bayer cell, the cells are picked with a stride such that
+    the preview has about size rows. Costs milliseconds, compared to seconds for a full resolution demosaic.
+    :param mosaic: RGGB mosaic as delivered by RawCamera.capture(False)
+    :param size: approximate number of rows of the preview
+    :param out: array returned by a previous call or of previewShape(), reused if it has the right shape
+    :returns uint16 RGB array, in the orientation of the camera without h/vflip
+    """
+    rows, cols = previewShape(mosaic.shape, size)[:2]
+    step = 2 * max(1, mosaic.shape[0] // (2 * size))
+    if out is not None and out.shape == (rows, cols, 3):
+        rgb = out[::-1, ::-1]
+    else:
+        rgb = np.empty((rows, cols, 3), dtype=np.uint16)
+    rgb[:, :, 0] = mosaic[0::step, 0::step][:rows, :cols]
+    green = rgb[:, :, 1]
+    np.add(mosaic[0::step, 1::step][:rows, :cols], mosaic[1::step, 0::step][:rows, :cols], out=green)
+    green >>= 1
+    rgb[:, :, 2] = mosaic[1::step, 1::step][:rows, :cols]
+    # RawCamera.capture(False) returns the mosaic rotated by 180 degrees
+    return rgb[::-1, ::-1]
+
+
+DEMOSAIC_ALGORITHMS = {"superpixel": demosaicSuperpixel,
+                       "bilinear": demosaicBilinear,
+                       "edge": demosaicEdgeAware,
+                       "reference": PiBayerFlatArray.demosaicReference}
+""" available demosaic algorithms, ordered by increasing quality. See the functions for their cost"""
+DEFAULT_DEMOSAIC = "bilinear"
+""" algorithm used if none is chosen explicitly"""
+
+
+class SimulatedPiCamera:
+    """ simulation of picamera.PiCamera, as far as used by RawCamera
+
+    Permits to run and profile the capture pipeline without RaspberryPi and camera. Times are
+    simulated with sleep:
+    - opening the camera takes openSecs
+    - a capture takes settleFrames frames at the current framerate plus the exposure, because
+      the camera runs through several frames until exposure and gains are settled. This gives the
+      75 seconds for a 10 second exposure at framerate 1/10, see RawCamera.shutter_speed
+    The raw frames show a static sky with stars: signal proportional to exposure time and gain, with
+    shot noise, read noise, hot pixels and saturation. They are delivered as JPEG+BRCM buffer, like
+    the real camera does.
+    """
+
+    SENSORS=sorted(BAYER_BUFFER_LAYOUTS)
+    """ simulated sensors, keys of BAYER_BUFFER_LAYOUTS"""
+
+    timeScale=1.0
+    """ factor for all simulated times, e.g. 0.01 for 100 times faster runs"""
+
+    def __init__(self,sensor="RP_imx219",seed=None):
+        """ open simulated camera
+        :param sensor: one of SENSORS
+        :param seed: seed of the noise, random if None
+        """
+        self.exif_tags={'IFD0.Model':sensor}
+        """ as picamera, only the sensor type"""
+        self.MAX_RESOLUTION=tuple(reversed(BAYER_BUFFER_LAYOUTS[sensor]["shape"]))
+        """ as picamera, (width,height) of the sensor"""
+        self.sensor=sensor
+        """ sensor type, one of SENSORS"""
+        self.openSecs=2.0
+        """ time needed to open the camera"""
+        self.settleFrames=6
+        """ number of frames needed by a capture in addition to the exposure"""
+        self.electronsPerSecond=20.0
+        """ signal of the brightest sky pixels in electrons per second at analog gain 1"""
+        self.readNoise=3.0
+        """ read noise in electrons"""
+        self.hotPixelFraction=0.0005
+        """ fraction of pixels that are hot"""
+        self.hotPixelRate=50.0
+        """ dark signal of hot pixels in raw units per second"""
+        self.blackLevel=RawCamera.CAMERA_CAPABIILITES[sensor]["black_level"]
+        """ raw value of black pixels"""
+        self.maxValue=(1<<BAYER_BUFFER_LAYOUTS[sensor]["bits"])-1
+        """ raw value of saturated pixels"""
+        self.numNoiseFrames=4
+        """ number of different noise realizations per setting. They are computed once and then repeated,
+        so that computing the simulation does not dominate the measured times"""
+        self._buffers={}
+        """ (exposure,gain,flipped) -> list of buffers with frames for these settings"""
+        self._numFrames={}
+        """ (exposure,gain,flipped) -> number of frames delivered for these settings"""
+        self.framerate=fractions.Fraction(30,1)
+        self.shutter_speed=0
+        self.iso=100
+        self.analog_gain=1.0
+        self.awb_mode="auto"
+        self.awb_gains=(1,1)
+        self.hflip=False
+        self.vflip=False
+        self._closed=False
+        self._random=np.random.RandomState(seed)
+        shape=BAYER_BUFFER_LAYOUTS[sensor]["shape"]
+        self._sky=self._makeSky(shape)
+        """ relative brightness of each pixel in the flipped (RGGB) orientation"""
+        self._hotPixels=self._random.randint(0,self._sky.size,int(self.hotPixelFraction*self._sky.size))
+        """ flat indices of hot pixels"""
+        self._sleep(self.openSecs)
+
+    def _makeSky(self,shape):
+        """ returns float32 relative brightness 0..1 of a sky with gradient, stars and Bayer color response
+        """
+        sky=np.empty(shape,dtype=np.float32)
+        sky[...]=0.05+0.1*np.arange(shape[0])[:,np.newaxis]/shape[0]
+        stars=self._random.randint(0,sky.size,2000)
+        sky.flat[stars]+=self._random.exponential(0.3,stars.size).astype(np.float32)
+        # red, green and blue response of the RGGB mosaic
+        sky[0::2,0::2]*=0.5
+        sky[1::2,1::2]*=0.4
+        return np.minimum(sky,1.0,out=sky)
+
+    def _sleep(self,secs):
+        """ sleep for simulated secs
+        """
+        time.sleep(secs*self.timeScale)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed=True
+
+    @property
+    def exposure_speed(self):
+        return self.shutter_speed
+
+    def capture(self,output,format='jpeg',bayer=False):
+        """ simulate capture with bayer=True: write JPEG+BRCM buffer to output and flush it
+        """
+        if self._closed:
+            raise PiCameraError("Camera is closed")
+        if format!='jpeg' or not bayer:
+            raise PiCameraValueError("Simulated camera only supports format jpeg with bayer=True")
+        exposureSecs=self.shutter_speed/1000000
+        self._sleep(self.settleFrames/float(self.framerate)+exposureSecs)
+        output.write(self._buffer(exposureSecs))
+        output.flush()
+
+    def capture_continuous(self,output,format='jpeg',use_video_port=False,burst=False,bayer=False):
+        """ generator simulating continuous captures into output. Yields output after each frame
+
+        Only the first frame needs settleFrames. With burst, the next frames follow after one frame
+        time or the exposure, whichever is longer. Without burst, each frame is a complete capture.
+        """
+        if format!='jpeg' or not bayer:
+            raise PiCameraValueError("Simulated camera only supports format jpeg with bayer=True")
+        bFirst=True
+        while True:
+            if self._closed:
+                raise PiCameraError("Camera is closed")
+            exposureSecs=self.shutter_speed/1000000
+            frameSecs=max(exposureSecs,1/float(self.framerate))
+            self._sleep(self.settleFrames/float(self.framerate)+exposureSecs if bFirst or not burst else frameSecs)
+            bFirst=False
+            output.write(self._buffer(exposureSecs))
+            output.flush()
+            yield output
+
+    def _buffer(self,exposureSecs):
+        """ returns JPEG+BRCM buffer with a frame for exposureSecs and the current settings
+        """
+        key=(exposureSecs,self.analog_gain*self.iso,self.hflip and self.vflip)
+        buffers=self._buffers.setdefault(key,[])
+        # cycle through the realizations of each setting, the first ones are returned as they are computed
+        index=self._numFrames.get(key,0)%self.numNoiseFrames
+        self._numFrames[key]=index+1
+        if index==len(buffers):
+            buffers.append(makeBayerBuffer(self._rawFrame(exposureSecs),self.sensor))
+        return buffers[index]
+
+    def _rawFrame(self,exposureSecs):
+        """ returns uint16 mosaic for an exposure of exposureSecs, oriented according to hflip and vflip
+        """
+        gain=self.analog_gain*self.iso/100
+        electrons=self._sky*(self.electronsPerSecond*exposureSecs)
+        # shot noise and read noise, gaussian approximation
+        noise=self._random.standard_normal(electrons.shape).astype(np.float32)
+        noise*=np.sqrt(electrons+self.readNoise**2)
+        electrons+=noise
+        electrons*=gain
+        electrons.flat[self._hotPixels]+=self.hotPixelRate*exposureSecs
+        electrons+=self.blackLevel
+        mosaic=np.clip(electrons,0,self.maxValue,out=electrons).astype(np.uint16)
+        if not (self.hflip and self.vflip):
+            # without flip, the sensor delivers BGGR
+            mosaic=np.ascontiguousarray(mosaic[::-1,::-1])
+        return mosaic
 
 # Patching this because default 30 is too short
-picamera.PiCamera.CAPTURE_TIMEOUT=80
+if picamera is not None:
+    picamera.PiCamera.CAPTURE_TIMEOUT=80
 class RawCamera:
     """ Raw camera class
 
@@ -872,23 +2795,55 @@ class RawCamera:
     CAMERA_CAPABIILITES={"RP_imx219":{"max_resolution":(3280,2464),
                                       "min_framerate":fractions.Fraction(1,10),
                                       "max_framerate":fractions.Fraction(120,1), #determined empirically, higher cause error
+                                      "min_shutter":10,
                                       "max_shutter":10*1000000,
+                                      "black_level":64,
+                                      "bits":10,
                                       "max_mode":3},
-                         "RP_OV5647":{"max_resolution:":(2592,1944),
+                         "RP_OV5647":{"max_resolution":(2592,1944),
                                       "min_framerate":fractions.Fraction(1,6),
                                       "max_framerate":fractions.Fraction(120,1), #not yet tested
-                                      "max_shutter=":6*1000000,
+                                      "min_shutter":10,
+                                      "max_shutter":6*1000000,
+                                      "black_level":16,
+                                      "bits":10,
+                                      "max_mode":3},
+                         "RP_imx477":{"max_resolution":(4056,3040),
+                                      "min_framerate":fractions.Fraction(1,200),
+                                      "max_framerate":fractions.Fraction(40,1), #not yet tested
+                                      "min_shutter":10,
+                                      "max_shutter":200*1000000,
+                                      "black_level":256,
+                                      "bits":12,
                                       "max_mode":3}
                          }
-    """ capabilities of sensors. Framerate is in 1/s, shutter in microsecond
+    """ capabilities of sensors. Framerate is in 1/s, shutter in microsecond, black level in raw values,
+    bits per raw value as in BAYER_PACKINGS
     """
 
+    CAMERA_BACKENDS={"picamera":lambda: picamera.PiCamera(),
+                     "simulated":SimulatedPiCamera}
+    """ functions returning an open camera: the real one, or a simulation for tests and benchmarks without Pi"""
+
+    backend="picamera"
+    """ key of CAMERA_BACKENDS used by new RawCameras"""
+
     def __init__(self):
         """ Initializes camera
 
         needs minimum of 2 seconds
         """
-        self._camera=picamera.PiCamera()
+        if self.backend=="picamera" and picamera is None:
+            raise RuntimeError("picamera is not installed, only the simulated camera can be used")
+        self._camera=self.CAMERA_BACKENDS[self.backend]()
+        try:
+            self._sensorType,self._capabilities=capabilityService.lookup(self._camera)
+            """ sensor type and its entry of CAMERA_CAPABIILITES, see CapabilityService"""
+        except ValueError:
+            self.close()
+            raise
+        self._settings={}
+        """ values last applied to the camera by the setters, used to skip unchanged settings"""
         self.iso=800
         self.awb_mode="off"
         self.awb_gains=(1,1)
@@ -896,10 +2851,21 @@ class RawCamera:
     def __repr__(self):
         """ return repr string
         """
-        if self.closed():
+        if self.closed:
             return "RawCamera: Camera=None"
         else:
-            return "RawCamera: Camera={!s}, exposure_speed={!s}".format(self.camera,self.exposure_speed)
+            return "RawCamera: Camera={!s}, exposure_speed={!s}".format(self._camera,self.exposure_speed)
+
+    def _setCameraAttr(self,name,value):
+        """ set attribute name of the camera to value, unless this value has already been applied
+
+        Changing settings of a running camera is slow, so a persistent camera should only get
+        the settings that actually changed.
+        """
+        if name in self._settings and self._settings[name]==value:
+            return
+        setattr(self._camera,name,value)
+        self._settings[name]=value
 
     #
     # Context manager
@@ -931,7 +2897,7 @@ class RawCamera:
 
         Most calls on self are illegal once the camera has been closed
         """
-        return self._camera is None or self._camera.closed()
+        return self._camera is None or self._camera.closed
 
     @property
     def exposure_speed(self):
@@ -951,6 +2917,8 @@ class RawCamera:
         """ set shutter speed in microseconds
         """
         #print("shutter_speed=",microseconds,type(microseconds))
+        if self._settings.get("shutter_speed")==microseconds:
+            return
         # set framerate as neeeded
         # The time needed for capture is strongly influenced by framerate. Therefore
         # set quickest framerate possible.
@@ -958,11 +2926,11 @@ class RawCamera:
         if shutterSecs>=1.0:
             framerate=fractions.Fraction(1,math.ceil(shutterSecs))
         else:
-            maxFramerate=self.CAMERA_CAPABIILITES[self.sensor_type]["max_framerate"]
+            maxFramerate=self.capabilities["max_framerate"]
             framerate=min(maxFramerate,fractions.Fraction(math.floor(1/shutterSecs),1))
         #print("framerate=",framerate)
-        self._camera.framerate=framerate
-        self._camera.shutter_speed=microseconds
+        self._setCameraAttr("framerate",framerate)
+        self._setCameraAttr("shutter_speed",microseconds)
 
     @property
     def analog_gain(self):
@@ -973,7 +2941,7 @@ class RawCamera:
     def analog_gain(self,val):
         """set analog gain
         """
-        self._camera.analog_gain=val
+        self._setCameraAttr("analog_gain",val)
 
     @property
     def awb_mode(self):
@@ -984,7 +2952,7 @@ class RawCamera:
     def awb_mode(self,val):
         """ set awb_mode
         """
-        self._camera.awb_mode=val
+        self._setCameraAttr("awb_mode",val)
 
     @property
     def awb_gains(self):
@@ -995,7 +2963,7 @@ class RawCamera:
     def awb_gains(self,values):
         """ set awb_gains (pair of values
         """
-        self._camera.awb_gains=values
+        self._setCameraAttr("awb_gains",values)
 
     @property
     def iso(self):
@@ -1006,38 +2974,246 @@ class RawCamera:
     def iso(self,val):
         """ set iso to value
         """
-        self._camera.iso=val
-
-    def capture(self,bDemosaic=True):
-        """ capture an image, returns numpy arrays with (raw,debayer), with debayer only filled if bDemosaic=True
-        @param bDemosaic: if True, return demosaiced RGB array. Otherwise: Flat RGGB array
-        """
-        #print("Capture()")
-        now=datetime.datetime.now()
-        with PiBayerFlatArray(self._camera) as output:
-            if not bDemosaic:
-                # returns array with RGGB mosaic when saved to FITS
-                self._camera.hflip = True
-                self._camera.vflip = True
-            #print("RawCamera:__capture__() init bayer=%s secs" % (datetime.datetime.now() - now))
-            # print("In With")
-            self._camera.capture(output, 'jpeg', bayer=True)
-            #print("RawCamera:__capture__() capture bayer=%s secs" % (datetime.datetime.now() - now))
-            # print("Capture done")
+        self._setCameraAttr("iso",val)
+
+    def capture(self,bDemosaic=True,allocate=None,bPacked=False,crop=None,binning=1):
+        """ capture an image, returns numpy arrays with (raw,debayer), with debayer only filled if bDemosaic is set
+        @param bDemosaic: if True, return RGB array demosaiced with DEFAULT_DEMOSAIC, if the name of one
+               of DEMOSAIC_ALGORITHMS, use this algorithm. Otherwise: Flat RGGB array
+        @param allocate: function(shape,dtype) providing the arrays for raw and debayer, e.g. FramePool.acquire.
+               New arrays if None
+        @param bPacked: if True, raw is the uint8 array of packed rows, see BAYER_PACKINGS. Needs bDemosaic False
+        @param crop: (x,y,width,height) of the part of the flat RGGB array that is kept, see alignCrop(). Needs
+               bDemosaic False
+        @param binning: one of BINNING_FACTORS, see binMosaic(). Needs bDemosaic False. With bPacked, only the
+               size of crop is aligned, binning is left to unpackMosaic()
+        """
+        if bDemosaic is True:
+            bDemosaic=DEFAULT_DEMOSAIC
+        if bDemosaic and bDemosaic not in DEMOSAIC_ALGORITHMS:
+            raise ValueError("Unknown demosaic algorithm {!s}, choose one of {!s}".format(bDemosaic,
+                                                                                       sorted(DEMOSAIC_ALGORITHMS)))
+        if bDemosaic and bPacked:
+            raise ValueError("Packed raw data can not be demosaiced")
+        if bDemosaic and (crop is not None or binning!=1):
+            raise ValueError("Crop and binning are only supported for flat raw data")
+        with PiBayerFlatArray(self._camera,allocate,bPacked,crop,binning) as output:
+            # flipped returns array with RGGB mosaic when saved to FITS. Set explicitly, because
+            # the camera may be reused from a previous capture
+            self._setCameraAttr("hflip",not bDemosaic)
+            self._setCameraAttr("vflip",not bDemosaic)
+            # stages bayer and unpack are recorded within, in output.flush()
+            with timer.stage("exposure"):
+                self._camera.capture(output, 'jpeg', bayer=True)
             raw=output.array
             if bDemosaic:
-                debayer = output.demosaic()
+                debayer = output.demosaic(bDemosaic)
                 raw=raw[::-1,::-1] #because of h/Hflip
             else:
                 debayer=None
-        #print("RawCamera:__capture__() exit=%s secs"%(datetime.datetime.now()-now))
         return (raw,debayer)
 
+    def captureBurst(self,numFrames,allocate=None,bPacked=False,crop=None,binning=1):
+        """ generator capturing numFrames raw images in a row, yields (raw,captureTime) for each
+
+        The sensor keeps streaming between the frames (capture_continuous with burst=True), so the
+        frames come at the rate of the sensor instead of paying the setup of a full still capture
+        for each. Meant for sub-second exposures, e.g. meteors, lightning or the moon. The settings
+        can not be changed during the burst.
+        @param numFrames: number of frames
+        @param allocate: as for capture(), called for each frame. Each raw array stays valid after
+               the next frame has been captured
+        @param bPacked, crop, binning: as for capture()
+        raw is a flat RGGB array as with capture(False), captureTime the UTC datetime of the start of its exposure
+        """
+        if numFrames<=0:
+            return
+        exposure=datetime.timedelta(microseconds=self.shutter_speed)
+        with PiBayerFlatArray(self._camera,allocate,bPacked,crop,binning) as output:
+            self._setCameraAttr("hflip",True)
+            self._setCameraAttr("vflip",True)
+            frames=self._camera.capture_continuous(output,'jpeg',burst=True,bayer=True)
+            try:
+                for i in range(numFrames):
+                    # picamera flushes the output at the end of each frame, flush() decodes it
+                    with timer.stage("exposure"):
+                        next(frames)
+                    raw=output.array
+                    # the next frame is written from the start of the stream
+                    output.seek(0)
+                    output.truncate()
+                    yield (raw,datetime.datetime.utcnow()-exposure)
+            finally:
+                frames.close()
+
+    @property
+    def capabilities(self):
+        """ return entry of CAMERA_CAPABIILITES for this camera, validated when the camera was opened
+        """
+        return self._capabilities
+
     @property
     def sensor_type(self):
-        """ return sensor type of camera
+        """ return sensor type of camera, as read when it was opened
+        """
+        return self._sensorType
+
+class CapabilityService:
+    """ capabilities of the connected sensor, validated once and cached in a JSON file
+
+    The first time a sensor type is seen, it is probed: its entry of RawCamera.CAMERA_CAPABIILITES is checked
+    against CAPABILITY_SCHEMA, for malformed keys, types and limits, and the resolution reported by the camera
+    is compared with it. The result is kept in memory and written to cacheFile, so later sessions only load the
+    file. RawCamera gets the capabilities once when it is opened, its setters use them from memory. Each cached
+    entry carries a digest of the table entry it was made from, entries of a changed table are probed again.
+    A cache written by another version of piRaw, or one that does not validate, is ignored.
+    """
+
+    CAPABILITY_SCHEMA={"max_resolution":tuple,
+                       "min_framerate":fractions.Fraction,
+                       "max_framerate":fractions.Fraction,
+                       "min_shutter":int,
+                       "max_shutter":int,
+                       "black_level":int,
+                       "bits":int,
+                       "max_mode":int}
+    """ key -> type of each capability. max_resolution is (width,height). Fractions are stored as "num/den" """
+
+    def __init__(self,cacheFile=None):
+        """ initialize service. The cache is loaded when the first camera is looked up
+        :param cacheFile: path of the JSON cache, None for no cache
+        """
+        self.cacheFile=cacheFile
+        """ path of the cache file, None if not cached"""
+        self._capabilities=None
+        """ sensor type -> validated capabilities, None until the cache has been loaded"""
+        self._lock=threading.Lock()
+
+    @classmethod
+    def validate(cls,sensor,capabilities):
+        """ returns capabilities of sensor with the types of CAPABILITY_SCHEMA. Raises ValueError if they are invalid
         """
-        return self._camera.exif_tags['IFD0.Model']
+        missing=set(cls.CAPABILITY_SCHEMA)-set(capabilities)
+        unknown=set(capabilities)-set(cls.CAPABILITY_SCHEMA)
+        if missing or unknown:
+            raise ValueError("Capabilities of {!s}: missing keys {!s}, unknown keys {!s}".format(
+                sensor,sorted(missing),sorted(unknown)))
+        result={}
+        for key,valueType in cls.CAPABILITY_SCHEMA.items():
+            value=capabilities[key]
+            if valueType is tuple:
+                bValid=len(value)==2 and all(isinstance(v,int) and v>0 for v in value)
+                value=tuple(value)
+            elif valueType is fractions.Fraction:
+                bValid=isinstance(value,(fractions.Fraction,int)) and value>0
+                value=fractions.Fraction(value)
+            else:
+                bValid=isinstance(value,int) and not isinstance(value,bool) and value>=0
+            if not bValid:
+                raise ValueError("Capabilities of {!s}: invalid {!s} {!r}".format(sensor,key,value))
+            result[key]=value
+        if result["min_framerate"]>result["max_framerate"] or result["min_shutter"]>result["max_shutter"]:
+            raise ValueError("Capabilities of {!s}: minimum above maximum".format(sensor))
+        if result["bits"] not in BAYER_PACKINGS or result["black_level"]>=1<<result["bits"]:
+            raise ValueError("Capabilities of {!s}: invalid bits {:d} or black_level {:d}".format(
+                sensor,result["bits"],result["black_level"]))
+        if sensor in BAYER_BUFFER_LAYOUTS and \
+                tuple(reversed(BAYER_BUFFER_LAYOUTS[sensor]["shape"]))!=result["max_resolution"]:
+            raise ValueError("Capabilities of {!s}: max_resolution {!s} does not match BAYER_BUFFER_LAYOUTS".format(
+                sensor,result["max_resolution"]))
+        return result
+
+    def lookup(self,camera):
+        """ returns (sensor type,capabilities) of camera, an open picamera.PiCamera or SimulatedPiCamera.
+        Raises ValueError for unknown sensors
+        """
+        sensor=camera.exif_tags['IFD0.Model']
+        with self._lock:
+            if self._capabilities is None:
+                self._capabilities=self._load()
+            if sensor not in self._capabilities:
+                self._capabilities[sensor]=self._probe(camera,sensor)
+                self._save()
+            return (sensor,self._capabilities[sensor])
+
+    def _probe(self,camera,sensor):
+        """ returns validated capabilities of sensor, checked against the resolution reported by camera
+        """
+        if sensor not in RawCamera.CAMERA_CAPABIILITES:
+            raise ValueError("Unknown sensor {!s}, known are {!s}".format(sensor,sorted(RawCamera.CAMERA_CAPABIILITES)))
+        capabilities=self.validate(sensor,RawCamera.CAMERA_CAPABIILITES[sensor])
+        resolution=getattr(camera,"MAX_RESOLUTION",None)
+        if resolution is not None and tuple(resolution)!=capabilities["max_resolution"]:
+            raise ValueError("Sensor {!s} reports resolution {!s}, expected {!s}".format(
+                sensor,tuple(resolution),capabilities["max_resolution"]))
+        print("Capabilities of",sensor,"probed")
+        return capabilities
+
+    @staticmethod
+    def _toJson(capabilities):
+        """ returns capabilities with the values as stored in JSON
+        """
+        return {key:(str(value) if isinstance(value,fractions.Fraction) else value)
+                for key,value in capabilities.items()}
+
+    @classmethod
+    def _tableDigest(cls,sensor):
+        """ returns digest of the entry of sensor in RawCamera.CAMERA_CAPABIILITES, None if there is none
+        """
+        if sensor not in RawCamera.CAMERA_CAPABIILITES:
+            return None
+        table=json.dumps(cls._toJson(RawCamera.CAMERA_CAPABIILITES[sensor]),sort_keys=True)
+        return hashlib.sha1(table.encode()).hexdigest()
+
+    def _load(self):
+        """ returns sensor type -> capabilities from the cache file, empty if there is none or it is invalid.
+        Entries made from another table entry are left out
+        """
+        if self.cacheFile is None or not os.path.exists(self.cacheFile):
+            return {}
+        try:
+            with open(self.cacheFile) as f:
+                cache=json.load(f)
+            if cache.get("version")!=__version__:
+                raise ValueError("written by version {!s}".format(cache.get("version")))
+            result={}
+            for sensor,entry in cache["sensors"].items():
+                if entry["table"]!=self._tableDigest(sensor):
+                    print("Capabilities of",sensor,"changed since they were cached")
+                    continue
+                result[sensor]=self.validate(sensor,{key:(fractions.Fraction(value)
+                                                          if self.CAPABILITY_SCHEMA.get(key) is fractions.Fraction
+                                                          else value)
+                                                     for key,value in entry["capabilities"].items()})
+            return result
+        except (OSError,ValueError,KeyError,TypeError,AttributeError) as e:
+            print("Ignoring capability cache",self.cacheFile,":",e)
+            return {}
+
+    def _save(self):
+        """ write the capabilities to the cache file. Failures are only printed, the cache is optional
+        """
+        if self.cacheFile is None:
+            return
+        cache={"version":__version__,
+               "sensors":{sensor:{"table":self._tableDigest(sensor),"capabilities":self._toJson(capabilities)}
+                          for sensor,capabilities in self._capabilities.items()}}
+        try:
+            directory=os.path.dirname(os.path.abspath(self.cacheFile))
+            os.makedirs(directory,exist_ok=True)
+            # write completely before replacing, another session may read the file at the same time
+            temporaryFile=self.cacheFile+".tmp"
+            with open(temporaryFile,"w") as f:
+                json.dump(cache,f,indent=1,sort_keys=True)
+            os.replace(temporaryFile,self.cacheFile)
+        except OSError as e:
+            print("Can not write capability cache",self.cacheFile,":",e)
+
+DEFAULT_CAPABILITY_CACHE=os.path.join(os.path.expanduser("~"),".piRaw","capabilities.json")
+""" default cache file of capabilityService"""
+
+capabilityService=CapabilityService(DEFAULT_CAPABILITY_CACHE)
+""" capabilities of the sensors, used by all RawCameras"""
 
 class EvalArgs:
     """evaluates the command line. Provides --help.  See property methods for the results.
@@ -1054,41 +3230,233 @@ class EvalArgs:
             description="%(prog)s permits to take RAW photos using a RaspberryPi"
         )
 
+        # headless capture run
+        parser.add_argument("--headless", action="store_true",
+                            help="capture run without GUI, controlled by the options below.")
+        parser.add_argument("--shutter", type=float, default=0.1, help="shutter speed in seconds. Default %(default)s")
+        parser.add_argument("--count", type=int, default=100, help="number of pictures. Default %(default)s")
+        parser.add_argument("--delay", type=float, default=120,
+                            help="interval between the starts of pictures in seconds. Default %(default)s")
+        parser.add_argument("--burst", action="store_true",
+                            help="take all pictures in one burst as fast as the sensor permits, for sub-second "
+                                 "exposures. --delay and --autoShutter are ignored.")
+        parser.add_argument("--overrun", choices=sorted(DeadlineScheduler.OVERRUN_POLICIES), default="skip",
+                            help="what to do if a picture takes longer than --delay. Default %(default)s")
+        parser.add_argument("--directory", default=os.getcwd(), help="directory for the pictures. Default %(default)s")
+        parser.add_argument("--prefix", default="light", help="prefix of file names. Default %(default)s")
+        parser.add_argument("--autoShutter", action="store_true", help="adapt shutter speed after each picture.")
+        parser.add_argument("--meter", choices=sorted(ExposureMeter.METER_MODES), default="mean",
+                            help="metering mode for --autoShutter. Default %(default)s")
+        parser.add_argument("--format", choices=sorted(FrameWriter.FILE_FORMATS), default="fits",
+                            help="file format. Default %(default)s")
+        parser.add_argument("--stack", type=int, default=1,
+                            help="stack groups of this many pictures, only the stacks are written as fits. Default %(default)s")
+        parser.add_argument("--stackMode", choices=sorted(StackAccumulator.STACK_MODES), default="mean",
+                            help="how pictures are stacked with --stack. Default %(default)s")
+        parser.add_argument("--darks", default=None,
+                            help="directory of the dark library. If given, hot pixels are corrected.")
+        parser.add_argument("--buildDarks", action="store_true",
+                            help="take --count darks with --shutter and add their hot pixels to the --darks library.")
+        parser.add_argument("--binning", type=int, choices=BINNING_FACTORS, default=1,
+                            help="average groups of BINNING x BINNING pixels of the same color, the pictures get "
+                                 "BINNING times smaller in both directions. Default %(default)s")
+        parser.add_argument("--crop", type=int, nargs=4, default=None, metavar=("X", "Y", "WIDTH", "HEIGHT"),
+                            help="only keep this rectangle of the picture, in pixels. Rounded to the Bayer pattern.")
+        parser.add_argument("--detect", type=float, default=None, metavar="THRESHOLD",
+                            help="only write frames in which a part of the picture got brighter by more than "
+                                 "THRESHOLD raw values, e.g. 20 for meteors. Index in PREFIX_events.csv.")
+        parser.add_argument("--eventFrames", type=int, nargs=2, default=(2, 2), metavar=("BEFORE", "AFTER"),
+                            help="number of frames written before and after an event. Default %(default)s")
+        parser.add_argument("--focus", action="store_true",
+                            help="instead of a capture run, measure the focus of --count frames at the center of the "
+                                 "picture. Prints the half flux radius of the brightest star and the gradient energy.")
+        parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                            help="number of threads processing the pictures while the next one is captured. "
+                                 "0 processes them between the pictures. Default %(default)s")
+        parser.add_argument("--timingCsv", default=None,
+                            help="write the duration of each stage of each picture to this CSV file.")
+        parser.add_argument("--capabilityCache", default=DEFAULT_CAPABILITY_CACHE, metavar="FILE",
+                            help="file caching the validated capabilities of the sensor. Default %(default)s")
+        parser.add_argument("--simulate", type=float, nargs="?", const=1.0, default=None, metavar="TIMESCALE",
+                            help="use a simulated camera instead of the real one. Its times are multiplied with "
+                                 "TIMESCALE, e.g. 0.01 for a 100 times faster simulation. Default 1")
+
         # debug
-        parser.add_argument("-t", "--trace", action="store_true", help="activate trace mode for debugging.")
+        parser.add_argument("--profile", default=None, metavar="DIR",
+                            help="profile each stage with cProfile and take tracemalloc snapshots, written to DIR. "
+                                 "See piRaw.StageProfiler for reading the files.")
+        parser.add_argument("--profileSnapshots", type=int, default=10, metavar="N",
+                            help="with --profile, take a memory snapshot every N pictures, 0 for none. "
+                                 "Default %(default)s")
         parser.add_argument("-v", "--version", action="version", version=__version__,
                             help="display version of this tool and exit.")
         return parser
 
     @property
-    def isTrace(self):
-        return self.args.trace
+    def profileDirectory(self):
+        """ directory for --profile, None if not profiling"""
+        return self.args.profile
+
+    @property
+    def profileSnapshots(self):
+        return max(0,self.args.profileSnapshots)
+
+    @property
+    def isHeadless(self):
+        return self.args.headless
 
+    @property
+    def shutterSpeed(self):
+        """ shutter speed in microseconds"""
+        return int(self.args.shutter*1000000)
+
+    @property
+    def numPictures(self):
+        return self.args.count
 
-def run(*args):
-    #print("Hello World, args=",args)
-    #with RawCamera() as camera:
-    #    print(camera.capture().shape)
-    app=RawCameraApp(Tk.Tk())
-    app.mainloop()
+    @property
+    def delay(self):
+        return self.args.delay
+
+    @property
+    def isBurst(self):
+        return self.args.burst
+
+    @property
+    def overrunPolicy(self):
+        return self.args.overrun
+
+    @property
+    def directory(self):
+        return self.args.directory
+
+    @property
+    def prefix(self):
+        return self.args.prefix
+
+    @property
+    def isAutoShutter(self):
+        return self.args.autoShutter
+
+    @property
+    def meterMode(self):
+        return self.args.meter
+
+    @property
+    def fileFormat(self):
+        return self.args.format
+
+    @property
+    def stackFrames(self):
+        return self.args.stack
+
+    @property
+    def stackMode(self):
+        return self.args.stackMode
+
+    @property
+    def darkDirectory(self):
+        return self.args.darks
+
+    @property
+    def isBuildDarks(self):
+        return self.args.buildDarks
+
+    @property
+    def binning(self):
+        return self.args.binning
+
+    @property
+    def crop(self):
+        """ (x,y,width,height) or None"""
+        return tuple(self.args.crop) if self.args.crop is not None else None
+
+    @property
+    def detectThreshold(self):
+        return self.args.detect
+
+    @property
+    def eventFrames(self):
+        """ (before,after)"""
+        return tuple(self.args.eventFrames)
+
+    @property
+    def isFocus(self):
+        return self.args.focus
+
+    @property
+    def numWorkers(self):
+        return max(0,self.args.workers)
+
+    @property
+    def timingCsv(self):
+        return self.args.timingCsv
+
+    @property
+    def capabilityCache(self):
+        return self.args.capabilityCache
+
+    @property
+    def simulateTimeScale(self):
+        """ time scale of the simulated camera, None for the real camera"""
+        return self.args.simulate
+
+
+def runHeadless(evalArgs):
+    """ capture run as given on the command line, without GUI. Ctrl-C aborts the run
+    """
+    if evalArgs.isBuildDarks and evalArgs.darkDirectory is None:
+        raise ValueError("--buildDarks needs --darks")
+    darkLibrary=DarkLibrary(evalArgs.darkDirectory) if evalArgs.darkDirectory is not None else None
+    if evalArgs.isFocus:
+        thread=FocusThread(evalArgs.shutterSpeed,evalArgs.numPictures)
+    else:
+        thread=CaptureThread(evalArgs.shutterSpeed,evalArgs.numPictures,evalArgs.delay,
+                             evalArgs.directory,evalArgs.prefix,evalArgs.isAutoShutter,False,
+                             fileFormat=evalArgs.fileFormat,meterMode=evalArgs.meterMode,
+                             overrunPolicy=evalArgs.overrunPolicy,stackFrames=evalArgs.stackFrames,
+                             stackMode=evalArgs.stackMode,darkLibrary=darkLibrary,bBuildDarks=evalArgs.isBuildDarks,
+                             burst=evalArgs.isBurst,numWorkers=evalArgs.numWorkers,crop=evalArgs.crop,
+                             binning=evalArgs.binning,detectThreshold=evalArgs.detectThreshold,
+                             eventFrames=evalArgs.eventFrames)
+    thread.start()
+    try:
+        while thread.is_alive():
+            # join with timeout, otherwise Ctrl-C is not delivered
+            thread.join(1)
+    except KeyboardInterrupt:
+        print("Aborting, waiting for capture to finish")
+        thread.stopRequest()
+        thread.join()
+
+def run(evalArgs):
+    if evalArgs.simulateTimeScale is not None:
+        RawCamera.backend="simulated"
+        SimulatedPiCamera.timeScale=evalArgs.simulateTimeScale
+    capabilityService.cacheFile=evalArgs.capabilityCache
+    if evalArgs.timingCsv is not None:
+        timer.openCsv(evalArgs.timingCsv)
+    if evalArgs.profileDirectory is not None:
+        timer.startProfile(evalArgs.profileDirectory,evalArgs.profileSnapshots)
+    try:
+        if evalArgs.isHeadless:
+            runHeadless(evalArgs)
+        else:
+            # loading tkinter and matplotlib takes seconds on the Pi, so only import them when needed
+            import piRawGui
+            piRawGui.run()
+    finally:
+        timer.stopProfile()
+        timer.closeCsv()
 
 def main():
     evalArgs=EvalArgs()
     print("{!s} running with arguments {!s}".format(datetime.datetime.now(),evalArgs.args))
-    args = []
-    if evalArgs.isTrace:
-
-        aTrace = trace.Trace(count=False, trace=True,
-                             # keep subprocess and os, but remove most other libs
-                             ignoremods=["shlex", "posixpath", "UserDict", "threading", "platform", "getpass",
-                                         "string"])
-        aTrace.runctx(
-            "run(*args)",
-            globals(), locals())
-    else:
-        run(*args)
+    run(evalArgs)
 
 if __name__ == "__main__":
+    # piRawGui imports this file as module piRaw. Register it, so it is not loaded a second time
+    sys.modules.setdefault("piRaw",sys.modules[__name__])
     print("{!s} started".format(datetime.datetime.now()))
     try:
         main()
@@ -0,0 +1,887 @@
+# -*- coding: utf-8 -*-
+""" GUI of piRaw, see piRaw.py
+
+Imported by piRaw only when the GUI is used, so headless capture runs dont need to load
+tkinter and matplotlib. Needs in addition to the packages of piRaw
+- python3-matplotlib
+- python3-tk
+"""
+
+__author__    = 'Georg Viehoever'
+__copyright__ = 'Copyright 2016, Georg Viehoever'
+__license__   = """
+The MIT License (MIT)
+Copyright (c) 2016 Georg Viehoever
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and
+associated documentation files (the "Software"), to deal in the Software without restriction, including
+without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to
+the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT
+LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+
+import collections
+import datetime
+import time
+import functools
+import math
+import os
+
+#GUI
+import tkinter as Tk
+import tkinter.ttk as Ttk
+import tkinter.messagebox as TkMb
+import tkinter.filedialog as TkFd
+
+import matplotlib as mpl
+mpl.use("TkAgg") #FIXME Try other backend?
+import matplotlib.pyplot as plt
+import numpy as np
+
+from piRaw import (BINNING_FACTORS, CaptureThread, DarkLibrary, ExposureMeter, FocusThread, FrameWriter,
+                   RawCamera, StackAccumulator, previewFromMosaic, timer)
+
+#
+# GUI
+#
+def busyCursor(f):
+    """ decorator that causes execution of f with a busy cursor
+    """
+    @functools.wraps(f)
+    def wrapper(self,*args,**kwargs):
+        cursor=self.cget("cursor")
+        try:
+            #print("wait cursor")
+            self.configure(cursor="watch")
+            self.update() #necessary so cursor actually changes
+            return f(self,*args,**kwargs)
+        finally:
+            #print("restore cursor")
+            self.configure(cursor=cursor)
+            self.update()
+
+    return wrapper
+
+class HelpWindow:
+    def __init__(self, master, helpText):
+        self.master = master
+        self.master.wm_title("Help") #window title
+        self.master.protocol("WM_DELETE_WINDOW",self._quitCallback) #close action
+        self.frame = Tk.Frame(self.master)
+        self.text=Tk.Text(self.frame,width=110)
+        self.text.pack(side=Tk.TOP)
+        self.text.insert(Tk.END, str(helpText))
+        self.quitButton = Tk.Button(self.frame, text = 'Quit', width = 25, command = self._quitCallback)
+        self.quitButton.pack(side=Tk.TOP)
+        self.frame.pack()
+    def _quitCallback(self):
+        self.master.destroy()
+
+class RawCameraApp(Tk.Frame):
+    """GUI for RawCamera
+    """
+
+    def __init__(self,master):
+
+        # slots
+        self.shutter_speed=int(1000000 / 10)
+        """ shutter speed used in microseconds"""
+
+        # GUI
+        self.subsample=100
+        """x size of sample used for display. Avoids memory problems"""
+        self.rotation=0
+        """rotation of image in view, 0,90,180,270"""
+        self.histogramBins=64
+        """number of bins of the histogram, must divide 1024"""
+        self.imageBits=10
+        """bits per pixel of self.image, 10 or 12 depending on the sensor"""
+        self.redrawSecs=0.0
+        """time needed for the last update of the figure"""
+
+        # managing the capture thread
+        self.captureThread=None
+        """thread object doing the capture, not None only while running"""
+        self.focusThread=None
+        """thread object measuring the focus, not None only while running"""
+
+        # focus assistant settings
+        self.focusCenter=(0.5,0.5)
+        """ (x,y) center of the focus region as fraction of the mosaic. Selected by clicking into the preview"""
+        self.focusSize=256
+        """ width and height of the focus region in pixels"""
+        self.focusHistory=collections.deque(maxlen=100)
+        """ (hfr,gradient,peak,x,y) of the last frames of the focus assistant, see FocusMeter.measure()"""
+
+        # capture thread settings
+        self.captureNum = 100
+        """ number of images on run """
+        self.captureDelay = 120
+        """ delay between images during run"""
+        self.captureDirectory=os.getcwd()
+        """ directory for storing images"""
+        self.capturePrefix="light"
+        """ prefix for generated file names"""
+        self.captureFileFormat="fits"
+        """ format of generated files, see FrameWriter.FILE_FORMATS"""
+        self.captureAutoShutter=True
+        """" if True, drift current exposure time until mean value 256 is reached"""
+        self.captureDisplayImage=True
+        """ if True, display captured images in GUI. Needs additional time"""
+        self.captureMeterMode="mean"
+        """ metering mode of AutoShutter, see ExposureMeter.METER_MODES"""
+        self.captureBurst=False
+        """ if True, take all images in one burst, see CaptureThread"""
+        self.captureBinning=1
+        """ binning factor of the images, see BINNING_FACTORS"""
+        self.captureStackFrames=1
+        """ number of images per stack, 1 for no stacking"""
+        self.captureStackMode="mean"
+        """ how images are stacked, see StackAccumulator.STACK_MODES"""
+        self.captureHotPixels=False
+        """ if True, correct hot pixels with the dark library in subdirectory darks of captureDirectory"""
+        self.captureBuildDarks=False
+        """ if True, Run captures darks for the dark library"""
+
+        #some image with non-trivial histogram
+        image1=np.random.randint(0,512,(self.subsample,self.subsample,3))
+        image2=np.random.randint(0,513,(self.subsample,self.subsample,3))
+        self.image=(image1+image2).astype(np.uint16)
+        """image being displayed in GUI, low resolution RGB preview, see previewFromMosaic()"""
+        #GUI
+        super().__init__(master)
+        self._createWidgets()
+
+    @property
+    def logShutter_speed(self):
+        """ log10 value of shutter_speed in [s]
+        """
+        res=math.log10(self.shutter_speed / 1000000)
+        return res
+
+    @logShutter_speed.setter
+    def logShutter_speed(self,value):
+        """ set log1 value of shutter speed in [s]
+        """
+        self.shutter_speed=int((10.0 ** value) * 1000000)
+
+    def _createWidgets(self):
+        """Create the GUI elements
+        """
+        self.master.wm_title("PiRaw Camera") #window title
+        self.master.protocol("WM_DELETE_WINDOW",self._quitCallback) #close action
+
+        # matplotlib related elements
+        self.figure=self._genFigure()
+        self.canvas=mpl.backends.backend_tkagg.FigureCanvasTkAgg(self.figure,master=self)
+        self.canvas.mpl_connect("draw_event",self._onDraw)
+        self.canvas.mpl_connect("button_press_event",self._onClick)
+        self.canvas.get_tk_widget().pack(side=Tk.TOP,fill=Tk.BOTH,expand=1)
+
+        self.toolbar=mpl.backends.backend_tkagg.NavigationToolbar2TkAgg(self.canvas,self)
+        self.toolbar.pack(side=Tk.TOP,fill=Tk.BOTH)
+
+        # GUI elements for test capture shown in GUI
+        self.uiFrameCapture=Tk.Frame(self)
+        self.uiCaptureTestButton=Tk.Button(self.uiFrameCapture,text="Capture Test",command=self._captureTestCallback)
+        self.uiCaptureTestButton.pack(side=Tk.LEFT)
+        self.uiFocusButton=Tk.Button(self.uiFrameCapture,text="Focus",command=self._focusCallback)
+        self.uiFocusButton.pack(side=Tk.LEFT)
+
+        self.uiLogShutterSlider=Tk.Scale(self.uiFrameCapture,label="log10(shutter)[s]",
+                                         from_=-5,to=1,
+                                         orient=Tk.HORIZONTAL,length=200,resolution=0.02,
+                                         command=self._logShutterCallback)
+        self.uiLogShutterSlider.pack(side=Tk.LEFT)
+        self.uiShutterLabel = Tk.Label(self.uiFrameCapture, text="x.xx s")
+        self.uiShutterLabel.pack(side=Tk.LEFT)
+
+        self.uiRotationLabel = Tk.Label(self.uiFrameCapture, text="Rotate View [deg]:")
+        self.uiRotationLabel.pack(side=Tk.LEFT)
+        self._rotationVar=Tk.IntVar(self.uiFrameCapture,self.rotation)
+        self.uiRot0RadioButton=Tk.Radiobutton(self.uiFrameCapture, text="0",
+                                              variable=self._rotationVar,value=0,
+                                              command=self._rotationCallback)
+        self.uiRot0RadioButton.pack(side=Tk.LEFT)
+        self.uiRot90RadioButton=Tk.Radiobutton(self.uiFrameCapture, text="90",
+                                              variable=self._rotationVar,value=90,
+                                              command=self._rotationCallback)
+        self.uiRot90RadioButton.pack(side=Tk.LEFT)
+        self.uiRot180RadioButton=Tk.Radiobutton(self.uiFrameCapture, text="180",
+                                              variable=self._rotationVar,value=180,
+                                              command=self._rotationCallback)
+        self.uiRot180RadioButton.pack(side=Tk.LEFT)
+        self.uiRot270RadioButton=Tk.Radiobutton(self.uiFrameCapture, text="270",
+                                              variable=self._rotationVar,value=270,
+                                              command=self._rotationCallback)
+        self.uiRot270RadioButton.pack(side=Tk.LEFT)
+
+        self.uiFrameCapture.pack(side=Tk.TOP,fill=Tk.BOTH)
+
+        # GUI elements for capture to file
+
+        #self.uiCaptureFitsButton=Tk.Button(self.uiFrameFile,text="Single FITS",command=self._captureFitsCallback)
+        #self.uiCaptureFitsButton.pack(side=Tk.LEFT)
+
+
+        self.uiFrameSequence = Tk.Frame(self)
+
+        # GUI elements for sequence
+        self.uiCaptureNumLabel=Tk.Label(self.uiFrameSequence,text="No of Images:")
+        self.uiCaptureNumLabel.pack(side=Tk.LEFT)
+        self._captureNumVar=Tk.IntVar(self.uiFrameSequence,self.captureNum)
+        captureNumCallback=self.uiFrameSequence.register(self._captureNumCallback)
+        self.uiCaptureNumEntry=Ttk.Entry(self.uiFrameSequence,width=4,textvariable=self._captureNumVar,
+                                         validate="all",validatecommand=(captureNumCallback,"%P"))
+        self.uiCaptureNumEntry.pack(side=Tk.LEFT)
+
+        self.uiCaptureDelayLabel = Tk.Label(self.uiFrameSequence, text="Delay [s]:")
+        self.uiCaptureDelayLabel.pack(side=Tk.LEFT)
+
+        self._captureDelayVar=Tk.IntVar(self.uiFrameSequence,self.captureDelay)
+        captureDelayCallback = self.uiFrameSequence.register(self._captureDelayCallback)
+        self.uiCaptureDelayEntry = Ttk.Entry(self.uiFrameSequence, width=4, textvariable=self._captureDelayVar,
+                                           validate="all", validatecommand=(captureDelayCallback, "%P"))
+        self.uiCaptureDelayEntry.pack(side=Tk.LEFT)
+
+        self._captureAutoShutterVar=Tk.BooleanVar(self.uiFrameSequence,self.captureAutoShutter)
+        self.uiCaptureAutoShutterCheckbox=Tk.Checkbutton(self.uiFrameSequence,text="AutoShutter",command=self._captureAutoShutterCallback,
+                                                  variable=self._captureAutoShutterVar)
+        self.uiCaptureAutoShutterCheckbox.pack(side=Tk.LEFT)
+
+        self._captureMeterModeVar=Tk.StringVar(self.uiFrameSequence,self.captureMeterMode)
+        self.uiCaptureMeterModeCombobox = Ttk.Combobox(self.uiFrameSequence, width=10, textvariable=self._captureMeterModeVar,
+                                                       values=sorted(ExposureMeter.METER_MODES), state="readonly")
+        self.uiCaptureMeterModeCombobox.bind("<<ComboboxSelected>>",self._captureMeterModeCallback)
+        self.uiCaptureMeterModeCombobox.pack(side=Tk.LEFT)
+
+        self._captureBurstVar=Tk.BooleanVar(self.uiFrameSequence,self.captureBurst)
+        self.uiCaptureBurstCheckbox=Tk.Checkbutton(self.uiFrameSequence,text="Burst",command=self._captureBurstCallback,
+                                                   variable=self._captureBurstVar)
+        self.uiCaptureBurstCheckbox.pack(side=Tk.LEFT)
+
+        self.uiCaptureBinningLabel = Tk.Label(self.uiFrameSequence, text="Bin:")
+        self.uiCaptureBinningLabel.pack(side=Tk.LEFT)
+        self._captureBinningVar=Tk.IntVar(self.uiFrameSequence,self.captureBinning)
+        self.uiCaptureBinningCombobox = Ttk.Combobox(self.uiFrameSequence, width=2, textvariable=self._captureBinningVar,
+                                                     values=BINNING_FACTORS, state="readonly")
+        self.uiCaptureBinningCombobox.bind("<<ComboboxSelected>>",self._captureBinningCallback)
+        self.uiCaptureBinningCombobox.pack(side=Tk.LEFT)
+
+        self.uiFrameSequence.pack(side=Tk.TOP, fill=Tk.BOTH)
+
+        # GUI elements for file management
+        self.uiFrameFile=Tk.Frame(self)
+        self.uiCaptureDirectoryButton = Tk.Button(self.uiFrameFile, text="Directory...", command=self._captureDirectoryCallback)
+        self.uiCaptureDirectoryButton.pack(side=Tk.LEFT)
+        self.uiCaptureDirectoryLabel=Tk.Label(self.uiFrameFile,text="")
+        self.uiCaptureDirectoryLabel.pack(side=Tk.LEFT)
+
+        self.uiCapturePrefixLabel = Tk.Label(self.uiFrameFile, text="Prefix:")
+        self.uiCapturePrefixLabel.pack(side=Tk.LEFT)
+        self._capturePrefixVar=Tk.IntVar(self.uiFrameFile,self.capturePrefix)
+        capturePrefixCallback = self.uiFrameFile.register(self._capturePrefixCallback)
+        self.uiCapturePrefixEntry = Ttk.Entry(self.uiFrameFile, width=8, textvariable=self._capturePrefixVar,
+                                           validate="all", validatecommand=(capturePrefixCallback, "%P"))
+        self.uiCapturePrefixEntry.pack(side=Tk.LEFT)
+
+        self.uiCaptureFileFormatLabel = Tk.Label(self.uiFrameFile, text="Format:")
+        self.uiCaptureFileFormatLabel.pack(side=Tk.LEFT)
+        self._captureFileFormatVar=Tk.StringVar(self.uiFrameFile,self.captureFileFormat)
+        self.uiCaptureFileFormatCombobox = Ttk.Combobox(self.uiFrameFile, width=9, textvariable=self._captureFileFormatVar,
+                                                        values=sorted(FrameWriter.FILE_FORMATS), state="readonly")
+        self.uiCaptureFileFormatCombobox.bind("<<ComboboxSelected>>",self._captureFileFormatCallback)
+        self.uiCaptureFileFormatCombobox.pack(side=Tk.LEFT)
+
+        self.uiCaptureStackLabel = Tk.Label(self.uiFrameFile, text="Stack:")
+        self.uiCaptureStackLabel.pack(side=Tk.LEFT)
+        self._captureStackFramesVar=Tk.IntVar(self.uiFrameFile,self.captureStackFrames)
+        captureStackFramesCallback = self.uiFrameFile.register(self._captureStackFramesCallback)
+        self.uiCaptureStackFramesEntry = Ttk.Entry(self.uiFrameFile, width=3, textvariable=self._captureStackFramesVar,
+                                                   validate="all", validatecommand=(captureStackFramesCallback, "%P"))
+        self.uiCaptureStackFramesEntry.pack(side=Tk.LEFT)
+        self._captureStackModeVar=Tk.StringVar(self.uiFrameFile,self.captureStackMode)
+        self.uiCaptureStackModeCombobox = Ttk.Combobox(self.uiFrameFile, width=6, textvariable=self._captureStackModeVar,
+                                                       values=sorted(StackAccumulator.STACK_MODES), state="readonly")
+        self.uiCaptureStackModeCombobox.bind("<<ComboboxSelected>>",self._captureStackModeCallback)
+        self.uiCaptureStackModeCombobox.pack(side=Tk.LEFT)
+
+        self._captureHotPixelsVar=Tk.BooleanVar(self.uiFrameFile,self.captureHotPixels)
+        self.uiCaptureHotPixelsCheckbox=Tk.Checkbutton(self.uiFrameFile,text="HotPixels",command=self._captureHotPixelsCallback,
+                                                       variable=self._captureHotPixelsVar)
+        self.uiCaptureHotPixelsCheckbox.pack(side=Tk.LEFT)
+        self._captureBuildDarksVar=Tk.BooleanVar(self.uiFrameFile,self.captureBuildDarks)
+        self.uiCaptureBuildDarksCheckbox=Tk.Checkbutton(self.uiFrameFile,text="Darks",command=self._captureBuildDarksCallback,
+                                                        variable=self._captureBuildDarksVar)
+        self.uiCaptureBuildDarksCheckbox.pack(side=Tk.LEFT)
+
+        self.uiCaptureRunButton = Tk.Button(self.uiFrameFile, text="Run", command=self._captureRunCallback)
+        self.uiCaptureRunButton.pack(side=Tk.LEFT)
+
+        self.uiFrameFile.pack(side=Tk.TOP,fill=Tk.BOTH)
+
+        #Quit +Help Button
+        self.quitButton=Tk.Button(self,text="Quit",command=self._quitCallback)
+        self.quitButton.pack(side=Tk.LEFT)
+        self.helpButton=Tk.Button(self,text="Help...",command=self._helpCallback)
+        self.helpButton.pack(side=Tk.LEFT)
+        self.uiTimingLabel=Tk.Label(self,text="",anchor=Tk.W)
+        self.uiTimingLabel.pack(side=Tk.LEFT,fill=Tk.X)
+
+        self.pack(fill=Tk.BOTH, expand=1)
+
+        self._updateItems()
+
+
+    def threadUpdateItems(self,thread,shutterSpeed,captureNum,image=None,bits=10):
+        """ called by capture thread to update GUI. bits are the bits per pixel of image
+        """
+        self.captureThread=thread
+        self.shutter_speed=shutterSpeed
+        #print("threadUpdateItems():shutterSpeed=",shutterSpeed)
+        self.captureNum=captureNum
+        if image is not None:
+            self.image=image
+            self.imageBits=bits
+            self._redraw()
+        self._updateItems()
+        self.update()
+
+    def threadFocusItems(self,thread,measurement):
+        """ called by focus thread to update GUI
+        @param thread: the thread while it is running, None when it terminates
+        @param measurement: see FocusMeter.measure(). None if there was no star or if thread terminates
+        """
+        self.focusThread=thread
+        if thread is not None:
+            self.focusHistory.append(measurement)
+            self._redrawFocus()
+        self._updateItems()
+        self.update()
+
+    def _updateItems(self):
+        """ update GUI elements to current state
+        """
+        #update displayed values
+        #print("_updateItems,log_shutter_speed",self.logShutter_speed)
+        self.uiLogShutterSlider.set(self.logShutter_speed)
+        self.uiShutterLabel.config(text="{:6.6f} sec".format(self.shutter_speed / 1000000))
+        self._rotationVar.set(self.rotation)
+        self._captureNumVar.set(self.captureNum)
+        self._captureDelayVar.set(self.captureDelay)
+        self._capturePrefixVar.set(self.capturePrefix)
+        self._captureFileFormatVar.set(self.captureFileFormat)
+        self._captureAutoShutterVar.set(self.captureAutoShutter)
+        self._captureMeterModeVar.set(self.captureMeterMode)
+        self._captureBurstVar.set(self.captureBurst)
+        self._captureBinningVar.set(self.captureBinning)
+        self._captureStackFramesVar.set(self.captureStackFrames)
+        self._captureStackModeVar.set(self.captureStackMode)
+        self._captureHotPixelsVar.set(self.captureHotPixels)
+        self._captureBuildDarksVar.set(self.captureBuildDarks)
+        self.uiCaptureDirectoryLabel.config(text=self.captureDirectory[-20:])
+        self.uiTimingLabel.config(text=timer.medians())
+
+        # disable/enable
+        if self.captureThread is not None or self.focusThread is not None:
+            if self.captureThread is not None:
+                self.uiCaptureRunButton.config(text="Abort")
+                self.uiFocusButton.config(state=Tk.DISABLED)
+            else:
+                self.uiCaptureRunButton.config(state=Tk.DISABLED)
+                self.uiFocusButton.config(text="Stop Focus")
+            # FIXME wont update if disabled
+            #self.uiCaptureFitsButton.config(state=Tk.DISABLED)
+            self.uiCaptureNumEntry.config(state=Tk.DISABLED)
+            self.uiCaptureDelayEntry.config(state=Tk.DISABLED)
+            self.uiCaptureDirectoryButton.config(state=Tk.DISABLED)
+            self.uiCapturePrefixEntry.config(state=Tk.DISABLED)
+            self.uiCaptureFileFormatCombobox.config(state=Tk.DISABLED)
+            self.uiCaptureTestButton.config(state=Tk.DISABLED)
+            self.uiCaptureAutoShutterCheckbox.config(state=Tk.DISABLED)
+            self.uiCaptureMeterModeCombobox.config(state=Tk.DISABLED)
+            self.uiCaptureBurstCheckbox.config(state=Tk.DISABLED)
+            self.uiCaptureBinningCombobox.config(state=Tk.DISABLED)
+            self.uiCaptureStackFramesEntry.config(state=Tk.DISABLED)
+            self.uiCaptureStackModeCombobox.config(state=Tk.DISABLED)
+            self.uiCaptureHotPixelsCheckbox.config(state=Tk.DISABLED)
+            self.uiCaptureBuildDarksCheckbox.config(state=Tk.DISABLED)
+            #self.uiLogShutterSlider.config(state=Tk.DISABLED)
+            self.helpButton.config(state=Tk.DISABLED)
+            self.quitButton.config(state=Tk.DISABLED)
+        else:
+            self.uiCaptureRunButton.config(text="Run",state=Tk.NORMAL)
+            self.uiFocusButton.config(text="Focus",state=Tk.NORMAL)
+            #self.uiCaptureFitsButton.config(state=Tk.NORMAL)
+            self.uiCaptureNumEntry.config(state=Tk.NORMAL)
+            self.uiCaptureDelayEntry.config(state=Tk.NORMAL)
+            self.uiCaptureDirectoryButton.config(state=Tk.NORMAL)
+            self.uiCapturePrefixEntry.config(state=Tk.NORMAL)
+            self.uiCaptureFileFormatCombobox.config(state="readonly")
+            self.uiCaptureTestButton.config(state=Tk.NORMAL)
+            self.uiCaptureAutoShutterCheckbox.config(state=Tk.NORMAL)
+            self.uiCaptureMeterModeCombobox.config(state="readonly")
+            self.uiCaptureBurstCheckbox.config(state=Tk.NORMAL)
+            self.uiCaptureBinningCombobox.config(state="readonly")
+            self.uiCaptureStackFramesEntry.config(state=Tk.NORMAL)
+            self.uiCaptureStackModeCombobox.config(state="readonly")
+            self.uiCaptureHotPixelsCheckbox.config(state=Tk.NORMAL)
+            self.uiCaptureBuildDarksCheckbox.config(state=Tk.NORMAL)
+            self.uiLogShutterSlider.config(state=Tk.NORMAL)
+            self.helpButton.config(state=Tk.NORMAL)
+            self.quitButton.config(state=Tk.NORMAL)
+
+
+    def _quitCallback(self):
+        """ callback for Quit button
+        """
+        if self.captureThread:
+            TkMb.showerror("Error","Abort capture run before quitting!")
+        elif self.focusThread:
+            TkMb.showerror("Error","Stop focus before quitting!")
+        else:
+            self.quit()
+            self.destroy()
+
+    def _helpCallback(self):
+        helpText="""PiRaw - A tool for capturing RAWs with the Raspberry Pi
+
+This tool allows to capture RAWs with the Raspberry Pi Camera Module, controlled with a GUI.
+So far tested with Raspberry Pi 3 and PiNoir V2.1, but should work with other
+RaspberryPi systems as well.
+
+The pictures are stored as bayered FITS files as understood by many astrophotography tools.
+Pixel values are 0..1023 (10 bits), 0..4095 (12 bits) with the HQ camera. When read with PixInsight, the
+images can be debayered with the RGGB pattern.
+
+UI elements:
+- Picture preview on the top left: Reduced resolution view of the captured picture. Can be rotated with the
+  "Rotation" buttons. It is computed directly from the raw data at reduced resolution, which limits memory
+  and CPU consumption
+- Histogram on the top right: RGB histogram, generated from the reduced resolution picture. The title shows
+  the mean value and the time needed for the last update of the display.
+- Capture Test button: Capture image, but dont store a FITS file. Good for determining shutter speed
+  and camera orientation
+- Focus button: Focus assistant. Captures a region of 256x256 pixels again and again, as fast as the
+  shutter speed permits, and plots its focus on the right: HFR (blue, left scale, half flux radius of the
+  brightest star in pixels, smaller is better) and gradient (red, right scale, gradient energy, larger is
+  better, also works on the moon). Click into the preview to choose the region, it is marked with a cross.
+  The shutter slider works while focusing. Choose a shutter speed that does not saturate the star, the
+  peak value is shown.
+- Shutter slider: Log scale slider to determine shutter speed. Actual shutter speed in displayed to the right.
+  Note that there is no choice of aperture or ISO: The Pi Camera does not really have something like this.
+- Rotate View buttons: Rotate the picture preview. Has no influence on the orientation of the FITS file
+- No of Images text field: determine the number of images to be taken. One image is approx. 16 MB, so a
+  16GB SD card is goold for several hundred images
+- Delay: Time between the starts of images. Images start at fixed intervals, so they do not drift.
+  If time is shorter than the time needed to take an image (20..80 seconds), missed start times are
+  skipped. Note that the time for capture depends on the shutter time. For 10 second
+  captures it is around 80 seconds, for short exposure times around 20 seconds.
+- Autoshutter check box: If enabled, adapts shutter time such that the metered value of an image is ~500.
+  Adaption happens after each shot, usually one or two shots are needed. Has no effect on Capture Test.
+- Meter mode: How Autoshutter meters the image. mean: mean of all pixels. center: center weighted mean.
+  percentile: median, ignores stars and hot pixels. highlight: mean, but avoids saturating the brightest parts.
+- Burst check box: If enabled, all images are taken in one burst, as fast as the sensor permits, without
+  the setup time of each single image. For short exposures, e.g. meteors, lightning or the moon.
+  Delay and Autoshutter are ignored. Use format raw10, otherwise writing the files is the bottleneck.
+- Bin: Binning of the images. 2 or 4 average 2x2 or 4x4 pixels of the same color, the images keep their
+  Bayer pattern and get 4 or 16 times smaller. Darks must be taken with the same binning.
+- Directory button: Choose directory where images are stored.
+- Prefix text field: Enter file prefix. Files get names such as prefix_201_20160828163035.727016.fits,
+  with _201 being the image number, then datetime.milliseconds, then postfix .fits.
+- Format: fits is uncompressed FITS. fits_mmap writes the same files with less memory and CPU, the
+  image is unpacked directly into the file. fits_rice is lossless compressed FITS, about 40% of the size.
+  raw10 is a compact packed format with 10 bits per pixel, read it with piRaw.readRaw10().
+- Stack: Number of images that are stacked into one file, 1 for no stacking. Only the stacks are written,
+  always as FITS. sum adds the images, mean averages them, sigma averages them without outliers such as
+  satellites and planes. sigma keeps all images of a stack in memory, so use it only with small stacks.
+- HotPixels check box: If enabled, hot pixels are replaced by the median of their neighbours before images
+  are written. Uses the darks in subdirectory darks of the chosen directory, with the nearest shutter time.
+- Darks check box: If enabled, Run takes darks instead of images (cover the lens!). Their mean is written as
+  master dark, and its hot pixels are added to subdirectory darks. Autoshutter and Stack are ignored.
+- Run/Abort button: Run the capture sequence. While running, it is possible to abort.
+- Help button: Display this text
+- Next to the buttons, the median duration of each stage of the last pictures is shown: open camera,
+  exposure (including bayer and unpack of the raw data), hot pixels, preview, write, redraw, ...
+  Percentiles are printed to the log, start with --timingCsv FILE to record all durations.
+- Quit button: Quit the tool"""
+        newWindow = Tk.Toplevel(self.master)
+        self.app = HelpWindow(newWindow,helpText)
+
+
+    #@busyCursor
+    def _captureRunCallback(self):
+        """ callback for Run button, capture series
+        """
+        #print("_captureRunCallback")
+        if self.captureThread is not None:
+            self.captureThread.stopRequest()
+        else:
+            darkLibrary=None
+            if self.captureHotPixels or self.captureBuildDarks:
+                darkLibrary=DarkLibrary(os.path.join(self.captureDirectory,"darks"))
+            self.captureThread=CaptureThread(self.shutter_speed, self.captureNum,
+                                             self.captureDelay, self.captureDirectory,
+                                             self.capturePrefix, self.captureAutoShutter,
+                                             self.captureDisplayImage,
+                                             self,self.captureFileFormat,self.captureMeterMode,
+                                             stackFrames=self.captureStackFrames,stackMode=self.captureStackMode,
+                                             darkLibrary=darkLibrary,bBuildDarks=self.captureBuildDarks,
+                                             burst=self.captureBurst,binning=self.captureBinning)
+            self.captureThread.start()
+
+        self._updateItems()
+
+    def _focusCallback(self):
+        """ callback for Focus button, starts and stops the focus assistant
+        """
+        if self.focusThread is not None:
+            self.focusThread.stopRequest()
+        else:
+            self.focusHistory.clear()
+            self.focusThread=FocusThread(self.shutter_speed,center=self.focusCenter,size=self.focusSize,app=self)
+            self.focusThread.start()
+        self._updateItems()
+
+    def _onClick(self,event):
+        """ callback for mouse clicks into the figure. A click into the preview chooses the focus region,
+        unless the toolbar is in pan or zoom mode
+        """
+        if event.inaxes is not self._imageArtist.axes or self.toolbar.mode or self.captureThread is not None:
+            return
+        self.focusCenter=self._displayToFocus(event.xdata,event.ydata)
+        self.focusHistory.clear()
+        if self.focusThread is not None:
+            self.focusThread.center=self.focusCenter
+        self._redrawFocus()
+
+    @staticmethod
+    def _rotatePoint(row,col,shape,k):
+        """ returns (row,col,shape) of the point row,col of an image of shape after np.rot90(image,k)
+        """
+        for i in range(k%4):
+            row,col,shape=shape[1]-1-col,row,(shape[1],shape[0])
+        return (row,col,shape)
+
+    def _focusToDisplay(self,center):
+        """ returns (x,y) in the displayed preview of center (x,y) given as fractions of the mosaic
+
+        The preview is rotated by 180 degrees compared to the mosaic, see previewFromMosaic(), and then by self.rotation
+        """
+        height,width=self._imageArtist.get_array().shape[:2]
+        k=self.rotation//90
+        shape=(height,width) if k%2==0 else (width,height)
+        row,col,shape=self._rotatePoint(shape[0]-0.5-center[1]*shape[0],shape[1]-0.5-center[0]*shape[1],shape,k)
+        return (col,row)
+
+    def _displayToFocus(self,x,y):
+        """ returns (x,y) as fractions of the mosaic of the point x,y in the displayed preview, see _focusToDisplay()
+        """
+        k=self.rotation//90
+        row,col,shape=self._rotatePoint(y,x,self._imageArtist.get_array().shape[:2],-k)
+        return (min(max((shape[1]-0.5-col)/shape[1],0.0),1.0),min(max((shape[0]-0.5-row)/shape[0],0.0),1.0))
+
+    @busyCursor
+    def _rotationCallback(self):
+        """ Callback for rotation radio butttons
+        """
+        val=self._rotationVar.get()
+        if val!=self.rotation:
+            self.rotation=val
+            self._redraw()
+
+    def _captureNumCallback(self,val):
+        """ callback for capture num entry
+        """
+        try:
+            val=int(val)
+        except ValueError:
+            return False
+        if val<0:
+            return False
+        self.captureNum=val
+        return True
+
+    def _captureDelayCallback(self, val):
+        """ callback for capture delay entry
+        """
+        try:
+            val = int(val)
+        except ValueError:
+            return False
+        if val < 0:
+            return False
+        self.captureDelay = val
+        return True
+
+    @busyCursor
+    def _captureTestCallback(self):
+        """ capture test image
+        """
+        with timer.stage("open"):
+            camera=RawCamera()
+        with camera:
+            camera.shutter_speed=self.shutter_speed
+            raw=camera.capture(False)[0]
+            bits=camera.capabilities["bits"]
+        with timer.stage("preview"):
+            self.image=previewFromMosaic(raw,self.subsample)
+            self.imageBits=bits
+        self._redraw()
+        self._updateItems()
+
+    #@busyCursor
+    #def _captureFitsCallback(self):
+    #    """ capture image to fits file
+    #    """
+    #    now=datetime.datetime.now()
+    #    with RawCamera() as camera:
+    #        camera.shutter_speed=self.shutter_speed
+    #        image=camera.capture(False)
+    #    print("RawCameraApp._captureFitsCallback() capture=%s secs" % (datetime.datetime.now() - now))
+    #    print("FitsImage=",image.shape,image.dtype)
+    #    hdu=pyfits.PrimaryHDU(image)
+    #    hduList=pyfits.HDUList([hdu])
+    #    print("RawCameraApp._captureFitsCallback() prepFits=%s secs" % (datetime.datetime.now() - now))
+    #    hdu.writeto("test.fits",clobber=True)
+    #    print("RawCameraApp._captureFitsCallback() writeFits=%s secs" % (datetime.datetime.now() - now))
+
+    def _logShutterCallback(self,value):
+        """ callback for shutter slider
+        """
+        self.logShutter_speed=float(value)
+        if self.focusThread is not None:
+            self.focusThread.shutterSpeed=self.shutter_speed
+        self._updateItems()
+
+    def _captureAutoShutterCallback(self):
+        """ callback for autoshutter checkbox
+        """
+        self.captureAutoShutter=not self.captureAutoShutter
+        self._updateItems()
+
+    def _captureBurstCallback(self):
+        """ callback for burst checkbox
+        """
+        self.captureBurst=not self.captureBurst
+        self._updateItems()
+
+    def _captureBinningCallback(self, event):
+        """ callback for binning combobox
+        """
+        self.captureBinning=self._captureBinningVar.get()
+
+    def _captureMeterModeCallback(self, event):
+        """ callback for meter mode combobox
+        """
+        self.captureMeterMode=self._captureMeterModeVar.get()
+
+    def _captureDirectoryCallback(self):
+        """ callback for directory button
+        """
+        self.captureDirectory=TkFd.askdirectory(parent=self,initialdir=self.captureDirectory, mustexist=True,
+                                                title=("Choose directory for images"))
+        self._updateItems()
+
+    def _capturePrefixCallback(self, val):
+        """ callback for capture prefix entry
+        """
+        self.capturePrefix=val
+        return True
+
+    def _captureFileFormatCallback(self, event):
+        """ callback for file format combobox
+        """
+        self.captureFileFormat=self._captureFileFormatVar.get()
+
+    def _captureStackFramesCallback(self, val):
+        """ callback for stack frames entry
+        """
+        try:
+            val = int(val)
+        except ValueError:
+            return False
+        if val < 1:
+            return False
+        self.captureStackFrames = val
+        return True
+
+    def _captureHotPixelsCallback(self):
+        """ callback for hot pixels checkbox
+        """
+        self.captureHotPixels=not self.captureHotPixels
+        self._updateItems()
+
+    def _captureBuildDarksCallback(self):
+        """ callback for darks checkbox
+        """
+        self.captureBuildDarks=not self.captureBuildDarks
+        self._updateItems()
+
+    def _captureStackModeCallback(self, event):
+        """ callback for stack mode combobox
+        """
+        self.captureStackMode=self._captureStackModeVar.get()
+
+    def _previewImage(self):
+        """ returns (uint8Image,histogram) for display of self.image
+
+        histogram has shape (3,self.histogramBins) and is normalized to a maximum of 1. It is computed with
+        bincount on the values with self.imageBits, which is much cheaper than matplotlib's hist()
+        """
+        # subsample. Full image is too much for RPi
+        subStep=max(1,self.image.shape[0]//self.subsample)
+        smallImage=self.image[::subStep,::subStep,:]
+
+        uint8Image=(smallImage>>(self.imageBits-8)).astype(np.uint8)
+        if self.rotation!=0:
+            uint8Image=np.rot90(uint8Image,self.rotation//90)
+
+        numValues=1<<self.imageBits
+        histogram=np.empty((3,self.histogramBins))
+        for i in range(3):
+            counts=np.bincount(np.minimum(smallImage[:,:,i].ravel(),numValues-1),minlength=numValues)
+            histogram[i]=counts.reshape(self.histogramBins,-1).sum(axis=1)
+        histogram/=max(1,histogram.max())
+        return (uint8Image,histogram,smallImage.mean())
+
+    def _onDraw(self,event):
+        """ callback for full redraws of the canvas, e.g. after resize or zoom. Saves the background
+        for blitting, and draws the animated artists on top of it.
+        """
+        self._background=self.canvas.copy_from_bbox(self.figure.bbox)
+        self._drawArtists()
+
+    def _drawArtists(self):
+        """ draw the artists that change with each image
+        """
+        for artist in [self._imageArtist,self._focusMarker,self._histogramTitle,self._focusTitle,
+                       self._focusHfrLine,self._focusGradientLine]+self._histogramLines:
+            artist.axes.draw_artist(artist)
+
+    def _blit(self,bFullDraw):
+        """ show the updated artists. Only they are drawn onto the saved background and blitted,
+        unless bFullDraw is set, then the complete figure is redrawn
+        """
+        if bFullDraw or self._background is None:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self._background)
+            self._drawArtists()
+            self.canvas.blit(self.figure.bbox)
+
+    def _redraw(self):
+        """ redraw with current data
+
+        The artists are updated in place. If the image shape did not change, only they are drawn
+        onto the saved background and blitted, otherwise the complete figure is redrawn.
+        """
+        now=time.perf_counter()
+        uint8Image,histogram,mean=self._previewImage()
+        bFullDraw=uint8Image.shape!=self._imageArtist.get_array().shape
+        self._imageArtist.set_data(uint8Image)
+        binCenters=self._binCenters()
+        x,y=self._focusToDisplay(self.focusCenter)
+        self._focusMarker.set_data([x],[y])
+        for line,values in zip(self._histogramLines,histogram):
+            line.set_ydata(values)
+        if self._histogramLines[0].get_xdata()[-1]!=binCenters[-1]:
+            # other number of bits
+            for line in self._histogramLines:
+                line.set_xdata(binCenters)
+            self._histogramLines[0].axes.set_xlim(0,(1<<self.imageBits)-1)
+            bFullDraw=True
+        self._histogramTitle.set_text("Mean={:4.3f}, redraw {:.0f} ms".format(mean,1000*self.redrawSecs))
+        if bFullDraw:
+            height,width=uint8Image.shape[:2]
+            self._imageArtist.set_extent((-0.5,width-0.5,height-0.5,-0.5))
+            ax=self._imageArtist.axes
+            ax.set_xlim(-0.5,width-0.5)
+            ax.set_ylim(height-0.5,-0.5)
+        self._blit(bFullDraw)
+        self.redrawSecs=time.perf_counter()-now
+        timer.record("redraw",self.redrawSecs)
+
+    def _binCenters(self):
+        """ returns the centers of the histogram bins for values with self.imageBits
+        """
+        binWidth=(1<<self.imageBits)/self.histogramBins
+        return (np.arange(self.histogramBins)+0.5)*binWidth
+
+    def _redrawFocus(self):
+        """ redraw the focus plot and marker with self.focusHistory. Cheap, the preview is not recomputed
+
+        The y axes are only extended, which needs a full redraw, if the values grow beyond them
+        """
+        now=time.perf_counter()
+        x,y=self._focusToDisplay(self.focusCenter)
+        self._focusMarker.set_data([x],[y])
+        measurements=[m for m in self.focusHistory if m is not None]
+        frames=np.arange(1-len(self.focusHistory),1)[[m is not None for m in self.focusHistory]]
+        bFullDraw=False
+        for line,values in ((self._focusHfrLine,[m[0] for m in measurements]),
+                            (self._focusGradientLine,[m[1] for m in measurements])):
+            line.set_data(frames,values)
+            ax=line.axes
+            if values and max(values)>ax.get_ylim()[1]:
+                ax.set_ylim(0,1.5*max(values))
+                bFullDraw=True
+        if not self.focusHistory:
+            self._focusTitle.set_text("Focus")
+        elif self.focusHistory[-1] is None:
+            self._focusTitle.set_text("No star")
+        else:
+            hfr,gradient,peak=self.focusHistory[-1][:3]
+            self._focusTitle.set_text("HFR {:.2f} best {:.2f}\npeak {:d}".format(
+                hfr,min(m[0] for m in measurements),peak))
+        self._blit(bFullDraw)
+        timer.record("redraw",time.perf_counter()-now)
+
+    def _genFigure(self):
+        """returns figure to be displayed, with the artists that are updated by _redraw()
+        """
+        uint8Image,histogram,mean=self._previewImage()
+        fig,axes=plt.subplots(1,3,squeeze=True)
+        ax=axes[0]
+        self._imageArtist=ax.imshow(uint8Image,interpolation='none',animated=True)
+        x,y=self._focusToDisplay(self.focusCenter)
+        self._focusMarker=ax.plot([x],[y],marker="+",markersize=15,color="y",scalex=False,scaley=False,
+                                  animated=True)[0]
+
+        ax=axes[1]
+        binCenters=self._binCenters()
+        self._histogramLines=[ax.plot(binCenters,values,color=color,drawstyle="steps-mid",animated=True)[0]
+                              for values,color in zip(histogram,('r','g','b'))]
+        ax.set_xlim(0,(1<<self.imageBits)-1)
+        ax.set_ylim(0,1.05)
+        self._histogramTitle=ax.set_title("Mean={:4.3f}".format(mean),animated=True)
+
+        ax=axes[2]
+        numFrames=self.focusHistory.maxlen
+        self._focusHfrLine=ax.plot([],[],color='b',animated=True)[0]
+        ax.set_xlim(1-numFrames,0)
+        ax.set_ylim(0,10)
+        ax.set_xlabel("frame")
+        ax.tick_params(axis="y",colors='b')
+        self._focusTitle=ax.set_title("Focus",fontsize="small",animated=True)
+        ax=ax.twinx()
+        self._focusGradientLine=ax.plot([],[],color='r',animated=True)[0]
+        ax.set_ylim(0,1)
+        ax.tick_params(axis="y",colors='r')
+        self._background=None
+        return fig
+
+
+def run():
+    """ run GUI until it is closed
+    """
+    app=RawCameraApp(Tk.Tk())
+    app.mainloop()
@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+""" tests of piRaw, run with
+  python3 -m pytest test_piRaw.py
+
+Run without RaspberryPi and camera. If pyfits is not installed, astropy.io.fits is used instead.
+"""
+
+__author__    = 'Georg Viehoever'
+__copyright__ = 'Copyright 2016, Georg Viehoever'
+__license__   = "MIT, see piRaw.py"
+
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+try:
+    import pyfits
+except ImportError:
+    pyfits=pytest.importorskip("astropy.io.fits")
+    sys.modules["pyfits"]=pyfits
+
+import piRaw
+
+
+def makeBuffer(tail=6404096,jpegSize=1000):
+    """ returns bytes as captured by picamera with bayer=True: JPEG data followed by tail bytes of
+    BRCM header and raw data, all pixels 0
+    """
+    data=bytearray(jpegSize+tail)
+    data[:2]=b'\xff\xd8'
+    data[jpegSize:jpegSize+4]=b'BRCM'
+    return bytes(data)
+
+def randomMosaic(shape,bits,seed=0):
+    """ returns uint16 mosaic of shape with random values of bits
+    """
+    return np.random.RandomState(seed).randint(0,1<<bits,shape).astype(np.uint16)
+
+def binReference(mosaic,factor):
+    """ returns binMosaic() computed per color plane with sums, rounded half up
+    """
+    rows,cols=mosaic.shape
+    out=np.empty((rows//factor,cols//factor),dtype=np.uint16)
+    for r in range(2):
+        for c in range(2):
+            plane=mosaic[r::2,c::2].astype(np.uint32)
+            sums=plane.reshape(plane.shape[0]//factor,factor,plane.shape[1]//factor,factor).sum(axis=(1,3))
+            out[r::2,c::2]=(sums+factor*factor//2)//(factor*factor)
+    return out
+
+def flushOutput(data):
+    """ returns PiBayerFlatArray into which data has been written and flushed, as done by picamera
+    """
+    output=piRaw.PiBayerFlatArray(None)
+    output.write(data)
+    output.flush()
+    return output
+
+
+def test_flushDecodesBuffer():
+    output=flushOutput(makeBuffer())
+    assert output.array.shape==(1944,2592)
+    assert output.array.dtype==np.uint16
+    assert not output.array.any()
+
+@pytest.mark.parametrize("sensor",sorted(piRaw.BAYER_BUFFER_LAYOUTS))
+def test_bayerBufferRoundTrip(sensor):
+    layout=piRaw.BAYER_BUFFER_LAYOUTS[sensor]
+    mosaic=randomMosaic(layout["shape"],layout["bits"])
+    output=flushOutput(piRaw.makeBayerBuffer(mosaic,sensor))
+    assert output.bits==layout["bits"]
+    assert np.array_equal(output.array,mosaic)
+
+def test_flushTruncatedBuffer():
+    output=piRaw.PiBayerFlatArray(None)
+    output.write(makeBuffer()[:-1000])
+    with pytest.raises(ValueError) as errorInfo:
+        output.flush()
+    # the stream can be reused while the error is handled
+    output.seek(0)
+    output.truncate()
+    output.write(makeBuffer())
+    output.flush()
+    assert output.array.shape==(1944,2592)
+    assert "Bayer data" in str(errorInfo.value)
+
+def test_flushFailingUnpack(monkeypatch):
+    def failingUnpack(packed,out=None):
+        raise ValueError("unpack failed")
+    monkeypatch.setitem(piRaw.BAYER_PACKINGS[10],"unpack",failingUnpack)
+    output=piRaw.PiBayerFlatArray(None)
+    output.write(makeBuffer())
+    with pytest.raises(ValueError,match="unpack failed") as errorInfo:
+        output.flush()
+    monkeypatch.undo()
+    # the traceback of the error no longer refers to views of the stream, it can be reused
+    output.seek(0)
+    output.truncate()
+    output.write(makeBuffer())
+    output.flush()
+    assert output.array.shape==(1944,2592)
+    assert errorInfo.traceback
+
+@pytest.mark.parametrize("bits",sorted(piRaw.BAYER_PACKINGS))
+def test_packRoundTrip(bits):
+    packing=piRaw.BAYER_PACKINGS[bits]
+    mosaic=randomMosaic((6,24),bits)
+    packed=packing["pack"](mosaic)
+    assert packed.shape==(6,24*packing["bytes"]//packing["pixels"])
+    assert np.array_equal(packing["unpack"](packed),mosaic)
+
+def test_raw10RoundTrip(tmp_path):
+    filename=str(tmp_path/"frame.raw10")
+    # cols not a multiple of 4, padded by pack10()
+    mosaic=randomMosaic((10,22),10)
+    piRaw.writeRaw10(filename,mosaic,{"EXPTIME":2.0})
+    array,header=piRaw.readRaw10(filename)
+    assert np.array_equal(array,mosaic)
+    assert header=={"EXPTIME":2.0}
+
+def test_readRaw10OtherFile(tmp_path):
+    filename=tmp_path/"frame.fits"
+    filename.write_bytes(b"SIMPLE  =                    T")
+    with pytest.raises(ValueError):
+        piRaw.readRaw10(str(filename))
+
+def meteredScene(seed=0):
+    """ returns function(shutterSpeed) of a noise free 10 bit scene: sky with a gradient and 1% bright stars,
+    black level 16, sky level 500 at shutter speed 100000 microseconds
+    """
+    random=np.random.RandomState(seed)
+    rows,cols=np.ogrid[0:240,0:320]
+    rates=np.ones((240,320))*(0.5+(rows+cols)/(240+320))*(484/100000)
+    stars=random.randint(0,rates.size,rates.size//100)
+    rates.flat[stars]*=random.uniform(1.5,3.0,stars.size)
+    return lambda shutterSpeed: np.minimum(1023,np.rint(16+rates*shutterSpeed)).astype(np.uint16)
+
+def runMeter(meter,scene,shutterSpeed,maxPictures=8):
+    """ returns list of the shutter speeds chosen by meter until it does not change the shutter speed
+    """
+    shutterSpeeds=[shutterSpeed]
+    for _ in range(maxPictures):
+        shutterSpeed=meter.nextShutter(shutterSpeed,scene(shutterSpeed),10,10*1000000,16)
+        if shutterSpeed==shutterSpeeds[-1]:
+            break
+        shutterSpeeds.append(shutterSpeed)
+    return shutterSpeeds
+
+@pytest.mark.parametrize("mode",["mean","center","percentile"])
+@pytest.mark.parametrize("startShutter",[1000,20000,300000])
+def test_exposureMeterConverges(mode,startShutter):
+    meter=piRaw.ExposureMeter(mode)
+    scene=meteredScene()
+    shutterSpeeds=runMeter(meter,scene,startShutter)
+    # the metered value is proportional to the shutter speed: one correction, two if saturated at first
+    assert len(shutterSpeeds)<=3
+    value=meter.measure(scene(shutterSpeeds[-1]))[0]
+    assert abs(value-meter.targetLevel)<=0.05*meter.targetLevel
+
+@pytest.mark.parametrize("startShutter",[1000,100000,5000000])
+def test_exposureMeterHighlight(startShutter):
+    meter=piRaw.ExposureMeter("highlight")
+    scene=meteredScene()
+    shutterSpeeds=runMeter(meter,scene,startShutter)
+    highlight=meter.measure(scene(shutterSpeeds[-1]))[1]
+    assert abs(highlight-meter.highlightLevel)<=0.05*meter.highlightLevel
+    # clipped pictures are corrected by saturatedStep, then one correction without overshoot
+    numClipped=sum(meter.measure(scene(shutterSpeed))[1]>=meter.clipLevel for shutterSpeed in shutterSpeeds)
+    assert len(shutterSpeeds)<=numClipped+2
+    assert all(shutterSpeed>=shutterSpeeds[-1]/meter.saturatedStep for shutterSpeed in shutterSpeeds[1:])
+
+def test_exposureMeterHighlightNotClipped():
+    meter=piRaw.ExposureMeter("highlight")
+    scene=meteredScene()
+    shutterSpeed=runMeter(meter,scene,100000)[-1]
+    # highlights above saturatedLevel, but not clipped: corrected in one step, not by saturatedStep
+    highlight=meter.measure(scene(shutterSpeed))[1]
+    brighter=int(shutterSpeed*(1010-16)/(highlight-16))
+    assert meter.saturatedLevel<meter.measure(scene(brighter))[1]<meter.clipLevel
+    shutterSpeeds=runMeter(meter,scene,brighter)
+    assert len(shutterSpeeds)==2
+    assert abs(shutterSpeeds[1]/shutterSpeed-1)<meter.tolerance-1
+
+class FakeClock:
+    """ replaces time.monotonic() and the stop event of DeadlineScheduler: waiting advances the time
+    """
+    def __init__(self):
+        self.now=100.0
+        self.bStopped=False
+
+    def monotonic(self):
+        return self.now
+
+    def wait(self,timeout):
+        if not self.bStopped:
+            self.now+=timeout
+        return self.bStopped
+
+    def set(self):
+        self.bStopped=True
+
+def runScheduler(monkeypatch,interval,durations,policy="skip"):
+    """ returns (scheduler,starts): start times of pictures taking durations seconds
+    """
+    clock=FakeClock()
+    monkeypatch.setattr(piRaw.time,"monotonic",clock.monotonic)
+    scheduler=piRaw.DeadlineScheduler(interval,policy,clock)
+    starts=[]
+    for duration in durations:
+        assert scheduler.waitNext()
+        starts.append(clock.now)
+        clock.now+=duration
+    return (scheduler,np.array(starts)-starts[0])
+
+def test_schedulerNoDrift(monkeypatch):
+    durations=np.random.RandomState(0).uniform(0.1,0.9,100)
+    scheduler,starts=runScheduler(monkeypatch,1.0,durations)
+    # the starts do not depend on the durations
+    assert np.allclose(starts,np.arange(100))
+    assert np.allclose(scheduler.startErrors,0)
+    assert scheduler.numSkipped==0
+
+def test_schedulerSkip(monkeypatch):
+    scheduler,starts=runScheduler(monkeypatch,1.0,[0.5,2.2,0.5,1.2,0.5])
+    # 2.2 skips the deadline at 2, the ones at 3 and 5 are missed by less than maxLateness
+    assert np.allclose(starts,[0,1,3.2,4,5.2])
+    assert scheduler.numSkipped==1
+
+def test_schedulerCatchup(monkeypatch):
+    scheduler,starts=runScheduler(monkeypatch,1.0,[2.5,0.1,0.1,0.1],"catchup")
+    assert np.allclose(starts,[0,2.5,2.6,3])
+    assert scheduler.numSkipped==0
+
+def test_schedulerZeroDelay(monkeypatch):
+    scheduler,starts=runScheduler(monkeypatch,0,[0.5,1.0,2.0,0.5])
+    # pictures are taken as fast as possible, this is no start error
+    assert np.allclose(starts,[0,0.5,1.5,3.5])
+    assert np.allclose(scheduler.startErrors,0)
+    assert "max 0.0 ms" in scheduler.statistics()
+
+def test_schedulerStop(monkeypatch):
+    scheduler,starts=runScheduler(monkeypatch,1.0,[0.5])
+    scheduler.stop()
+    assert not scheduler.waitNext()
+
+def sigmaClipReference(frames,kappa):
+    """ returns the mean of frames over axis 0 without the values beyond kappa sigma of the other frames
+    """
+    frames=frames.astype(np.float64)
+    n=frames.shape[0]
+    keep=np.empty(frames.shape,dtype=bool)
+    for i in range(n):
+        others=np.delete(frames,i,axis=0)
+        # variance of the difference between a value and the mean of the others
+        variance=others.var(axis=0,ddof=1)*n/(n-1)
+        keep[i]=np.abs(frames[i]-others.mean(axis=0))<=kappa*np.sqrt(np.maximum(variance,1.0))
+    count=keep.sum(axis=0)
+    return np.where(count>0,(frames*keep).sum(axis=0)/np.maximum(count,1),frames.mean(axis=0))
+
+def stackFrames(accumulator,frames):
+    """ returns list of (filename,stack,header) of accumulator after adding frames
+    """
+    results=[]
+    for i,frame in enumerate(frames):
+        result=accumulator.add(frame,"frame{:d}".format(i),{"EXPTIME":2.0})
+        if result is not None:
+            results.append(result)
+    result=accumulator.flush()
+    if result is not None:
+        results.append(result)
+    return results
+
+def test_stackSigmaClip():
+    random=np.random.RandomState(0)
+    frames=random.poisson(200,(8,40,60)).astype(np.uint16)
+    # satellite trail in one frame
+    frames[3,10,:]+=500
+    accumulator=piRaw.StackAccumulator("sigma",8)
+    accumulator.chunkRows=16
+    [(filename,stack,header)]=stackFrames(accumulator,frames)
+    assert filename=="frame0"
+    assert header["NCOMBINE"]==8 and header["EXPTIME"]==2.0
+    assert stack.dtype==np.float32
+    assert np.allclose(stack,sigmaClipReference(frames,accumulator.kappa),rtol=1e-6)
+    assert np.allclose(stack[10],np.delete(frames,3,axis=0)[:,10].mean(axis=0),atol=10)
+
+@pytest.mark.parametrize("mode",["sum","mean"])
+def test_stackSumMean(mode):
+    frames=np.random.RandomState(0).randint(0,1024,(5,8,12)).astype(np.uint16)
+    results=stackFrames(piRaw.StackAccumulator(mode,3),frames)
+    assert [filename for filename,stack,header in results]==["frame0","frame3"]
+    for (filename,stack,header),group in zip(results,(frames[:3],frames[3:])):
+        assert header["NCOMBINE"]==len(group)
+        if mode=="sum":
+            assert np.array_equal(stack,group.sum(axis=0))
+            assert header["EXPTIME"]==2.0*len(group)
+        else:
+            assert np.allclose(stack,group.mean(axis=0))
+            assert header["EXPTIME"]==2.0
+
+def darkFrames(seed=0):
+    """ returns (dark,picture,hot): master dark with hot pixels, picture with the same hot pixels
+    and boolean mask of the hot pixels
+    """
+    random=np.random.RandomState(seed)
+    shape=(40,60)
+    hot=np.zeros(shape,dtype=bool)
+    hot.flat[random.choice(hot.size,20,replace=False)]=True
+    dark=(16+random.randint(0,4,shape)+hot*300).astype(np.uint16)
+    picture=(np.full(shape,200)+hot*300).astype(np.uint16)
+    return (dark,picture,hot)
+
+def test_darkLibraryRoundTrip(tmp_path):
+    dark,picture,hot=darkFrames()
+    library=piRaw.DarkLibrary(tmp_path/"darks")
+    assert library.add(dark,1000000,100)==hot.sum()
+    assert library.keys()==[(1000000,100)]
+    # a new library loads the entry from the directory, nearest shutter speed of the same iso
+    library=piRaw.DarkLibrary(tmp_path/"darks")
+    assert library.correct(picture,2000000,100)==hot.sum()
+    assert np.all(picture==200)
+    assert library.correct(picture,1000000,800)==0
+
+def test_darkLibraryNotContiguous(tmp_path):
+    dark,picture,hot=darkFrames()
+    library=piRaw.DarkLibrary(tmp_path)
+    library.add(dark[::-1,::-1],1000000,100)
+    # flipped view of the rows of a larger buffer
+    buffer=np.zeros((picture.shape[0],picture.shape[1]+4),dtype=np.uint16)
+    buffer[:,:-4]=picture
+    view=buffer[:,:-4][::-1,::-1]
+    assert library.correct(view,1000000,100)==hot.sum()
+    assert np.all(buffer[:,:-4]==200)
+
+def test_darkLibraryConcurrentLoad(tmp_path,monkeypatch):
+    dark,picture,hot=darkFrames()
+    library=piRaw.DarkLibrary(tmp_path)
+    library.add(dark,1000000,100)
+    loads=[]
+    load=np.load
+    def countingLoad(*args,**kwargs):
+        loads.append(args)
+        time.sleep(0.05)
+        return load(*args,**kwargs)
+    monkeypatch.setattr(np,"load",countingLoad)
+    pictures=[picture.copy() for _ in range(4)]
+    threads=[threading.Thread(target=library.correct,args=(p,1000000,100)) for p in pictures]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads)==1
+    assert all(np.all(p==200) for p in pictures)
+
+def test_simulatedNoiseFrames():
+    camera=piRaw.SimulatedPiCamera("RP_OV5647",seed=1)
+    buffers=[bytes(camera._buffer(0.1)) for _ in range(camera.numNoiseFrames+1)]
+    # consecutive frames cycle through the noise realizations
+    assert len(set(buffers[:-1]))==camera.numNoiseFrames
+    assert buffers[-1]==buffers[0]
+    # with their own cycle per setting
+    assert bytes(camera._buffer(0.2)) not in buffers
+    assert bytes(camera._buffer(0.1))==buffers[1]
+
+def test_frameProcessorOrder():
+    delivered=[]
+    active=[]
+    def process(i):
+        active.append(i)
+        # later frames are processed faster
+        time.sleep(0.002*(20-i))
+        return i*i
+    processor=piRaw.FrameProcessor(process,delivered.append,numWorkers=3)
+    for i in range(20):
+        processor.submit(i)
+        assert processor.numPending<=4
+    processor.close()
+    assert delivered==[i*i for i in range(20)]
+    assert sorted(active)==list(range(20))
+
+def test_frameProcessorError():
+    delivered=[]
+    def process(i):
+        if i==3:
+            raise ValueError("frame 3 failed")
+        return i
+    processor=piRaw.FrameProcessor(process,delivered.append,numWorkers=2)
+    with pytest.raises(ValueError,match="frame 3 failed"):
+        for i in range(100):
+            processor.submit(i)
+            time.sleep(0.001)
+    with pytest.raises(ValueError,match="frame 3 failed"):
+        processor.close()
+    # frames before the error are delivered in order
+    assert delivered[:3]==[0,1,2]
+    assert 3 not in delivered
+
+def test_mappedFits(tmp_path):
+    filename=str(tmp_path/"mapped.fits")
+    mosaic=randomMosaic((30,44),10)
+    data=piRaw.mapFits(filename,mosaic.shape)
+    piRaw.unpack10(piRaw.pack10(mosaic),data)
+    piRaw.finishMappedFits(filename,data,{"EXPTIME":1.5,"DATE-OBS":"2016-08-28T16:30:35"})
+    del data
+    with pyfits.open(filename) as hduList:
+        assert np.array_equal(hduList[0].data,mosaic)
+        assert hduList[0].header["EXPTIME"]==1.5
+        assert hduList[0].header["DATE-OBS"]=="2016-08-28T16:30:35"
+
+def test_demosaic12BitSaturatedStar():
+    # single red pixel with saturated green neighbours, e.g. a bright star
+    star=np.zeros((8,8),dtype=np.uint16)
+    star[0::2,1::2]=4095
+    star[1::2,0::2]=4095
+    star[4,4]=4095
+    assert piRaw.demosaicEdgeAware(star,bits=12)[4,4,1]==4095
+
+@pytest.mark.parametrize("algorithm",["superpixel","bilinear","edge"])
+def test_demosaic12BitMatches10Bit(algorithm):
+    function=piRaw.DEMOSAIC_ALGORITHMS[algorithm]
+    low=randomMosaic((32,48),10)
+    if algorithm=="edge":
+        expected=function(low,bits=10).astype(np.int32)<<2
+        result=function(low<<2,bits=12)
+    else:
+        expected=function(low).astype(np.int32)<<2
+        result=function(low<<2)
+    # equal up to the rounding of the shifts
+    assert np.abs(result-expected).max()<=8
+
+@pytest.mark.parametrize("factor",piRaw.BINNING_FACTORS)
+def test_binMosaic(factor):
+    mosaic=randomMosaic((48,64),12)
+    assert np.array_equal(piRaw.binMosaic(mosaic,factor),binReference(mosaic,factor))
+
+@pytest.mark.parametrize("bits",sorted(piRaw.BAYER_PACKINGS))
+@pytest.mark.parametrize("binning",piRaw.BINNING_FACTORS)
+def test_cropAndUnpack(bits,binning):
+    mosaic=randomMosaic((96,128),bits)
+    packed=piRaw.BAYER_PACKINGS[bits]["pack"](mosaic)
+    crop=(13,7,70,50)
+    x,y,width,height=piRaw.alignCrop(crop,mosaic.shape,binning)
+    assert x%4==0 and y%2==0 and width%(2*binning)==0 and height%(2*binning)==0
+    result=piRaw.unpackMosaic(piRaw.cropPacked(packed,bits,crop,binning),bits,binning,chunkRows=8)
+    assert np.array_equal(result,binReference(mosaic[y:y+height,x:x+width],binning))
+
+def test_flushCropBinning():
+    layout=piRaw.BAYER_BUFFER_LAYOUTS["RP_imx477"]
+    mosaic=randomMosaic(layout["shape"],layout["bits"])
+    crop=(1001,501,1200,800)
+    output=piRaw.PiBayerFlatArray(None,crop=crop,binning=2)
+    output.write(piRaw.makeBayerBuffer(mosaic,"RP_imx477"))
+    output.flush()
+    x,y,width,height=piRaw.alignCrop(crop,mosaic.shape,2)
+    assert np.array_equal(output.array,binReference(mosaic[y:y+height,x:x+width],2))
+
+def test_eventDetector(tmp_path):
+    rng=np.random.default_rng(0)
+    frames=[rng.integers(60,68,size=(64,128),dtype=np.uint16) for i in range(10)]
+    # a streak across several blocks in frame 5
+    frames[5][20:24,10:100]+=200
+    released=[]
+    detector=piRaw.EventDetector(tmp_path/"events.csv",lambda mosaic:released.append(id(mosaic)),framesBefore=2,framesAfter=2)
+    written=[]
+    for i,mosaic in enumerate(frames):
+        written+=detector.add(mosaic,"frame{:d}.fits".format(i),{})
+    assert detector.flush()=="1 events in 10 frames"
+    assert [filename for filename,mosaic,header in written]==["frame{:d}.fits".format(i) for i in (3,4,5,6,7)]
+    assert all(header["EVENT"]==1 for filename,mosaic,header in written)
+    # all other frames go back through release, the frames after the event when flushing the ring buffer
+    assert released==[id(frames[i]) for i in (0,1,2,8,9)]
+    rows=(tmp_path/"events.csv").read_text().splitlines()
+    assert rows[0]==",".join(piRaw.EventDetector.INDEX_COLUMNS)
+    assert [row.split(",")[1] for row in rows[1:]]==["before","before","trigger","after","after"]
+    x,y=(int(value) for value in rows[3].split(",")[-2:])
+    assert 10<=x<100 and 12<=y<32
+
+def starMosaic(sigma,seed=0,amplitude=600.0,shape=(128,128),center=(61.0,66.0)):
+    """ returns 10 bit mosaic with a Gaussian star of sigma mosaic pixels on a noisy background, None for no star
+    """
+    rng=np.random.default_rng(seed)
+    mosaic=rng.normal(64.0,2.0,size=shape)
+    if sigma is not None:
+        rows,cols=np.indices(shape)
+        mosaic+=amplitude*np.exp(-((rows-center[0])**2+(cols-center[1])**2)/(2*sigma**2))
+    return np.clip(np.round(mosaic),0,1023).astype(np.uint16)
+
+def test_focusMeterSharpness():
+    meter=piRaw.FocusMeter()
+    measurements=[meter.measure(starMosaic(sigma)) for sigma in (1.5,2.5,4.0,6.0)]
+    assert all(measurement is not None for measurement in measurements)
+    hfrs=[measurement[0] for measurement in measurements]
+    gradients=[measurement[1] for measurement in measurements]
+    assert hfrs==sorted(hfrs) and gradients==sorted(gradients,reverse=True)
+    hfr,gradient,peak,x,y=measurements[1]
+    assert abs(x-66)<=2 and abs(y-61)<=2 and 500<peak<=664
+
+@pytest.mark.parametrize("seed",range(5))
+def test_focusMeterNoise(seed):
+    assert piRaw.FocusMeter().measure(starMosaic(None,seed)) is None
+
+@pytest.mark.parametrize("sensor",sorted(piRaw.RawCamera.CAMERA_CAPABIILITES))
+def test_capabilitiesValid(sensor):
+    capabilities=piRaw.CapabilityService.validate(sensor,piRaw.RawCamera.CAMERA_CAPABIILITES[sensor])
+    assert capabilities["max_shutter"]<=1000000/capabilities["min_framerate"]
+
+def test_capabilitiesMalformedKey():
+    capabilities=dict(piRaw.RawCamera.CAMERA_CAPABIILITES["RP_imx219"])
+    capabilities["max_shutter="]=capabilities.pop("max_shutter")
+    with pytest.raises(ValueError,match="max_shutter"):
+        piRaw.CapabilityService.validate("RP_imx219",capabilities)
+
+def test_capabilityCache(tmp_path,monkeypatch):
+    cacheFile=str(tmp_path/"capabilities.json")
+    camera=piRaw.SimulatedPiCamera("RP_imx219")
+    probed=[]
+    probe=piRaw.CapabilityService._probe
+    monkeypatch.setattr(piRaw.CapabilityService,"_probe",lambda self,*args:probed.append(args[1]) or probe(self,*args))
+    sensor,capabilities=piRaw.CapabilityService(cacheFile).lookup(camera)
+    assert sensor=="RP_imx219" and probed==["RP_imx219"]
+    # a new session loads the cache without probing
+    assert piRaw.CapabilityService(cacheFile).lookup(camera)==(sensor,capabilities)
+    assert probed==["RP_imx219"]
+    # a changed table entry invalidates the cached one
+    table=dict(piRaw.RawCamera.CAMERA_CAPABIILITES)
+    table["RP_imx219"]=dict(table["RP_imx219"],max_shutter=5*1000000)
+    monkeypatch.setattr(piRaw.RawCamera,"CAMERA_CAPABIILITES",table)
+    sensor,capabilities=piRaw.CapabilityService(cacheFile).lookup(camera)
+    assert probed==["RP_imx219","RP_imx219"] and capabilities["max_shutter"]==5*1000000